@@ -0,0 +1,514 @@
+# /// script
+# requires-python = ">=3.11"
+# dependencies = [
+#   "langchain",
+#   "langchain-openai",
+#   "langchain-community",
+#   "numpy",
+# ]
+# ///
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import os
+import random
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, asdict
+from multiprocessing import get_context
+from pathlib import Path
+from typing import List, Dict, Any, Optional
+
+import create
+from create import (
+    CallMetrics,
+    CheckpointManager,
+    GenerationContext,
+    RequestScheduler,
+    content_fingerprint,
+    load_and_split_documents,
+    load_typescript_examples,
+)
+
+logger = logging.getLogger("benchmark")
+
+# Corpus sizes as (documentation sections, TypeScript example files)
+CORPUS_SIZES = {
+    "small": (40, 10),
+    "medium": (400, 60),
+    "large": (2000, 250),
+}
+
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+class MockAPIError(Exception):
+    """A 5xx response from the mock model."""
+
+    def __init__(self, message: str, status_code: int = 500):
+        super().__init__(message)
+        self.status_code = status_code
+
+class MockRateLimitError(MockAPIError):
+    """A 429 response from the mock model, with a Retry-After header."""
+
+    def __init__(self, message: str, retry_after: float):
+        super().__init__(message, status_code=429)
+        self.response = type("Response", (), {"headers": {"retry-after": str(retry_after)}})()
+
+class SimulatedCrash(BaseException):
+    """Raised by the mock model to abort a run, as if the process had been killed."""
+
+@dataclass
+class MockResponse:
+    """The parts of a chat model response that create.py reads."""
+    content: str
+    usage_metadata: Dict[str, int]
+
+class MockChatModel:
+    """Deterministic stand-in for ChatOpenAI.
+
+    Each call draws its latency and outcome from a generator seeded by the
+    prompt and the number of earlier calls with that prompt, so a retried
+    request can succeed and two runs with the same settings behave the same.
+    Successful responses follow the format each prompt asks for.
+    """
+
+    def __init__(self, latency: str = "lognormal", latency_ms: float = 5.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, malformed_rate: float = 0.0, seed: int = 0,
+                 crash_after: Optional[int] = None):
+        if latency not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {latency}")
+        self.model_name = "mock-chat"
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.malformed_rate = malformed_rate
+        self.seed = seed
+        self.crash_after = crash_after
+        self.calls = 0
+        self.errors = 0
+        self.rate_limited = 0
+        self.malformed = 0
+        self.first_call_at: Optional[float] = None
+        self._attempts: Dict[str, int] = {}
+
+    def _sample_latency(self, rng: random.Random) -> float:
+        mean = self.latency_ms / 1000
+        if self.latency == "constant":
+            return mean
+        if self.latency == "uniform":
+            return rng.uniform(0, 2 * mean)
+        if self.latency == "exponential":
+            return rng.expovariate(1 / mean) if mean > 0 else 0.0
+        # Lognormal with sigma 1, scaled so the mean matches latency_ms
+        return rng.lognormvariate(math.log(mean) - 0.5, 1.0) if mean > 0 else 0.0
+
+    def _draw(self, prompt: str) -> tuple:
+        """Return (latency, outcome) for the next call with this prompt."""
+        if self.crash_after is not None and self.calls >= self.crash_after:
+            # Crash once; asyncio.run cancels whatever else is in flight
+            self.crash_after = None
+            raise SimulatedCrash(f"Simulated crash after {self.calls} calls")
+        if self.first_call_at is None:
+            self.first_call_at = time.perf_counter()
+        self.calls += 1
+        key = content_fingerprint(prompt)
+        attempt = self._attempts.get(key, 0)
+        self._attempts[key] = attempt + 1
+        rng = random.Random(f"{self.seed}:{key}:{attempt}")
+        latency = self._sample_latency(rng)
+        roll = rng.random()
+        if roll < self.rate_limit_rate:
+            return latency, "rate_limit"
+        if roll < self.rate_limit_rate + self.error_rate:
+            return latency, "error"
+        if roll < self.rate_limit_rate + self.error_rate + self.malformed_rate:
+            return latency, rng.choice(["fenced", "truncated"])
+        return latency, "ok"
+
+    def _respond(self, prompt: str, outcome: str, response_format: Optional[Dict[str, Any]] = None) -> MockResponse:
+        if outcome == "rate_limit":
+            self.rate_limited += 1
+            raise MockRateLimitError("Rate limit reached for mock-chat", retry_after=0.01)
+        if outcome == "error":
+            self.errors += 1
+            raise MockAPIError("The server had an error while processing your request")
+        content = self._content(prompt, response_format is not None)
+        if outcome == "fenced":
+            self.malformed += 1
+            content = f"Here are the examples:\n```json\n{content}\n```\nLet me know if you need more."
+        elif outcome == "truncated":
+            self.malformed += 1
+            content = content[:len(content) * 3 // 4]
+        usage = {"input_tokens": len(prompt) // 4 + 1, "output_tokens": len(content) // 4 + 1}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        return MockResponse(content, usage)
+
+    @staticmethod
+    def _content(prompt: str, structured: bool = False) -> str:
+        tag = content_fingerprint(prompt)[:8]
+        section_ids = re.findall(r'<section id="([0-9a-f]+)">', prompt)
+        if section_ids:
+            return json.dumps({
+                section_id: [{"question": f"What does section {section_id} describe?",
+                              "answer": f"Section {section_id} describes {tag}."}]
+                for section_id in section_ids
+            })
+        if '"instruction"' in prompt:
+            pairs = [{
+                "instruction": f"Create a component for scenario {tag}",
+                "implementation": f"```tsx\nexport function Scenario{tag}() {{\n  return <div>{tag}</div>;\n}}\n```",
+            }]
+        else:
+            pairs = [
+                {"question": f"How do I use feature {tag}?", "answer": f"Feature {tag} is configured through props."},
+                {"question": f"What does {tag} return?", "answer": f"It returns a rendered {tag} element."},
+            ]
+        # Strict json_schema responses wrap the array in an object
+        return json.dumps({"pairs": pairs} if structured else pairs)
+
+    def invoke(self, prompt: str, response_format: Optional[Dict[str, Any]] = None, **kwargs) -> MockResponse:
+        latency, outcome = self._draw(prompt)
+        time.sleep(latency)
+        return self._respond(prompt, outcome, response_format)
+
+    async def ainvoke(self, prompt: str, response_format: Optional[Dict[str, Any]] = None, **kwargs) -> MockResponse:
+        latency, outcome = self._draw(prompt)
+        await asyncio.sleep(latency)
+        return self._respond(prompt, outcome, response_format)
+
+@dataclass
+class Scenario:
+    """One benchmark configuration."""
+    size: str
+    use_async: bool = False
+    max_concurrency: int = 8
+    latency: str = "lognormal"
+    latency_ms: float = 5.0
+    error_rate: float = 0.0
+    rate_limit_rate: float = 0.0
+    malformed_rate: float = 0.0
+    pack_tokens: int = 0
+    structured_output: bool = False
+    seed: int = 0
+
+    @property
+    def name(self) -> str:
+        return f"{self.size}-{'async' if self.use_async else 'sync'}"
+
+def write_synthetic_corpus(directory: Path, doc_sections: int, code_files: int, seed: int = 0):
+    """Write a synthetic llm-full.txt and TypeScript examples directory; return their paths."""
+    rng = random.Random(seed)
+    vocabulary = [f"{rng.choice('bcdfghklmnprstvz')}{rng.choice('aeiou')}{rng.choice('lmnrst')}{i}" for i in range(2000)]
+
+    def sentence() -> str:
+        return " ".join(rng.choices(vocabulary, k=rng.randint(8, 20))).capitalize() + "."
+
+    doc_file = directory / "llm-full.txt"
+    with open(doc_file, "w", encoding="utf-8") as f:
+        for section in range(doc_sections):
+            f.write(f"## Section {section}\n\n")
+            for _ in range(rng.randint(3, 6)):
+                f.write(" ".join(sentence() for _ in range(rng.randint(2, 5))) + "\n\n")
+
+    examples_dir = directory / "examples"
+    examples_dir.mkdir()
+    for index in range(code_files):
+        props = "\n".join(f"  {word}?: string;" for word in rng.sample(vocabulary, 4))
+        body = "\n".join(f"      <p>{{props.{word}}}</p>" for word in rng.sample(vocabulary, 3))
+        (examples_dir / f"Example{index}.tsx").write_text(
+            f"import React from 'react';\n\n"
+            f"interface Example{index}Props {{\n{props}\n}}\n\n"
+            f"export function Example{index}(props: Example{index}Props) {{\n"
+            f"  return (\n    <div>\n{body}\n    </div>\n  );\n}}\n",
+            encoding="utf-8",
+        )
+    # One component long enough to be split into declarations, with apostrophes
+    # in JSX text that the declaration scanner must not treat as open strings.
+    sections = "\n".join(
+        f"export function Notice{index}() {{\n"
+        f"  return <p>Don't {' '.join(rng.sample(vocabulary, 12))}, it isn't ready.</p>;\n}}\n"
+        for index in range(64)
+    )
+    (examples_dir / "Notices.tsx").write_text(f"import React from 'react';\n\n{sections}", encoding="utf-8")
+    return doc_file, examples_dir
+
+def peak_rss_mb() -> float:
+    """Return this process's peak resident set size in MiB."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is reported in bytes on macOS and in KiB elsewhere
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _generate(scenario: Scenario, all_examples, llm: MockChatModel, checkpoint_manager: CheckpointManager,
+              metrics: Optional[CallMetrics] = None):
+    context = GenerationContext(scheduler=RequestScheduler(
+        max_concurrency=scenario.max_concurrency if scenario.use_async else 1,
+        requests_per_minute=10 ** 9,
+        tokens_per_minute=10 ** 12,
+        base_delay=0.01,
+        max_delay=0.1,
+    ), metrics=metrics, structured_output=scenario.structured_output)
+    if scenario.use_async:
+        return asyncio.run(create.acreate_comprehensive_training_data_with_checkpoints(
+            all_examples, llm, checkpoint_manager, max_concurrency=scenario.max_concurrency,
+            context=context, pack_tokens=scenario.pack_tokens
+        ))
+    return create.create_comprehensive_training_data_with_checkpoints(
+        all_examples, llm, checkpoint_manager, context, pack_tokens=scenario.pack_tokens
+    )
+
+def _mock_model(scenario: Scenario, crash_after: Optional[int] = None) -> MockChatModel:
+    return MockChatModel(scenario.latency, scenario.latency_ms, scenario.error_rate, scenario.rate_limit_rate,
+                         scenario.malformed_rate, scenario.seed, crash_after)
+
+def run_scenario(scenario: Scenario) -> Dict[str, Any]:
+    """Run one scenario end to end and return its measurements.
+
+    A full run is timed first. A second run in a fresh directory is then
+    crashed halfway through and resumed; resume time is the delay between
+    starting the resumed run and its first model call (journal replay,
+    output truncation and planning).
+    """
+    logging.getLogger("create").setLevel(logging.WARNING)
+    doc_sections, code_files = CORPUS_SIZES[scenario.size]
+    with tempfile.TemporaryDirectory() as workdir:
+        workdir = Path(workdir)
+        doc_file, examples_dir = write_synthetic_corpus(workdir, doc_sections, code_files, scenario.seed)
+        all_examples = load_and_split_documents(str(doc_file)) + load_typescript_examples(str(examples_dir))
+        # Build the topic index here so it is memoized for the runs below and
+        # cached in workdir rather than next to a real corpus's index.
+        create.get_lexical_index(all_examples, cache_dir=str(workdir / create.INDEX_CACHE_DIR))
+
+        llm = _mock_model(scenario)
+        metrics = CallMetrics()
+        checkpoint_manager = CheckpointManager(str(workdir / "full.checkpoint.jsonl"), str(workdir / "full.jsonl"))
+        started = time.perf_counter()
+        checkpoint = _generate(scenario, all_examples, llm, checkpoint_manager, metrics)
+        wall_time = time.perf_counter() - started
+        checkpoint_manager.close()
+        journal_bytes = os.path.getsize(checkpoint_manager.checkpoint_file)
+        output_bytes = os.path.getsize(checkpoint_manager.partial_file)
+        rss = peak_rss_mb()
+
+        crashed_manager = CheckpointManager(str(workdir / "resume.checkpoint.jsonl"), str(workdir / "resume.jsonl"))
+        try:
+            _generate(scenario, all_examples, _mock_model(scenario, crash_after=llm.calls // 2), crashed_manager)
+        except SimulatedCrash:
+            pass
+        finally:
+            crashed_manager.close()
+        resumed_llm = _mock_model(scenario)
+        resumed_manager = CheckpointManager(str(workdir / "resume.checkpoint.jsonl"), str(workdir / "resume.jsonl"))
+        started = time.perf_counter()
+        _generate(scenario, all_examples, resumed_llm, resumed_manager)
+        resumed_manager.close()
+        resume_time = (resumed_llm.first_call_at or time.perf_counter()) - started
+
+    return {
+        "scenario": scenario.name,
+        **asdict(scenario),
+        "examples": len(all_examples),
+        "training_examples": checkpoint.stats.total,
+        "failed_units": len(checkpoint.failed_units),
+        "requests": llm.calls,
+        "rate_limited": llm.rate_limited,
+        "errors": llm.errors,
+        "malformed": llm.malformed,
+        "wall_time_s": round(wall_time, 3),
+        "requests_per_s": round(llm.calls / wall_time, 1) if wall_time else 0.0,
+        "checkpoint_bytes": journal_bytes,
+        "output_bytes": output_bytes,
+        "peak_rss_mb": round(rss, 1),
+        "resume_time_s": round(resume_time, 4),
+        "call_metrics": metrics.summary(),
+    }
+
+def run_isolated(scenario: Scenario) -> Dict[str, Any]:
+    """Run a scenario in a fresh process so peak RSS is measured per scenario."""
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+        return executor.submit(run_scenario, scenario).result()
+
+def print_report(results: List[Dict[str, Any]]):
+    """Print a fixed-width table of benchmark results."""
+    columns = [
+        ("scenario", "scenario", "{}"),
+        ("examples", "examples", "{}"),
+        ("requests", "requests", "{}"),
+        ("failed", "failed_units", "{}"),
+        ("wall s", "wall_time_s", "{:.2f}"),
+        ("req/s", "requests_per_s", "{:.1f}"),
+        ("p95 ms", "latency_p95", "{:.1f}"),
+        ("ckpt KiB", "checkpoint_bytes", "{:.1f}"),
+        ("RSS MiB", "peak_rss_mb", "{:.1f}"),
+        ("resume ms", "resume_time_s", "{:.1f}"),
+    ]
+    rows = []
+    for result in results:
+        latency_p95 = max((stats["latency_p95"] for stats in result["call_metrics"].values()), default=0.0)
+        values = dict(result, checkpoint_bytes=result["checkpoint_bytes"] / 1024,
+                      resume_time_s=result["resume_time_s"] * 1000, latency_p95=latency_p95 * 1000)
+        rows.append([fmt.format(values[key]) for _, key, fmt in columns])
+    widths = [max(len(header), *(len(row[i]) for row in rows)) for i, (header, _, _) in enumerate(columns)]
+    print("  ".join(header.rjust(width) for (header, _, _), width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(value.rjust(width) for value, width in zip(row, widths)))
+
+def compare_to_baseline(results: List[Dict[str, Any]], baseline_file: str, tolerance: float) -> List[str]:
+    """Return a message for every scenario whose throughput fell below the baseline by more than tolerance."""
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = {result["scenario"]: result for result in json.load(f)}
+    regressions = []
+    for result in results:
+        previous = baseline.get(result["scenario"])
+        if previous and result["requests_per_s"] < previous["requests_per_s"] * (1 - tolerance):
+            regressions.append(f"{result['scenario']}: {result['requests_per_s']} req/s "
+                               f"(baseline {previous['requests_per_s']} req/s)")
+    return regressions
+
+CREATE_SCRIPT = Path(create.__file__).resolve()
+STARTUP_COMMANDS = {
+    "stats": ["stats"],
+    "clear-checkpoint": ["clear-checkpoint"],
+    "help": ["--help"],
+}
+# Top-level packages the non-LLM commands must not import
+HEAVY_MODULES = ("langchain", "langchain_core", "langchain_community", "langchain_openai", "openai", "tiktoken")
+
+def run_startup(repeats: int) -> List[Dict[str, Any]]:
+    """Time the non-LLM create.py commands in fresh interpreters.
+
+    Each command runs repeats times in an empty directory against a missing
+    output; the median wall time is reported next to a bare interpreter so
+    the script's own import cost is visible. The heavy modules loaded by
+    `import create` are recorded as well.
+    """
+    def median_ms(args: List[str], cwd: str) -> float:
+        times = []
+        for _ in range(repeats):
+            started = time.perf_counter()
+            subprocess.run([sys.executable, *args], cwd=cwd, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            times.append(time.perf_counter() - started)
+        return statistics.median(times) * 1000
+
+    results = []
+    with tempfile.TemporaryDirectory() as workdir:
+        results.append({"command": "interpreter", "median_ms": median_ms(["-c", "pass"], workdir)})
+        for name, command in STARTUP_COMMANDS.items():
+            results.append({"command": name, "median_ms": median_ms([str(CREATE_SCRIPT), *command], workdir)})
+        probe = ("import json, sys; import create; "
+                 f"print(json.dumps(sorted(m for m in sys.modules if m.split('.')[0] in {HEAVY_MODULES!r})))")
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [str(CREATE_SCRIPT.parent),
+                                                                           os.environ.get("PYTHONPATH")])))
+        loaded = json.loads(subprocess.run([sys.executable, "-c", probe], cwd=workdir, env=env, check=True,
+                                           capture_output=True, text=True).stdout)
+    results.append({"command": "import create", "heavy_modules": loaded})
+    return results
+
+def check_startup(results: List[Dict[str, Any]], target_ms: float) -> List[str]:
+    """Return a message for every command slower than target_ms and for heavy imports at module level."""
+    failures = []
+    for result in results:
+        if result["command"] not in STARTUP_COMMANDS:
+            continue
+        if result["median_ms"] > target_ms:
+            failures.append(f"{result['command']}: {result['median_ms']:.0f} ms (target {target_ms:.0f} ms)")
+    loaded = next(result["heavy_modules"] for result in results if result["command"] == "import create")
+    if loaded:
+        failures.append("import create loads " + ", ".join(loaded))
+    return failures
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse command line options."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark create.py offline against a deterministic mock chat model."
+    )
+    parser.add_argument("--sizes", nargs="+", choices=list(CORPUS_SIZES), default=["small", "medium"],
+                        help="Synthetic corpus sizes to benchmark")
+    parser.add_argument("--mode", choices=["sync", "async", "both"], default="both",
+                        help="Which orchestrator to benchmark")
+    parser.add_argument("--max-concurrency", type=int, default=8,
+                        help="Concurrency limit for the async orchestrator")
+    parser.add_argument("--latency", choices=LATENCY_DISTRIBUTIONS, default="lognormal",
+                        help="Mock response latency distribution")
+    parser.add_argument("--latency-ms", type=float, default=5.0,
+                        help="Mean mock response latency in milliseconds")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="Fraction of calls that fail with a 5xx error")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0,
+                        help="Fraction of calls that fail with a 429 rate limit")
+    parser.add_argument("--malformed-rate", type=float, default=0.0,
+                        help="Fraction of calls that return fenced or truncated JSON")
+    parser.add_argument("--pack-tokens", type=int, default=0,
+                        help="Pack documentation chunks into requests of up to this many tokens")
+    parser.add_argument("--structured-output", action="store_true",
+                        help="Request JSON-schema structured output from the mock model")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="Seed for the synthetic corpus and the mock model")
+    parser.add_argument("--json", metavar="FILE",
+                        help="Also write the results to FILE as JSON")
+    parser.add_argument("--baseline", metavar="FILE",
+                        help="Exit with status 1 if throughput regressed against results saved with --json")
+    parser.add_argument("--tolerance", type=float, default=0.2,
+                        help="Allowed fractional drop in requests/sec before --baseline fails")
+    parser.add_argument("--startup", action="store_true",
+                        help="Measure startup of the non-LLM commands instead of running scenarios")
+    parser.add_argument("--startup-target-ms", type=float, default=500.0,
+                        help="Exit with status 1 if a non-LLM command takes longer than this to run (default: 500)")
+    parser.add_argument("--startup-repeats", type=int, default=5,
+                        help="Runs per command for --startup; the median is reported (default: 5)")
+    return parser.parse_args(argv)
+
+def main(argv: Optional[List[str]] = None):
+    """Run the selected scenarios and report their measurements."""
+    args = parse_args(argv)
+    if args.startup:
+        results = run_startup(args.startup_repeats)
+        for result in results:
+            if "median_ms" in result:
+                print(f"{result['command']:>16}  {result['median_ms']:8.1f} ms")
+            else:
+                print(f"{result['command']:>16}  heavy modules: {', '.join(result['heavy_modules']) or 'none'}")
+        if args.json:
+            with open(args.json, 'w', encoding='utf-8') as f:
+                json.dump(results, f, indent=2)
+        failures = check_startup(results, args.startup_target_ms)
+        for failure in failures:
+            logger.error(f"Startup target missed: {failure}")
+        if failures:
+            sys.exit(1)
+        return
+
+    modes = {"sync": [False], "async": [True], "both": [False, True]}[args.mode]
+    results = []
+    for size in args.sizes:
+        for use_async in modes:
+            scenario = Scenario(size, use_async, args.max_concurrency, args.latency, args.latency_ms, args.error_rate,
+                                args.rate_limit_rate, args.malformed_rate, args.pack_tokens, args.structured_output,
+                                args.seed)
+            logger.info(f"Running {scenario.name}")
+            results.append(run_isolated(scenario))
+    print_report(results)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        regressions = compare_to_baseline(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            logger.error(f"Throughput regression: {regression}")
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
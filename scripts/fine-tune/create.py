@@ -4,26 +4,58 @@
 #   "langchain",
 #   "langchain-openai",
 #   "langchain-community",
+#   "numpy",
+#   "tree-sitter",
+#   "tree-sitter-typescript",
 # ]
 # ///
 
+from __future__ import annotations
+
+import argparse
+import asyncio
+import gzip
+import hashlib
+import heapq
+import io
+import itertools
 import json
 import logging
+import mmap
 import sys
 import os
+import random
+import re
+import signal
+import threading
+import time
+from array import array
+from multiprocessing import get_context
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import ExitStack
 from pathlib import Path
-from typing import List, Dict, Any, Tuple
-from dataclasses import dataclass, asdict
+from typing import TYPE_CHECKING, BinaryIO, List, Dict, Any, Callable, FrozenSet, Iterable, Iterator, Optional, Set, Tuple
+from dataclasses import dataclass, asdict, field, replace
 from datetime import datetime
 
-from langchain.text_splitter import MarkdownTextSplitter
-from langchain_community.document_loaders import TextLoader
-from langchain_openai import ChatOpenAI
+import numpy as np
+
+# langchain is imported where it is used so commands that never load documents
+# or call the model (stats, clear-checkpoint) start quickly
+if TYPE_CHECKING:
+    from langchain_openai import ChatOpenAI
+
+DEFAULT_MODEL = "gpt-4"
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+def content_fingerprint(text: str) -> str:
+    """Return a short stable hash of text."""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()[:16]
+
 @dataclass
 class TrainingExample:
     """Represents a training example with metadata."""
@@ -32,80 +64,1391 @@ class TrainingExample:
     source_file: str
     chunk_index: int
 
+    def fingerprint(self) -> str:
+        """Identify the example by type and content rather than position."""
+        return content_fingerprint(f"{self.example_type}\0{self.content}")
+
+@dataclass
+class TrainingDataStats:
+    """Running summary statistics over training records, updated one record at a time."""
+    total: int = 0
+    code_generation_count: int = 0
+    code_questions: int = 0
+    question_types: Dict[str, int] = field(default_factory=dict)
+
+    def add(self, item: Dict[str, Any]):
+        """Account for one training record."""
+        user_content = item["messages"][0]["content"].lower()
+        self.total += 1
+
+        # Check for code-related questions
+        if any(word in user_content for word in ["code", "component", "import", "export", "function", "class"]):
+            self.code_questions += 1
+
+        # Check for code generation instructions
+        if any(word in user_content for word in ["create", "implement", "build", "write", "generate", "make"]):
+            if any(word in user_content for word in ["component", "function", "class", "code", "app", "template"]):
+                self.code_generation_count += 1
+                return
+
+        # Categorize other questions
+        if "how" in user_content:
+            q_type = "how"
+        elif "what" in user_content:
+            q_type = "what"
+        elif "why" in user_content:
+            q_type = "why"
+        elif "when" in user_content:
+            q_type = "when"
+        elif "error" in user_content or "debug" in user_content or "troubleshoot" in user_content:
+            q_type = "troubleshooting"
+        elif "integrate" in user_content or "setup" in user_content or "install" in user_content:
+            q_type = "integration"
+        else:
+            q_type = "other"
+        self.question_types[q_type] = self.question_types.get(q_type, 0) + 1
+
+    def log_summary(self):
+        """Print comprehensive summary statistics."""
+        logger.info("=== COMPREHENSIVE TRAINING DATA SUMMARY ===")
+        logger.info(f"Total training examples: {self.total}")
+        logger.info(f"Code generation examples: {self.code_generation_count}")
+        for q_type, count in self.question_types.items():
+            logger.info(f"Questions with '{q_type}': {count}")
+        logger.info(f"Code-related questions: {self.code_questions}")
+
+class NearDuplicateFilter:
+    """Drops training records that nearly duplicate one already kept.
+
+    Each record's question and answer are lowercased, punctuation is folded
+    to spaces, and the text is shingled into character 5-grams. Signatures are one-permutation MinHash
+    (one mixed hash per shingle, min per bin, empty bins densified by
+    rotation), computed with NumPy for a whole batch of records at once. An
+    LSH index over signature bands then finds candidates in sublinear time; a
+    candidate is a duplicate when the estimated Jaccard similarity reaches
+    threshold. Records are decided in input order and hashing is seeded, so
+    the same input always keeps the same records.
+    """
+
+    SHINGLE_CHARS = 5
+    _EMPTY = np.uint64(1 << 56)
+    # Byte translation table: ASCII letters lowercased, other ASCII punctuation to spaces
+    _FOLD = np.array([
+        c + 32 if 65 <= c <= 90 else (c if c >= 128 or chr(c).isalnum() else 32)
+        for c in range(256)
+    ], dtype=np.uint8)
+
+    def __init__(self, threshold: float = 0.8, num_perm: int = 64, batch_size: int = 4096):
+        if num_perm & (num_perm - 1):
+            raise ValueError("num_perm must be a power of two")
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.batch_size = batch_size
+        self.rows = self._choose_rows(num_perm, threshold)
+        self.bands = num_perm // self.rows
+        self.dropped: Dict[str, int] = {}
+        self.seen: Dict[str, int] = {}
+        self._buckets: Dict[int, List[Tuple[int, int]]] = {}
+        self._signatures: List[np.ndarray] = []
+        rng = np.random.default_rng(0x5EED)
+        self._band_weights = rng.integers(1, 2 ** 63, size=(self.bands, self.rows), dtype=np.uint64) | np.uint64(1)
+
+    @staticmethod
+    def _choose_rows(num_perm: int, threshold: float) -> int:
+        """Pick the most rows per band whose LSH threshold stays below threshold."""
+        rows = 1
+        for r in range(1, num_perm + 1):
+            if num_perm % r == 0 and (1 / (num_perm // r)) ** (1 / r) <= threshold:
+                rows = r
+        return rows
+
+    def signatures(self, records: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
+        """Return (signatures, has_text) for a batch of records.
+
+        signatures has one row of num_perm uint64 values per record; rows of
+        records without any text are meaningless and flagged False in has_text.
+        """
+        n, k, width = len(records), self.num_perm, self.SHINGLE_CHARS
+        texts = [" ".join(m["content"] for m in record["messages"]).encode("utf-8") for record in records]
+        lengths = np.fromiter((len(text) for text in texts), dtype=np.int64, count=n)
+        starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        raw = np.frombuffer(b"".join(texts) + b" " * width, dtype=np.uint8)
+        data = self._FOLD[raw].astype(np.uint64)
+
+        # Polynomial hash of every width-character window, then a 64-bit mix
+        windows = len(data) - width + 1
+        h = np.zeros(windows, dtype=np.uint64)
+        for j in range(width):
+            h = h * np.uint64(1099511628211) + data[j:j + windows]
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xFF51AFD7ED558CCD)
+        h ^= h >> np.uint64(33)
+
+        # Keep windows fully inside one text (texts shorter than width use one window)
+        doc = np.repeat(np.arange(n), lengths)
+        h = h[:len(doc)]
+        offset = np.arange(len(doc)) - starts[doc]
+        valid = offset <= np.maximum(lengths[doc] - width, 0)
+        valid &= lengths[doc] > 0
+        h, doc = h[valid], doc[valid]
+
+        bins = (h & np.uint64(k - 1)).astype(np.int64)
+        values = (h >> np.uint64(8)) & (self._EMPTY - np.uint64(1))
+        sig = np.full(n * k, self._EMPTY, dtype=np.uint64)
+        np.minimum.at(sig, doc * k + bins, values)
+        sig = sig.reshape(n, k)
+
+        # Densify empty bins from the next non-empty bin to the right (circularly)
+        filled = sig != self._EMPTY
+        has_text = filled.any(axis=1)
+        if not filled.all():
+            positions = np.where(np.concatenate([filled, filled], axis=1), np.arange(2 * k), 4 * k)
+            next_filled = np.minimum.accumulate(positions[:, ::-1], axis=1)[:, ::-1][:, :k]
+            next_filled = np.where(has_text[:, None], next_filled, np.arange(k))
+            distance = (next_filled - np.arange(k)).astype(np.uint64)
+            sig = np.take_along_axis(sig, next_filled % k, axis=1) + distance * self._EMPTY
+        return sig, has_text
+
+    def keep_batch(self, records: List[Dict[str, Any]], source_types: List[str]) -> List[bool]:
+        """Decide, in order, which records to keep; kept records are indexed."""
+        if not records:
+            return []
+        sig, has_text = self.signatures(records)
+        band_keys = (sig.reshape(len(records), self.bands, self.rows) * self._band_weights).sum(axis=2, dtype=np.uint64)
+        band_keys = (band_keys + np.arange(self.bands, dtype=np.uint64)).tolist()
+        batch = len(self._signatures)
+        self._signatures.append(sig)
+        min_matches = self.threshold * self.num_perm
+
+        decisions = []
+        for row, (source_type, text) in enumerate(zip(source_types, has_text.tolist())):
+            self.seen[source_type] = self.seen.get(source_type, 0) + 1
+            duplicate = False
+            if text:
+                checked = set()
+                for band_key in band_keys[row]:
+                    for candidate in self._buckets.get(band_key, ()):
+                        if candidate in checked:
+                            continue
+                        checked.add(candidate)
+                        other = self._signatures[candidate[0]][candidate[1]]
+                        if np.count_nonzero(other == sig[row]) >= min_matches:
+                            duplicate = True
+                            break
+                    if duplicate:
+                        break
+            if duplicate:
+                self.dropped[source_type] = self.dropped.get(source_type, 0) + 1
+            elif text:
+                for band_key in band_keys[row]:
+                    self._buckets.setdefault(band_key, []).append((batch, row))
+            decisions.append(not duplicate)
+        return decisions
+
+    def filter(self, items: Iterable[Tuple[str, Dict[str, Any]]]) -> Iterator[Tuple[str, Dict[str, Any], bool]]:
+        """Stream (source_type, record) items, yielding each with its keep decision."""
+        batch: List[Tuple[str, Dict[str, Any]]] = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= self.batch_size:
+                decisions = self.keep_batch([record for _, record in batch], [kind for kind, _ in batch])
+                yield from ((kind, record, keep) for (kind, record), keep in zip(batch, decisions))
+                batch = []
+        decisions = self.keep_batch([record for _, record in batch], [kind for kind, _ in batch])
+        yield from ((kind, record, keep) for (kind, record), keep in zip(batch, decisions))
+
+    def log_summary(self):
+        """Log how many records were dropped per source type."""
+        total_dropped = sum(self.dropped.values())
+        logger.info(f"Near-duplicate filter (threshold {self.threshold}, {self.bands} bands x {self.rows} rows): "
+                    f"dropped {total_dropped} of {sum(self.seen.values())} examples")
+        for source_type, seen in sorted(self.seen.items()):
+            logger.info(f"  {source_type}: dropped {self.dropped.get(source_type, 0)} of {seen}")
+
+# Common English words that say nothing about whether an answer is grounded
+QUALITY_STOPWORDS = (
+    "the and for with you your this that are can use used using from not but all any how what when where which "
+    "who why will would should could into its has have had was were been being their they them then than there "
+    "these those also more most such each other only just about over some may might must does did our out one"
+).split()
+
+QUALITY_FIELDS = ("grounding", "identifier_coverage", "answer_words")
+
+class QualityFilter:
+    """Scores generated pairs against their source and drops or flags weak ones.
+
+    Three scores are computed for each record's answer, with NumPy for a
+    whole batch of records at once:
+
+    - grounding: the share of its content words (three or more characters,
+      not in QUALITY_STOPWORDS, case-folded) that occur in the source text;
+    - identifier_coverage: the share of its code identifiers (words with an
+      underscore or camel case, e.g. useVoiceClient) that occur in the
+      source, or 1 when it has none;
+    - answer_words: its length in words.
+
+    sources maps a unit's (kind, key), as recorded in the manifest, to the
+    text it was generated from. Records of units without a source are not
+    scored and always kept. A record below any threshold is dropped, or with
+    flag_only kept; either way it is listed in flagged for review.
+    """
+
+    # bytes.translate tables: word bytes (letters, digits, underscores and
+    # non-ASCII) case-folded and everything else to 0; letter case as 1/2
+    _FOLD = bytes(c + 32 if 65 <= c <= 90 else (c if c >= 128 or chr(c).isalnum() or c == 95 else 0)
+                  for c in range(256))
+    _CASE = bytes(1 if 97 <= c <= 122 else (2 if 65 <= c <= 90 else 0) for c in range(256))
+    _PRIME = 1099511628211
+    _PRIME_INVERSE = pow(_PRIME, -1, 2 ** 64)
+
+    def __init__(self, sources: Dict[Tuple[str, str], str], min_grounding: float = 0.0,
+                 min_identifier_coverage: float = 0.0, min_answer_words: int = 0,
+                 flag_only: bool = False, batch_size: int = 4096):
+        self.sources = sources
+        self.min_grounding = min_grounding
+        self.min_identifier_coverage = min_identifier_coverage
+        self.min_answer_words = min_answer_words
+        self.flag_only = flag_only
+        self.batch_size = batch_size
+        self.flagged: List[Dict[str, Any]] = []
+        self.unscored = 0
+        self._scores: Dict[str, List[np.ndarray]] = {}
+        self._below: Dict[str, int] = {}
+        self._powers = np.ones(0, dtype=np.uint64)
+        self._inverse_powers = np.ones(0, dtype=np.uint64)
+        self._stopwords = np.sort(self._hash_words(QUALITY_STOPWORDS)[0])
+
+    def _ensure_powers(self, n: int):
+        """Grow the cached powers of _PRIME and its inverse to at least n entries."""
+        if len(self._powers) < n:
+            size = max(n, 2 * len(self._powers))
+            self._powers = np.cumprod(np.full(size, self._PRIME, dtype=np.uint64)) * np.uint64(self._PRIME_INVERSE)
+            self._inverse_powers = np.cumprod(np.full(size, self._PRIME_INVERSE, dtype=np.uint64)) * np.uint64(self._PRIME)
+
+    def _hash_words(self, texts: List[str]) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Split a batch of texts into words and hash them all at once.
+
+        Returns (hashes, doc, length, identifier), one entry per word: its
+        case-folded uint64 hash, the index of the text it came from, its
+        length in bytes and whether it looks like a code identifier (has an
+        underscore or a lowercase letter followed by a capital). Hashes do
+        not depend on where a word occurs.
+        """
+        encoded = [text.encode("utf-8") for text in texts]
+        lengths = np.fromiter((len(text) + 1 for text in encoded), dtype=np.int64, count=len(encoded))
+        text_starts = np.cumsum(lengths) - lengths + 1
+        # Every text is preceded by a space, so word boundaries alternate start, end
+        joined = b" " + b" ".join(encoded) + b" "
+        folded = np.frombuffer(joined.translate(self._FOLD), dtype=np.uint8)
+        n = len(folded)
+
+        boundaries = np.flatnonzero(np.diff((folded != 0).view(np.int8))) + 1
+        starts, ends = boundaries[0::2], boundaries[1::2]
+        first_words = np.searchsorted(starts, text_starts)
+        doc = np.repeat(np.arange(len(texts)), np.diff(np.append(first_words, len(starts))))
+
+        # Polynomial hash of each word from one prefix sum (non-word bytes add 0):
+        # sum(c[j] * q**j for j in word) * p**(end - 1) == sum(c[j] * p**(end - 1 - j))
+        self._ensure_powers(n)
+        prefix = np.empty(n + 1, dtype=np.uint64)
+        prefix[0] = 0
+        terms = folded.astype(np.uint64)
+        terms *= self._inverse_powers[:n]
+        np.cumsum(terms, out=prefix[1:])
+        h = (prefix[ends] - prefix[starts]) * self._powers[ends - 1]
+        h ^= h >> np.uint64(33)
+        h *= np.uint64(0xFF51AFD7ED558CCD)
+        h ^= h >> np.uint64(33)
+
+        # Identifier markers (an underscore, or a capital after a lowercase
+        # letter) always fall inside a word and are rare, so map them to words
+        case = np.frombuffer(joined.translate(self._CASE), dtype=np.uint8)
+        marker = folded == 95
+        marker[1:] |= (case[:-1] == 1) & (case[1:] == 2)
+        identifier = np.zeros(len(starts), dtype=bool)
+        identifier[np.searchsorted(starts, np.flatnonzero(marker), side="right") - 1] = True
+        return h, doc, ends - starts, identifier
+
+    @staticmethod
+    def _keyed(hashes: np.ndarray, source_ids: np.ndarray) -> np.ndarray:
+        """Combine word hashes with the index of their source text."""
+        return hashes ^ ((source_ids.astype(np.uint64) + np.uint64(1)) * np.uint64(0x9E3779B97F4A7C15))
+
+    @staticmethod
+    def _member(values: np.ndarray, sorted_set: np.ndarray) -> np.ndarray:
+        """Return which values occur in sorted_set; sorted lookups keep the binary search cache-friendly."""
+        if not len(sorted_set):
+            return np.zeros(len(values), dtype=bool)
+        order = np.argsort(values)
+        found = np.empty(len(values), dtype=bool)
+        found[order] = sorted_set[np.minimum(np.searchsorted(sorted_set, values[order]), len(sorted_set) - 1)] == values[order]
+        return found
+
+    def scores(self, answers: List[str], sources: List[str]) -> np.ndarray:
+        """Return the grounding, identifier_coverage and answer_words of each answer against its source.
+
+        The result is an array of shape (len(answers), 3) in QUALITY_FIELDS order.
+        """
+        n = len(answers)
+        unique_sources: Dict[str, int] = {}
+        source_ids = np.fromiter((unique_sources.setdefault(source, len(unique_sources)) for source in sources),
+                                 dtype=np.int64, count=n)
+        hashes, doc, length, identifier = self._hash_words(answers + list(unique_sources))
+        in_answer = doc < n
+        source_words = np.sort(self._keyed(hashes[~in_answer], doc[~in_answer] - n))
+
+        answer_doc = doc[in_answer]
+        answer_hashes = hashes[in_answer]
+        present = self._member(self._keyed(answer_hashes, source_ids[answer_doc]), source_words)
+        content = (length[in_answer] >= 3) & ~self._member(answer_hashes, self._stopwords)
+        content_words = np.bincount(answer_doc[content], minlength=n)
+        grounding = np.bincount(answer_doc[content], weights=present[content], minlength=n) / np.maximum(content_words, 1)
+
+        is_identifier = identifier[in_answer]
+        identifiers = np.bincount(answer_doc[is_identifier], minlength=n)
+        coverage = np.bincount(answer_doc[is_identifier], weights=present[is_identifier], minlength=n)
+        coverage = np.where(identifiers > 0, coverage / np.maximum(identifiers, 1), 1.0)
+        return np.stack([grounding, coverage, np.bincount(answer_doc, minlength=n)], axis=1)
+
+    def keep_batch(self, records: List[Dict[str, Any]], kinds: List[str], keys: List[str]) -> List[bool]:
+        """Score a batch of records and decide which to keep."""
+        decisions = [True] * len(records)
+        scored = [i for i, (kind, key) in enumerate(zip(kinds, keys)) if (kind, key) in self.sources]
+        self.unscored += len(records) - len(scored)
+        if not scored:
+            return decisions
+        scores = self.scores([records[i]["messages"][-1]["content"] for i in scored],
+                             [self.sources[(kinds[i], keys[i])] for i in scored])
+        below = ((scores[:, 0] < self.min_grounding) | (scores[:, 1] < self.min_identifier_coverage)
+                 | (scores[:, 2] < self.min_answer_words))
+        scored_kinds = np.array([kinds[i] for i in scored])
+        for kind in np.unique(scored_kinds).tolist():
+            self._scores.setdefault(kind, []).append(scores[scored_kinds == kind])
+        for row in np.flatnonzero(below).tolist():
+            i = scored[row]
+            self._below[kinds[i]] = self._below.get(kinds[i], 0) + 1
+            grounding, coverage, words = scores[row].tolist()
+            self.flagged.append({"kind": kinds[i], "key": keys[i], "grounding": grounding,
+                                 "identifier_coverage": coverage, "answer_words": int(words),
+                                 "messages": records[i]["messages"]})
+            decisions[i] = self.flag_only
+        return decisions
+
+    def write_review(self, review_file: Path):
+        """Write the records below a threshold, with their scores, as JSONL for review."""
+        if not self.flagged:
+            review_file.unlink(missing_ok=True)
+            return
+        with open(review_file, 'w', encoding='utf-8') as f:
+            for entry in self.flagged:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        logger.info(f"Listed {len(self.flagged)} low-quality examples in {review_file}")
+
+    def log_summary(self):
+        """Log the score distribution and how many records fell below a threshold, per source type."""
+        action = "flagged" if self.flag_only else "dropped"
+        logger.info(f"Quality filter (grounding >= {self.min_grounding}, identifier coverage >= "
+                    f"{self.min_identifier_coverage}, answer words >= {self.min_answer_words}): "
+                    f"{action} {sum(self._below.values())} of "
+                    f"{sum(len(batch) for batches in self._scores.values() for batch in batches)} "
+                    f"scored examples, {self.unscored} without a source")
+        for source_type, batches in sorted(self._scores.items()):
+            rows = np.concatenate(batches)
+            percentiles = np.percentile(rows, [10, 50, 90], axis=0)
+            distribution = ", ".join(f"{name} p10/p50/p90 " + "/".join(f"{value:.2f}" for value in percentiles[:, column])
+                                     for column, name in enumerate(QUALITY_FIELDS))
+            logger.info(f"  {source_type}: {action} {self._below.get(source_type, 0)} of {len(rows)}; {distribution}")
+
+def filter_batches(items: Iterable[Tuple[Any, str, str, Dict[str, Any]]],
+                   quality: Optional[QualityFilter] = None,
+                   dedup: Optional[NearDuplicateFilter] = None) -> Iterator[Tuple[Any, Dict[str, Any]]]:
+    """Pass (tag, kind, key, record) items through the quality and near-duplicate filters.
+
+    Items are collected into batches of the filters' batch_size and each
+    batch goes through quality first, then dedup; (tag, record) is yielded
+    for every record kept, in input order.
+    """
+    batch_size = (quality or dedup).batch_size if quality or dedup else 1
+    batch: List[Tuple[Any, str, str, Dict[str, Any]]] = []
+    for item in itertools.chain(items, [None]):
+        if item is not None:
+            batch.append(item)
+            if len(batch) < batch_size:
+                continue
+        if quality is not None and batch:
+            decisions = quality.keep_batch([record for _, _, _, record in batch], [kind for _, kind, _, _ in batch],
+                                           [key for _, _, key, _ in batch])
+            batch = [item for item, keep in zip(batch, decisions) if keep]
+        if dedup is not None and batch:
+            decisions = dedup.keep_batch([record for _, _, _, record in batch], [kind for _, kind, _, _ in batch])
+            batch = [item for item, keep in zip(batch, decisions) if keep]
+        for tag, _, _, record in batch:
+            yield tag, record
+        batch = []
+
 @dataclass
 class Checkpoint:
     """Represents a checkpoint for resuming progress."""
     timestamp: str
-    processed_chunks: List[int]
-    processed_code_examples: List[str]
-    training_data: List[Dict[str, Any]]
+    processed_chunks: List[str]  # documentation fingerprints
+    processed_code_examples: List[str]  # code example fingerprints
     total_doc_chunks: int
     total_code_examples: int
-    integration_generated: bool
-    code_generation_generated: bool
+    processed_integration: List[str]  # integration topic unit fingerprints
+    processed_code_generation: List[str]  # code generation topic unit fingerprints
+    output_offset: int = 0  # bytes of the partial output covered by recorded units
+    stats: TrainingDataStats = field(default_factory=TrainingDataStats)
+    manifest: List[Dict[str, Any]] = field(default_factory=list)  # kind, key, record count, plan position and partial offset per unit, in journal order
+    failed_units: List[Dict[str, str]] = field(default_factory=list)  # kind and key of units left for a later run
+    planned_units: int = 0  # units in the full plan, across all shards; set once planning has finished
+
+    def apply(self, kind: str, key: str, count: int, position: int = -1, start: int = 0):
+        """Mark a unit at plan position as processed with count records written from offset start."""
+        self.manifest.append({"kind": kind, "key": key, "count": count, "position": position, "start": start})
+        if kind == "documentation":
+            self.processed_chunks.append(key)
+        elif kind == "code_example":
+            self.processed_code_examples.append(key)
+        elif kind == "integration":
+            self.processed_integration.append(key)
+        elif kind == "code_generation":
+            self.processed_code_generation.append(key)
+        self.timestamp = datetime.now().isoformat()
+
+def empty_checkpoint() -> Checkpoint:
+    """Create a checkpoint with nothing processed."""
+    return Checkpoint(
+        timestamp=datetime.now().isoformat(),
+        processed_chunks=[],
+        processed_code_examples=[],
+        total_doc_chunks=0,
+        total_code_examples=0,
+        processed_integration=[],
+        processed_code_generation=[]
+    )
+
+# Output files ending in one of these suffixes are written compressed
+COMPRESSION_SUFFIXES = {".gz": "gzip", ".zst": "zstd"}
+# Records per independently compressed frame; smaller frames make random access cheaper
+RECORDS_PER_FRAME = 256
+# One index entry per record: offset of the frame holding it, and its offset and length inside that frame
+INDEX_DTYPE = np.dtype([("frame", "<u8"), ("offset", "<u8"), ("length", "<u4")])
+
+def compression_of(path: str) -> Optional[str]:
+    """Return "gzip", "zstd" or None depending on a file's suffix."""
+    return COMPRESSION_SUFFIXES.get(Path(path).suffix)
+
+def output_base(output_file: str) -> Path:
+    """Return an output path without its compression suffix, e.g. out.jsonl for out.jsonl.gz."""
+    path = Path(output_file)
+    return path.with_suffix("") if compression_of(output_file) else path
+
+def manifest_path_for(output_file: str) -> Path:
+    """Return the manifest sidecar path for an output file."""
+    return output_base(output_file).with_suffix(".manifest.json")
+
+def low_quality_path_for(output_file: str) -> Path:
+    """Return the sidecar path listing an output's low-quality examples for review."""
+    return output_base(output_file).with_suffix(".low_quality.jsonl")
+
+def index_path_for(output_file: str) -> Path:
+    """Return the offset index sidecar path for an output file."""
+    return output_base(output_file).with_suffix(".index.npy")
+
+def _zstandard():
+    try:
+        import zstandard
+    except ImportError as e:
+        raise ImportError("zstd compressed output needs the zstandard package (pip install zstandard)") from e
+    return zstandard
+
+def _compressor(compression: Optional[str]) -> Callable[[bytes], bytes]:
+    if compression == "gzip":
+        # A fixed mtime keeps the output byte-identical across runs
+        return lambda data: gzip.compress(data, mtime=0)
+    if compression == "zstd":
+        return _zstandard().ZstdCompressor(level=3).compress
+    return lambda data: data
+
+def _decompressor(compression: Optional[str]) -> Callable[[bytes], bytes]:
+    if compression == "gzip":
+        return gzip.decompress
+    if compression == "zstd":
+        return _zstandard().ZstdDecompressor().decompress
+    return lambda data: data
+
+def open_jsonl(path: str) -> BinaryIO:
+    """Open a plain, gzip or zstd JSONL file for reading lines as bytes."""
+    compression = compression_of(path)
+    if compression == "gzip":
+        return gzip.open(path, "rb")
+    if compression == "zstd":
+        reader = _zstandard().ZstdDecompressor().stream_reader(open(path, "rb"), read_across_frames=True)
+        return io.BufferedReader(reader)
+    return open(path, "rb")
+
+def _save_index(index_file: Path, frames: array, offsets: array, lengths: array):
+    index = np.empty(len(offsets), dtype=INDEX_DTYPE)
+    index["frame"] = np.frombuffer(frames, dtype=np.uint64) if frames else 0
+    index["offset"] = np.frombuffer(offsets, dtype=np.uint64) if offsets else 0
+    index["length"] = np.frombuffer(lengths, dtype=np.uint32) if lengths else 0
+    with open(index_file, "wb") as f:
+        np.save(f, index)
+
+class JsonlWriter:
+    """Streams JSONL records to a plain, gzip or zstd file and builds its offset index.
+
+    Compressed output is written as independent frames (gzip members or zstd
+    frames) of up to frame_records records. Concatenated they are an ordinary
+    .gz or .zst file, and each frame can be decompressed on its own, which is
+    what lets the index address single records. The output and its index are
+    written to temporary files and published by close(), output first.
+    """
+
+    def __init__(self, output_file: str, frame_records: int = RECORDS_PER_FRAME):
+        self.output_file = output_file
+        self.index_file = index_path_for(output_file)
+        self.frame_records = frame_records
+        self.compression = compression_of(output_file)
+        self._compress = _compressor(self.compression)
+        self._tmp_file = f"{output_file}.tmp"
+        self._handle = open(self._tmp_file, "wb")
+        self._frame: List[bytes] = []
+        self._frame_size = 0
+        self._frames, self._offsets, self._lengths = array("Q"), array("Q"), array("I")
+
+    def __enter__(self) -> "JsonlWriter":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    def write(self, record: Dict[str, Any]):
+        """Append one record."""
+        self.write_line((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+
+    def write_line(self, line: bytes):
+        """Append one already serialized, newline-terminated record."""
+        if self.compression is None:
+            self._frames.append(0)
+            self._offsets.append(self._handle.tell())
+            self._lengths.append(len(line))
+            self._handle.write(line)
+            return
+        self._offsets.append(self._frame_size)
+        self._lengths.append(len(line))
+        self._frame.append(line)
+        self._frame_size += len(line)
+        if len(self._frame) >= self.frame_records:
+            self._flush_frame()
+
+    def _flush_frame(self):
+        if self._frame:
+            self._frames.extend([self._handle.tell()] * len(self._frame))
+            self._handle.write(self._compress(b"".join(self._frame)))
+            self._frame, self._frame_size = [], 0
+
+    def close(self):
+        """Write the last frame and publish the output and its index."""
+        self._flush_frame()
+        self._handle.close()
+        _save_index(Path(f"{self.index_file}.tmp"), self._frames, self._offsets, self._lengths)
+        os.replace(self._tmp_file, self.output_file)
+        os.replace(f"{self.index_file}.tmp", self.index_file)
+
+    def abort(self):
+        """Discard everything written so far."""
+        self._handle.close()
+        Path(self._tmp_file).unlink(missing_ok=True)
+
+def build_index(output_file: str):
+    """Write the offset index of an existing output file.
+
+    Used for outputs that were not written by JsonlWriter. A compressed file
+    is indexed as a single frame, so reading one of its records decompresses
+    the whole file once.
+    """
+    offsets, lengths = array("Q"), array("I")
+    position = 0
+    with open_jsonl(output_file) as f:
+        for line in f:
+            offsets.append(position)
+            lengths.append(len(line))
+            position += len(line)
+    index_file = index_path_for(output_file)
+    _save_index(Path(f"{index_file}.tmp"), array("Q", bytes(8 * len(offsets))), offsets, lengths)
+    os.replace(f"{index_file}.tmp", index_file)
+    logger.info(f"Indexed {len(offsets)} records of {output_file}")
+
+class IndexedJsonl:
+    """Random access to the records of an output file through its offset index.
+
+    The output and the index are memory-mapped, so looking up or sampling a
+    record reads only that record (or its compressed frame) instead of
+    parsing the file up to it. A missing index, or one older than the output,
+    is rebuilt first.
+    """
+
+    def __init__(self, output_file: str):
+        self.output_file = output_file
+        index_file = index_path_for(output_file)
+        if not index_file.exists() or index_file.stat().st_mtime_ns < Path(output_file).stat().st_mtime_ns:
+            build_index(output_file)
+        self.index = np.load(index_file, mmap_mode="r")
+        self.compression = compression_of(output_file)
+        self._decompress = _decompressor(self.compression)
+        self._file = open(output_file, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._data = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._frame_starts = np.unique(self.index["frame"]) if self.compression else None
+        self._cached_frame: Tuple[int, bytes] = (-1, b"")
+
+    def __enter__(self) -> "IndexedJsonl":
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def _frame(self, start: int) -> bytes:
+        if self._cached_frame[0] != start:
+            position = int(np.searchsorted(self._frame_starts, start, side="right"))
+            end = int(self._frame_starts[position]) if position < len(self._frame_starts) else len(self._data)
+            self._cached_frame = (start, self._decompress(self._data[start:end]))
+        return self._cached_frame[1]
+
+    def line(self, position: int) -> bytes:
+        """Return the serialized record at a position, including its newline."""
+        frame, offset, length = (int(value) for value in self.index[position])
+        data = self._data if self.compression is None else self._frame(frame)
+        return data[offset:offset + length]
+
+    def __getitem__(self, position: int) -> Dict[str, Any]:
+        return json.loads(self.line(position))
+
+    def sample(self, count: int, seed: int = 0) -> List[Dict[str, Any]]:
+        """Return count records chosen uniformly at random, in file order."""
+        positions = sorted(random.Random(seed).sample(range(len(self)), min(count, len(self))))
+        return [self[position] for position in positions]
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+        self._file.close()
+
+def write_manifest(output_file: str, manifest: List[Dict[str, Any]], planned_units: Optional[int] = None):
+    """Write the per-unit manifest next to an output file.
+
+    planned_units, the size of the full plan, lets merge_shard_outputs tell
+    whether the shards together cover every unit.
+    """
+    data = {"output_file": Path(output_file).name, "units": manifest}
+    if planned_units is not None:
+        data["planned_units"] = planned_units
+    with open(manifest_path_for(output_file), "w", encoding="utf-8") as f:
+        json.dump(data, f)
 
 class CheckpointManager:
-    """Manages saving and loading checkpoints."""
-    
-    def __init__(self, checkpoint_file: str = "fine_tune_checkpoint.json"):
+    """Manages the streamed output and its append-only checkpoint journal.
+
+    Training records are streamed to `<output_file>.partial` as each unit
+    completes, in completion order, and one small JSONL journal entry per unit
+    records its kind, key, record count, plan position, the output offsets
+    before and after it and the running statistics, so checkpoint cost is
+    constant per unit and nothing accumulates in memory. finalize_output puts
+    the units back in plan order.
+    Output and journal are flushed on every unit and fsynced (output first)
+    every fsync_every units.
+
+    Loading replays the journal and truncates the partial output back to the
+    last recorded offset, discarding records of a unit that was written but
+    never journaled. A torn final journal line from a crash mid-write is
+    ignored and the journal is compacted (rewritten atomically with only the
+    last entry per unit) before new entries are appended after it.
+    """
+
+    def __init__(self, checkpoint_file: str = "fine_tune_checkpoint.jsonl",
+                 output_file: str = "comprehensive_training.jsonl", fsync_every: int = 16):
         self.checkpoint_file = checkpoint_file
-    
-    def save_checkpoint(self, checkpoint: Checkpoint):
-        """Save checkpoint to file."""
+        self.output_file = output_file
+        self.partial_file = f"{output_file}.partial"
+        self.fsync_every = fsync_every
+        self._handle = None
+        self._output = None
+        self._unsynced = 0
+
+    def _open(self):
+        if self._handle is None:
+            self._handle = open(self.checkpoint_file, 'a', encoding='utf-8')
+        return self._handle
+
+    def _open_output(self, offset: int):
+        """Open the partial output for appending, truncated to offset."""
+        self._close_output()
+        self._output = open(self.partial_file, 'ab')
+        self._output.truncate(offset)
+
+    def _close_output(self):
+        if self._output is not None:
+            self._output.close()
+            self._output = None
+
+    def record_unit(self, checkpoint: Checkpoint, kind: str, key: str, position: int, records: Iterable[Dict[str, Any]]):
+        """Stream a completed unit's records to the output and journal the unit at its plan position."""
         try:
-            with open(self.checkpoint_file, 'w', encoding='utf-8') as f:
-                json.dump(asdict(checkpoint), f, indent=2)
-            logger.info(f"Checkpoint saved: {len(checkpoint.training_data)} examples, {len(checkpoint.processed_chunks)} doc chunks, {len(checkpoint.processed_code_examples)} code examples")
+            if self._output is None:
+                self._open_output(checkpoint.output_offset)
+            start = checkpoint.output_offset
+            count = 0
+            for record in records:
+                self._output.write((json.dumps(record, ensure_ascii=False) + '\n').encode('utf-8'))
+                checkpoint.stats.add(record)
+                count += 1
+            self._output.flush()
+            checkpoint.output_offset = self._output.tell()
+            checkpoint.apply(kind, key, count, position, start)
+
+            entry = {
+                "kind": kind,
+                "key": key,
+                "count": count,
+                "position": position,
+                "start": start,
+                "offset": checkpoint.output_offset,
+                "stats": asdict(checkpoint.stats),
+                "timestamp": checkpoint.timestamp
+            }
+            f = self._open()
+            f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            self._unsynced += 1
+            if self._unsynced >= self.fsync_every:
+                self.sync()
+            logger.debug(f"Checkpoint journal: recorded {kind} unit {key!r} with {count} examples")
         except Exception as e:
-            logger.error(f"Failed to save checkpoint: {e}")
-    
+            logger.error(f"Failed to record unit in checkpoint: {e}")
+            raise
+
+    def sync(self):
+        """Force output and journal entries written so far to disk, output first."""
+        if self._unsynced:
+            if self._output is not None:
+                os.fsync(self._output.fileno())
+            if self._handle is not None:
+                os.fsync(self._handle.fileno())
+            self._unsynced = 0
+
+    def close(self):
+        """Sync and close the journal and partial output."""
+        self.sync()
+        self._close_output()
+        if self._handle is not None:
+            self._handle.close()
+            self._handle = None
+
+    def _read_entries(self) -> Tuple[List[Dict[str, Any]], int]:
+        """Read journal entries, keeping the last entry per unit.
+
+        Returns the live entries in journal order and the number of lines that
+        were superseded, unreadable or not newline-terminated.
+        """
+        latest: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        dead = 0
+        previous_offset = 0
+        with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
+            for line_number, line in enumerate(f, 1):
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    logger.warning(f"Checkpoint journal line {line_number} is unreadable, ignoring")
+                    dead += 1
+                    continue
+                if not line.endswith('\n'):
+                    dead += 1
+                # Journals written before units carried plan positions were already in plan order
+                entry.setdefault("position", -1)
+                entry.setdefault("start", previous_offset)
+                previous_offset = entry["offset"]
+                unit_id = (entry["kind"], json.dumps(entry["key"]))
+                if unit_id in latest:
+                    del latest[unit_id]
+                    dead += 1
+                latest[unit_id] = entry
+        return list(latest.values()), dead
+
+    def _compact(self, entries: List[Dict[str, Any]], dead: int):
+        """Atomically replace the journal with the given live entries, dropping dead lines."""
+        tmp_file = f"{self.checkpoint_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for entry in entries:
+                f.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.checkpoint_file)
+        logger.info(f"Checkpoint journal compacted: {len(entries)} entries kept, {dead} dropped")
+
     def load_checkpoint(self) -> Checkpoint:
-        """Load checkpoint from file."""
+        """Rebuild the checkpoint by replaying the journal.
+
+        Entries whose offset lies beyond the end of the partial output (it was
+        truncated or lost its tail) are dropped, keeping the progress before
+        them. An unreadable journal is discarded along with the partial output.
+        """
+        self.close()
+        checkpoint = empty_checkpoint()
+        partial_size = Path(self.partial_file).stat().st_size if Path(self.partial_file).exists() else 0
         try:
             if Path(self.checkpoint_file).exists():
-                with open(self.checkpoint_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                checkpoint = Checkpoint(**data)
-                logger.info(f"Checkpoint loaded: {len(checkpoint.training_data)} examples, {len(checkpoint.processed_chunks)} doc chunks, {len(checkpoint.processed_code_examples)} code examples")
-                return checkpoint
+                entries, dead = self._read_entries()
+                covered = len(entries)
+                while covered and entries[covered - 1]["offset"] > partial_size:
+                    covered -= 1
+                if covered < len(entries):
+                    logger.error(f"Partial output {self.partial_file} is shorter than the checkpoint, "
+                                 f"keeping the first {covered} of {len(entries)} journaled units")
+                    entries, dead = entries[:covered], dead + len(entries) - covered
+                if dead:
+                    self._compact(entries, dead)
+                for entry in entries:
+                    checkpoint.apply(entry["kind"], entry["key"], entry["count"], entry["position"], entry["start"])
+                if entries:
+                    checkpoint.output_offset = entries[-1]["offset"]
+                    checkpoint.stats = TrainingDataStats(**entries[-1]["stats"])
+                logger.info(f"Checkpoint loaded: {checkpoint.stats.total} examples, {len(checkpoint.processed_chunks)} doc chunks, {len(checkpoint.processed_code_examples)} code examples")
         except Exception as e:
-            logger.error(f"Failed to load checkpoint: {e}")
-        
-        # Return empty checkpoint if no file or error
-        return Checkpoint(
-            timestamp=datetime.now().isoformat(),
-            processed_chunks=[],
-            processed_code_examples=[],
-            training_data=[],
-            total_doc_chunks=0,
-            total_code_examples=0,
-            integration_generated=False,
-            code_generation_generated=False
-        )
-    
+            logger.error(f"Failed to load checkpoint, starting over: {e}")
+            checkpoint = empty_checkpoint()
+            Path(self.checkpoint_file).unlink(missing_ok=True)
+        self._open_output(checkpoint.output_offset)
+
+        return checkpoint
+
+    def finalize_output(self, checkpoint: Checkpoint, dedup: Optional[NearDuplicateFilter] = None,
+                        quality: Optional[QualityFilter] = None):
+        """Publish the partial output in plan order with its manifest, then log statistics.
+
+        Units are read back from the partial output sorted by plan position,
+        seeking to each unit's start offset, so the output does not depend on
+        the order units completed in. They are streamed into a JsonlWriter,
+        which compresses the output if its file name asks for it and writes
+        the offset index. With a QualityFilter and/or a NearDuplicateFilter
+        the records pass through them in that order, in batches, quality
+        first; manifest counts and statistics are recomputed for the records
+        that are kept.
+        """
+        self.close()
+        order = sorted(checkpoint.manifest, key=lambda entry: entry["position"])
+        manifest = [{"kind": entry["kind"], "key": entry["key"], "count": entry["count"], "position": entry["position"]}
+                    for entry in order]
+        with JsonlWriter(self.output_file) as writer, open(self.partial_file, 'rb') as src:
+
+            def lines() -> Iterator[Tuple[int, bytes]]:
+                for position, entry in enumerate(order):
+                    if entry["count"] and src.tell() != entry["start"]:
+                        src.seek(entry["start"])
+                    for _ in range(entry["count"]):
+                        yield position, src.readline()
+
+            if dedup is None and quality is None:
+                for _, line in lines():
+                    writer.write_line(line)
+            else:
+                stats = TrainingDataStats()
+                kept = [0] * len(manifest)
+                items = ((position, manifest[position]["kind"], manifest[position]["key"], json.loads(line))
+                         for position, line in lines())
+                for position, record in filter_batches(items, quality, dedup):
+                    writer.write(record)
+                    stats.add(record)
+                    kept[position] += 1
+                manifest = [{**entry, "count": count} for entry, count in zip(manifest, kept)]
+                checkpoint.stats = stats
+                if quality is not None:
+                    quality.log_summary()
+                    quality.write_review(low_quality_path_for(self.output_file))
+                if dedup is not None:
+                    dedup.log_summary()
+        checkpoint.manifest = manifest
+        Path(self.partial_file).unlink()
+        write_manifest(self.output_file, checkpoint.manifest, checkpoint.planned_units or None)
+        logger.info(f"Successfully saved {checkpoint.stats.total} training examples to {self.output_file}")
+        checkpoint.stats.log_summary()
+
     def clear_checkpoint(self):
-        """Clear the checkpoint file."""
+        """Clear the checkpoint journal and any leftover partial output."""
         try:
-            if Path(self.checkpoint_file).exists():
-                Path(self.checkpoint_file).unlink()
-                logger.info("Checkpoint cleared")
+            self.close()
+            for path in (Path(self.checkpoint_file), Path(self.partial_file)):
+                if path.exists():
+                    path.unlink()
+            logger.info("Checkpoint cleared")
         except Exception as e:
             logger.error(f"Failed to clear checkpoint: {e}")
 
-def load_and_split_documents(file_path: str, chunk_size: int = 2000, chunk_overlap: int = 200) -> List[TrainingExample]:
-    """Load and split documentation into chunks."""
+class ResponseCache:
+    """Persistent content-addressed cache of raw LLM responses.
+
+    Entries live as one file per key under cache_dir, keyed by a hash of the
+    model name and the fully rendered prompt (template plus chunk content), so
+    an unchanged chunk maps to the same entry across runs. When the total size
+    exceeds max_bytes the least recently used entries are evicted; file mtimes
+    record recency so it survives restarts.
+    """
+
+    def __init__(self, cache_dir: str = ".llm_cache", max_bytes: int = 512 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, int]" = OrderedDict()
+        self._total_bytes = 0
+
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        existing = []
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith(".json"):
+                stat = entry.stat()
+                existing.append((stat.st_mtime, entry.name[:-len(".json")], stat.st_size))
+        for _, key, size in sorted(existing):
+            self._entries[key] = size
+            self._total_bytes += size
+
+    @staticmethod
+    def make_key(model: str, prompt: str) -> str:
+        """Hash a model name and rendered prompt into a cache key."""
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def get(self, key: str) -> Optional[str]:
+        """Return the cached response for key, or None on a miss."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+        try:
+            path = self._path(key)
+            with open(path, 'r', encoding='utf-8') as f:
+                response = json.load(f)["response"]
+            os.utime(path)
+        except Exception as e:
+            logger.warning(f"Dropping unreadable cache entry {key}: {e}")
+            with self._lock:
+                self._total_bytes -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return response
+
+    def put(self, key: str, response: str):
+        """Store a response and evict least recently used entries over the size limit."""
+        path = self._path(key)
+        tmp_path = path.with_suffix(f".{threading.get_ident()}.tmp")
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"response": response}, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            size = path.stat().st_size
+        except Exception as e:
+            logger.warning(f"Failed to write cache entry {key}: {e}")
+            return
+
+        with self._lock:
+            self._total_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            evicted = []
+            while self._total_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._total_bytes -= old_size
+                evicted.append(old_key)
+        for old_key in evicted:
+            self._path(old_key).unlink(missing_ok=True)
+        if evicted:
+            logger.debug(f"Evicted {len(evicted)} cache entries")
+
+    def discard(self, key: str):
+        """Remove an entry, e.g. a response that later failed validation."""
+        with self._lock:
+            self._total_bytes -= self._entries.pop(key, 0)
+        self._path(key).unlink(missing_ok=True)
+
+    def log_stats(self):
+        """Log hit and miss counts for this run."""
+        total = self.hits + self.misses
+        hit_rate = 100 * self.hits / total if total else 0.0
+        logger.info(f"LLM cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate), "
+                    f"{len(self._entries)} entries, {self._total_bytes / (1024 * 1024):.1f} MB")
+
+def model_name(llm: ChatOpenAI) -> str:
+    """Return the model identifier used in cache keys."""
+    return getattr(llm, "model_name", None) or type(llm).__name__
+
+# USD per million (prompt, completion) tokens
+MODEL_PRICES = {
+    "gpt-4": (30.0, 60.0),
+    "gpt-4-turbo": (10.0, 30.0),
+    "gpt-4o": (2.5, 10.0),
+    "gpt-4o-mini": (0.15, 0.6),
+    "gpt-3.5-turbo": (0.5, 1.5),
+}
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Return the estimated USD cost of a call, or 0.0 for models without a known price."""
+    prompt_price, completion_price = MODEL_PRICES.get(model, (0.0, 0.0))
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+
+def metrics_path_for(output_file: str) -> Path:
+    """Return the per-call metrics sidecar path for an output file."""
+    return output_base(output_file).with_suffix(".metrics.jsonl")
+
+@dataclass
+class CallRecord:
+    """Telemetry for one LLM call (or one cache hit) made by a generate_* function."""
+    kind: str
+    label: str
+    model: str
+    attempt: int = 0
+    cached: bool = False
+    queue_wait: float = 0.0
+    latency: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    cost: float = 0.0
+    outcome: str = "ok"  # 'ok', 'salvaged', 'empty', 'invalid_json', 'invalid_code', 'error'
+    valid_pairs: int = 0
+    error: Optional[str] = None
+
+class CallMetrics:
+    """Collects CallRecords, streams them to a JSONL file and summarizes them per example type.
+
+    Latency percentiles are computed over calls that reached the API, so cache
+    hits do not skew them; yield is valid pairs per 1k prompt plus completion
+    tokens.
+    """
+
+    def __init__(self, metrics_file: Optional[str] = None):
+        self.metrics_file = metrics_file
+        self._handle = None
+        self._records: Dict[str, List[CallRecord]] = {}
+
+    def record(self, call: CallRecord):
+        """Add a call record and append it to the metrics file."""
+        self._records.setdefault(call.kind, []).append(call)
+        if self.metrics_file and self._handle is None:
+            self._handle = open(self.metrics_file, 'a', encoding='utf-8')
+        if self._handle:
+            self._handle.write(json.dumps({"timestamp": time.time(), **asdict(call)}) + '\n')
+
+    @classmethod
+    def load(cls, metrics_file: str) -> "CallMetrics":
+        """Read back the call records of a metrics file without appending to it."""
+        metrics = cls()
+        with open(metrics_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                entry.pop("timestamp", None)
+                metrics.record(CallRecord(**entry))
+        return metrics
+
+    def records(self) -> Iterator[CallRecord]:
+        """Iterate over the collected call records."""
+        for calls in self._records.values():
+            yield from calls
+
+    def summary(self) -> Dict[str, Dict[str, Any]]:
+        """Return aggregate statistics per example type."""
+        summary = {}
+        for kind, calls in sorted(self._records.items()):
+            api_calls = [call for call in calls if not call.cached]
+            latencies = [call.latency for call in api_calls] or [0.0]
+            tokens = sum(call.prompt_tokens + call.completion_tokens for call in api_calls)
+            pairs = sum(call.valid_pairs for call in calls)
+            p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+            summary[kind] = {
+                "calls": len(api_calls),
+                "cache_hits": len(calls) - len(api_calls),
+                "errors": sum(call.outcome == "error" for call in calls),
+                "invalid_json": sum(call.outcome == "invalid_json" for call in calls),
+                "invalid_code": sum(call.outcome == "invalid_code" for call in calls),
+                "latency_p50": float(p50),
+                "latency_p95": float(p95),
+                "latency_p99": float(p99),
+                "queue_wait_mean": sum(call.queue_wait for call in api_calls) / len(api_calls) if api_calls else 0.0,
+                "prompt_tokens": sum(call.prompt_tokens for call in api_calls),
+                "completion_tokens": sum(call.completion_tokens for call in api_calls),
+                "cost": sum(call.cost for call in api_calls),
+                "valid_pairs": pairs,
+                "pairs_per_1k_tokens": 1000 * pairs / tokens if tokens else 0.0,
+            }
+        return summary
+
+    def log_summary(self):
+        """Log per example type latency percentiles, token usage, cost and yield."""
+        summary = self.summary()
+        if not summary:
+            return
+        logger.info("LLM call metrics:")
+        for kind, stats in summary.items():
+            logger.info(f"  {kind}: {stats['calls']} calls ({stats['cache_hits']} cached, {stats['errors']} errors, "
+                        f"{stats['invalid_json']} invalid JSON, {stats['invalid_code']} invalid code), latency p50/p95/p99 "
+                        f"{stats['latency_p50']:.2f}/{stats['latency_p95']:.2f}/{stats['latency_p99']:.2f}s, "
+                        f"queue wait {stats['queue_wait_mean']:.2f}s, "
+                        f"{stats['prompt_tokens'] + stats['completion_tokens']} tokens, ${stats['cost']:.2f}, "
+                        f"{stats['pairs_per_1k_tokens']:.2f} pairs per 1k tokens")
+        logger.info(f"  Total estimated cost: ${sum(stats['cost'] for stats in summary.values()):.2f}")
+        if self._handle:
+            logger.info(f"  Per-call metrics written to {self.metrics_file}")
+
+    def close(self):
+        """Close the metrics file."""
+        if self._handle:
+            self._handle.close()
+            self._handle = None
+
+def estimate_tokens(text: str) -> int:
+    """Roughly estimate the token count of text (about 4 characters per token)."""
+    return len(text) // 4 + 1
+
+def get_token_counter(tokenizer: str = "approx") -> Callable[[str], int]:
+    """Return a token counting function by name.
+
+    "approx" estimates about 4 characters per token. "tiktoken" or
+    "tiktoken:<encoding>" counts with tiktoken (cl100k_base by default) and
+    falls back to the estimate if tiktoken is not installed.
+    """
+    if tokenizer == "approx":
+        return estimate_tokens
+    if tokenizer.startswith("tiktoken"):
+        encoding_name = tokenizer.partition(":")[2] or "cl100k_base"
+        try:
+            import tiktoken
+        except ImportError:
+            logger.warning("tiktoken is not installed, falling back to approximate token counts")
+            return estimate_tokens
+        encoding = tiktoken.get_encoding(encoding_name)
+        return lambda text: len(encoding.encode(text, disallowed_special=()))
+    raise ValueError(f"Unknown tokenizer: {tokenizer}")
+
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    """Return True if an API error is a 429 rate limit response."""
+    return getattr(error, "status_code", None) == 429 or "RateLimit" in type(error).__name__
+
+def is_retryable_error(error: BaseException) -> bool:
+    """Return True for rate limits, timeouts, connection errors and 5xx responses."""
+    if isinstance(error, (TimeoutError, ConnectionError, asyncio.TimeoutError)):
+        return True
+    if getattr(error, "status_code", None) in RETRYABLE_STATUS_CODES:
+        return True
+    name = type(error).__name__
+    return any(marker in name for marker in ("RateLimit", "Timeout", "Connection", "InternalServer", "ServiceUnavailable"))
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """Return the Retry-After delay suggested by an API error, if any."""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
+
+class GenerationError(Exception):
+    """Raised when a unit could not be generated; the unit is not checkpointed."""
+
+class RequestScheduler:
+    """Shared admission control and retry policy for LLM requests.
+
+    Requests-per-minute and tokens-per-minute budgets are enforced with
+    continuously refilling buckets. The concurrency limit adapts AIMD-style:
+    it is halved on a 429 and on responses slower than target_latency, and
+    raised by one after a full window of fast successes, up to max_concurrency.
+    Every admitted request gets a ticket, and only requests admitted after the
+    last decrease can trigger the next one, so a burst of failures from the
+    same in-flight window halves the limit once.
+    Retryable failures are retried with full-jitter exponential backoff,
+    honouring Retry-After when the API provides it.
+    """
+
+    def __init__(self, max_concurrency: int = 8, requests_per_minute: int = 500,
+                 tokens_per_minute: int = 150_000, target_latency: float = 60.0,
+                 max_retries: int = 5, base_delay: float = 1.0, max_delay: float = 60.0,
+                 completion_tokens: int = 1000):
+        self.max_concurrency = max_concurrency
+        self.limit = max_concurrency
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.completion_tokens = completion_tokens
+        self.rate_limited = 0
+        self.retries = 0
+        self._request_budget = float(requests_per_minute)
+        self._token_budget = float(tokens_per_minute)
+        self._refilled_at = time.monotonic()
+        self._in_flight = 0
+        self._successes = 0
+        self._admitted = 0
+        self._decrease_barrier = 0  # tickets below this were in flight at the last decrease
+        self._condition: Optional[asyncio.Condition] = None
+
+    def _reserve(self, tokens: int) -> float:
+        """Take budget for one request, or return how long to wait for it."""
+        now = time.monotonic()
+        elapsed = now - self._refilled_at
+        self._refilled_at = now
+        self._request_budget = min(self.requests_per_minute, self._request_budget + elapsed * self.requests_per_minute / 60)
+        self._token_budget = min(self.tokens_per_minute, self._token_budget + elapsed * self.tokens_per_minute / 60)
+
+        tokens = min(tokens + self.completion_tokens, self.tokens_per_minute)
+        if self._request_budget >= 1 and self._token_budget >= tokens:
+            self._request_budget -= 1
+            self._token_budget -= tokens
+            return 0.0
+        request_wait = max(0.0, 1 - self._request_budget) * 60 / self.requests_per_minute
+        token_wait = max(0.0, tokens - self._token_budget) * 60 / self.tokens_per_minute
+        return max(request_wait, token_wait)
+
+    def _ticket(self) -> int:
+        self._admitted += 1
+        return self._admitted
+
+    def wait(self, prompt: str) -> int:
+        """Block until the rate budgets admit a request for prompt; return its ticket."""
+        while (delay := self._reserve(estimate_tokens(prompt))) > 0:
+            time.sleep(delay)
+        return self._ticket()
+
+    async def acquire(self, prompt: str) -> int:
+        """Wait for a concurrency slot and rate budget for prompt; return its ticket."""
+        if self._condition is None:
+            self._condition = asyncio.Condition()
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.limit)
+            self._in_flight += 1
+        try:
+            while (delay := self._reserve(estimate_tokens(prompt))) > 0:
+                await asyncio.sleep(delay)
+        except BaseException:
+            # Cancelled while waiting for rate budget: the caller never gets the slot to release
+            await self.release()
+            raise
+        return self._ticket()
+
+    async def release(self):
+        """Free a concurrency slot taken by acquire."""
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def _decrease(self, ticket: Optional[int]) -> bool:
+        """Halve the limit unless ticket was already in flight at the last decrease."""
+        self._successes = 0
+        if ticket is not None and ticket <= self._decrease_barrier:
+            return False
+        self.limit = max(1, self.limit // 2)
+        self._decrease_barrier = self._admitted
+        return True
+
+    def observe(self, latency: float, error: Optional[BaseException] = None, ticket: Optional[int] = None):
+        """Adapt the concurrency limit to a finished request admitted with ticket."""
+        if error is not None and is_rate_limit_error(error):
+            self.rate_limited += 1
+            if self._decrease(ticket):
+                logger.warning(f"Rate limited, reducing concurrency to {self.limit}")
+        elif error is None and latency > self.target_latency:
+            if self._decrease(ticket):
+                logger.warning(f"Slow response ({latency:.1f}s), reducing concurrency to {self.limit}")
+        elif error is None:
+            self._successes += 1
+            if self._successes >= self.limit and self.limit < self.max_concurrency:
+                self._successes = 0
+                self.limit += 1
+                logger.debug(f"Increasing concurrency to {self.limit}")
+
+    def backoff(self, attempt: int, error: BaseException) -> float:
+        """Return the delay before retry number attempt (0-based)."""
+        self.retries += 1
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        suggested = retry_after_seconds(error)
+        return max(delay, suggested) if suggested is not None else delay
+
+    def log_stats(self):
+        """Log rate limiting and retry counts for this run."""
+        logger.info(f"Request scheduler: {self.rate_limited} rate limited responses, {self.retries} retries, "
+                    f"final concurrency {self.limit}")
+
+@dataclass
+class GenerationContext:
+    """Services shared by every LLM call of a run."""
+    cache: Optional[ResponseCache] = None
+    scheduler: RequestScheduler = field(default_factory=RequestScheduler)
+    token_counter: Callable[[str], int] = estimate_tokens
+    metrics: Optional[CallMetrics] = None
+    structured_output: bool = False
+    router: Optional[ModelRouter] = None
+    validator: Optional[CodeValidator] = None
+    shutdown: Optional[GracefulShutdown] = None
+
+    def stopping(self) -> bool:
+        """Return whether a shutdown signal asked the run to stop starting units."""
+        return self.shutdown is not None and self.shutdown.requested
+
+    def record_call(self, call: CallRecord):
+        """Forward a call record to the metrics collector, if any."""
+        if self.metrics is not None:
+            self.metrics.record(call)
+
+    def count_usage(self, call: CallRecord, response: Any, prompt: str):
+        """Fill in a call's token usage and cost from the API response.
+
+        Falls back to token_counter estimates when the response carries no usage.
+        """
+        usage = getattr(response, "usage_metadata", None) or {}
+        token_usage = (getattr(response, "response_metadata", None) or {}).get("token_usage") or {}
+        call.prompt_tokens = (usage.get("input_tokens") or token_usage.get("prompt_tokens")
+                              or self.token_counter(prompt))
+        call.completion_tokens = (usage.get("output_tokens") or token_usage.get("completion_tokens")
+                                  or self.token_counter(response.content))
+        call.cost = estimate_cost(call.model, call.prompt_tokens, call.completion_tokens)
+
+def load_and_split_documents(file_path: str, chunk_size: int = 2000, chunk_overlap: int = 200,
+                             length_function: Optional[Callable[[str], int]] = None) -> List[TrainingExample]:
+    """Load and split documentation into chunks.
+
+    chunk_size and chunk_overlap are measured with length_function, so passing
+    a token counter from get_token_counter splits on tokens instead of
+    characters.
+    """
     logger.info(f"Loading documentation from {file_path}")
     
     if not Path(file_path).exists():
         logger.error(f"File not found: {file_path}")
         raise FileNotFoundError(f"File not found: {file_path}")
     
+    from langchain.text_splitter import MarkdownTextSplitter
+    from langchain_community.document_loaders import TextLoader
+
     try:
         loader = TextLoader(file_path)
         documents = loader.load()
         logger.info(f"Loaded {len(documents)} document(s)")
         
-        splitter = MarkdownTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+        splitter = MarkdownTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                        length_function=length_function or len)
         splits = splitter.split_documents(documents)
         logger.info(f"Split into {len(splits)} chunks")
         
@@ -123,8 +1466,290 @@ def load_and_split_documents(file_path: str, chunk_size: int = 2000, chunk_overl
         logger.error(f"Error loading/splitting documents: {e}")
         raise
 
-def load_typescript_examples(examples_dir: str = "../../examples") -> List[TrainingExample]:
-    """Load TypeScript examples from the examples directory."""
+MARKDOWN_HEADING = re.compile(r"#{1,6} ")
+
+def iter_markdown_sections(lines: Iterable[str]) -> Iterator[str]:
+    """Yield markdown text one header section at a time as lines are read.
+
+    A section runs from a heading line up to the next one; headings inside
+    fenced code blocks do not start a section. Only the current section is
+    held in memory.
+    """
+    section: List[str] = []
+    in_fence = False
+    for line in lines:
+        if line.lstrip().startswith("```"):
+            in_fence = not in_fence
+        elif not in_fence and section and MARKDOWN_HEADING.match(line):
+            yield "".join(section)
+            section = []
+        section.append(line)
+    if section:
+        yield "".join(section)
+
+def iter_document_chunks(file_path: str, chunk_size: int = 2000, chunk_overlap: int = 200,
+                         length_function: Optional[Callable[[str], int]] = None) -> Iterator[TrainingExample]:
+    """Stream documentation chunks from file_path header section by header section.
+
+    Consecutive sections are packed into one chunk while they fit in
+    chunk_size; a section larger than that is split on its own with
+    MarkdownTextSplitter and chunk_overlap. Chunks never end inside a section
+    they did not start, so their boundaries, and with them the unit keys,
+    differ from load_and_split_documents.
+    """
+    if not Path(file_path).exists():
+        logger.error(f"File not found: {file_path}")
+        raise FileNotFoundError(f"File not found: {file_path}")
+
+    from langchain.text_splitter import MarkdownTextSplitter
+
+    length = length_function or len
+    splitter = MarkdownTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap, length_function=length)
+    chunk_index = 0
+    pending: List[str] = []
+    pending_length = 0
+    with open(file_path, 'r', encoding='utf-8') as f:
+        for section in itertools.chain(iter_markdown_sections(f), [None]):
+            chunks = []
+            size = length(section) if section is not None else 0
+            if pending and (section is None or pending_length + size > chunk_size):
+                chunks.append("".join(pending))
+                pending, pending_length = [], 0
+            if section is not None and size > chunk_size:
+                chunks.extend(splitter.split_text(section))
+            elif section is not None:
+                pending.append(section)
+                pending_length += size
+            for chunk in chunks:
+                content = chunk.strip()
+                if content:
+                    yield TrainingExample(content=content, example_type="documentation",
+                                          source_file=file_path, chunk_index=chunk_index)
+                    chunk_index += 1
+    logger.info(f"Streamed {chunk_index} chunks from {file_path}")
+
+def _split_document_file(file_path: str, chunk_size: int, chunk_overlap: int,
+                         tokenizer: Optional[str]) -> List[TrainingExample]:
+    """Process pool worker: split one documentation file completely."""
+    length_function = get_token_counter(tokenizer) if tokenizer else None
+    return list(iter_document_chunks(file_path, chunk_size, chunk_overlap, length_function))
+
+def iter_documents(file_paths: List[str], chunk_size: int = 2000, chunk_overlap: int = 200,
+                   tokenizer: Optional[str] = None, max_workers: Optional[int] = None) -> Iterator[TrainingExample]:
+    """Stream documentation chunks from several files, in file order.
+
+    A single file is split in this process, so its first chunks are available
+    as soon as its first sections have been read. Several files are split in
+    parallel, one per task, on a spawned pool of up to max_workers processes;
+    a file's chunks are yielded once it and every file before it are done.
+    Chunks are measured with get_token_counter(tokenizer), or in characters
+    when tokenizer is None; the name is passed because counters don't pickle.
+    """
+    if len(file_paths) == 1:
+        length_function = get_token_counter(tokenizer) if tokenizer else None
+        yield from iter_document_chunks(file_paths[0], chunk_size, chunk_overlap, length_function)
+        return
+    for file_path in file_paths:
+        if not Path(file_path).exists():
+            logger.error(f"File not found: {file_path}")
+            raise FileNotFoundError(f"File not found: {file_path}")
+    pool = ProcessPoolExecutor(min(max_workers or os.cpu_count() or 1, len(file_paths)), mp_context=get_context("spawn"),
+                               initializer=_ignore_shutdown_signals)
+    try:
+        futures = [pool.submit(_split_document_file, file_path, chunk_size, chunk_overlap, tokenizer)
+                   for file_path in file_paths]
+        for future in futures:
+            yield from future.result()
+    finally:
+        pool.shutdown(cancel_futures=True)
+
+# Directories under examples/ that only hold dependencies or build output
+PRUNED_DIRS = {"node_modules", "dist", "build", "out", ".next", ".turbo", ".vercel", ".cache", "coverage", ".git"}
+
+# Only matched inside the file's leading comment block, where generators put their banner
+GENERATED_MARKERS = ("@generated", "auto-generated", "do not edit")
+
+DECLARATION_PATTERN = re.compile(
+    r"^(export\s+)?(default\s+)?(declare\s+)?(async\s+)?(abstract\s+)?"
+    r"(function|class|const|let|var|interface|type|enum|namespace)\b|^export\b"
+)
+
+def _leading_comment_block(content: str) -> str:
+    """Return the comments before the first line of code (a shebang counts as header)."""
+    header: List[str] = []
+    in_block = False
+    for line in content.splitlines():
+        stripped = line.strip()
+        if not in_block and stripped.startswith("/*"):
+            in_block, stripped = True, stripped[2:]
+        if in_block:
+            comment, closed, rest = stripped.partition("*/")
+            header.append(comment)
+            if closed:
+                in_block = False
+                if rest.strip():  # code follows the comment on the same line
+                    break
+        elif not stripped or stripped.startswith(("//", "#!")):
+            header.append(stripped)
+        else:
+            break
+    return "\n".join(header)
+
+def detect_generated_code(file_path: Path, content: str) -> Optional[str]:
+    """Return why a file looks minified or generated, or None if it looks hand-written."""
+    if any(file_path.name.endswith(suffix) for suffix in (".min.js", ".bundle.js", ".chunk.js")):
+        return "minified"
+    header = _leading_comment_block(content).lower()
+    if any(marker in header for marker in GENERATED_MARKERS):
+        return "generated"
+    lines = content.splitlines() or [""]
+    if max(len(line) for line in lines) > 1000 or len(content) / len(lines) > 300:
+        return "minified"
+    return None
+
+def _line_depths(source: str) -> List[int]:
+    """Return the bracket nesting depth at the start of each line.
+
+    Skips strings, template literals (including nested ${} expressions) and
+    comments, which is enough to find top-level statements in TS/JS source.
+    """
+    depths = [0]
+    depth = 0
+    stack: List[str] = []  # enclosing template literals and their ${ expressions
+    i, n = 0, len(source)
+    while i < n:
+        ch = source[i]
+        nxt = source[i + 1] if i + 1 < n else ""
+        if stack and stack[-1] == "`":
+            if ch == "\\":
+                i += 1
+            elif ch == "`":
+                stack.pop()
+            elif ch == "$" and nxt == "{":
+                stack.append("${")
+                depth += 1
+                i += 1
+            elif ch == "\n":
+                depths.append(depth)
+        elif ch == "/" and nxt == "/":
+            while i < n and source[i] != "\n":
+                i += 1
+            continue
+        elif ch == "/" and nxt == "*":
+            end = source.find("*/", i + 2)
+            end = n if end == -1 else end + 2
+            depths.extend([depth] * source.count("\n", i, end))
+            i = end
+            continue
+        elif ch in "'\"":
+            # Quotes end at the end of the line too, so an apostrophe in JSX
+            # text ("Don't") cannot swallow the newline that ends its line.
+            i += 1
+            while i < n and source[i] != ch and source[i] != "\n":
+                i += 2 if source[i] == "\\" and source[i + 1:i + 2] != "\n" else 1
+            if i < n and source[i] == "\n":
+                continue
+        elif ch == "`":
+            stack.append("`")
+        elif ch in "{([":
+            depth += 1
+        elif ch in "})]":
+            depth = max(0, depth - 1)
+            if ch == "}" and stack and stack[-1] == "${":
+                stack.pop()
+        elif ch == "\n":
+            depths.append(depth)
+        i += 1
+    return depths
+
+def split_code_declarations(content: str, max_chars: int) -> List[str]:
+    """Split TS/JS source into chunks of whole top-level declarations.
+
+    Imports (and directives such as "use client") are repeated at the top of
+    every chunk so each one stands on its own. Leading comments and decorators
+    stay with the declaration they precede. A single declaration larger than
+    max_chars is split on line boundaries.
+    """
+    lines = content.splitlines(keepends=True)
+    depths = _line_depths(content)
+    if len(depths) < len(lines):
+        # splitlines also breaks on \r, \f and other separators the scanner
+        # does not count; treat the extra lines as nested rather than fail.
+        depths += [1] * (len(lines) - len(depths))
+    header: List[str] = []
+    starts: List[int] = []
+    body_start = None
+    for i, line in enumerate(lines):
+        if depths[i] != 0:
+            continue
+        stripped = line.lstrip()
+        if body_start is None and (stripped.startswith("import ") or stripped.startswith(("'use ", '"use '))):
+            continue
+        if body_start is None and stripped and not stripped.startswith(("//", "/*", "*")):
+            body_start = i
+        if body_start is not None and DECLARATION_PATTERN.match(line):
+            start = i
+            while start > body_start and depths[start - 1] == 0 and lines[start - 1].lstrip().startswith(("//", "/*", "*", "@")):
+                start -= 1
+            starts.append(start)
+
+    if body_start is None:
+        return [content]
+    header = [line for i, line in enumerate(lines[:body_start]) if not (depths[i] == 0 and not line.strip())]
+    header_text = "".join(header)
+    if not starts or starts[0] != body_start:
+        starts.insert(0, body_start)
+
+    segments = ["".join(lines[a:b]) for a, b in zip(starts, starts[1:] + [len(lines)])]
+    budget = max(max_chars - len(header_text), max_chars // 2)
+    pieces: List[str] = []
+    current = ""
+    for segment in segments:
+        if len(segment) > budget:
+            if current:
+                pieces.append(current)
+                current = ""
+            part = ""
+            for line in segment.splitlines(keepends=True):
+                if part and len(part) + len(line) > budget:
+                    pieces.append(part)
+                    part = ""
+                part += line
+            current = part
+        elif current and len(current) + len(segment) > budget:
+            pieces.append(current)
+            current = segment
+        else:
+            current += segment
+    if current.strip():
+        pieces.append(current)
+
+    return [header_text + "\n" + piece if header_text else piece for piece in pieces]
+
+def _read_code_file(file_path: Path, max_file_bytes: int) -> Tuple[Path, Optional[str], Optional[str]]:
+    """Read one code file; return (path, content, reason it was skipped)."""
+    try:
+        if file_path.stat().st_size > max_file_bytes:
+            return file_path, None, "oversized"
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+    except Exception as e:
+        logger.warning(f"Failed to load {file_path}: {e}")
+        return file_path, None, "unreadable"
+    if not content.strip():
+        return file_path, None, "empty"
+    return file_path, content, detect_generated_code(file_path, content)
+
+def load_typescript_examples(examples_dir: str = "../../examples", max_file_bytes: int = 256 * 1024,
+                             max_chunk_chars: int = 6000, max_workers: int = 8) -> List[TrainingExample]:
+    """Load TypeScript examples from the examples directory.
+
+    Dependency and build directories are pruned, minified or generated files
+    and files over max_file_bytes are skipped, and byte-identical files are
+    loaded once. Files longer than max_chunk_chars are split into chunks of
+    whole top-level declarations. Files are read on a thread pool; results
+    keep a deterministic, sorted walk order.
+    """
     logger.info(f"Loading TypeScript examples from {examples_dir}")
     
     examples = []
@@ -137,36 +1762,45 @@ def load_typescript_examples(examples_dir: str = "../../examples") -> List[Train
     # Common TypeScript/React file extensions
     ts_extensions = {'.ts', '.tsx', '.js', '.jsx', '.mjs'}
     
+    paths = []
     for root, dirs, files in os.walk(examples_path):
-        for file in files:
-            if Path(file).suffix in ts_extensions:
-                file_path = Path(root) / file
-                try:
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        content = f.read()
-                    
-                    # Skip empty files
-                    if content.strip():
-                        examples.append(TrainingExample(
-                            content=content,
-                            example_type="code_example",
-                            source_file=str(file_path),
-                            chunk_index=len(examples)
-                        ))
-                        logger.debug(f"Loaded code example: {file_path}")
-                        
-                except Exception as e:
-                    logger.warning(f"Failed to load {file_path}: {e}")
+        dirs[:] = sorted(d for d in dirs if d not in PRUNED_DIRS)
+        paths.extend(Path(root) / file for file in sorted(files) if Path(file).suffix in ts_extensions)
+    
+    skipped: Dict[str, int] = {}
+    seen_hashes = set()
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        for file_path, content, reason in pool.map(lambda path: _read_code_file(path, max_file_bytes), paths):
+            if content is not None and reason is None:
+                digest = hashlib.sha256(content.encode("utf-8")).digest()
+                if digest in seen_hashes:
+                    reason = "duplicate"
+                seen_hashes.add(digest)
+            if reason is not None:
+                skipped[reason] = skipped.get(reason, 0) + 1
+                logger.debug(f"Skipping {reason} code example: {file_path}")
+                continue
+            
+            chunks = [content] if len(content) <= max_chunk_chars else split_code_declarations(content, max_chunk_chars)
+            for chunk in chunks:
+                examples.append(TrainingExample(
+                    content=chunk,
+                    example_type="code_example",
+                    source_file=str(file_path),
+                    chunk_index=len(examples)
+                ))
+            logger.debug(f"Loaded code example: {file_path} ({len(chunks)} chunks)")
     
-    logger.info(f"Loaded {len(examples)} TypeScript examples")
+    skipped_summary = ", ".join(f"{count} {reason}" for reason, count in sorted(skipped.items())) or "none"
+    logger.info(f"Loaded {len(examples)} TypeScript examples from {len(paths)} files (skipped: {skipped_summary})")
     return examples
 
-def generate_documentation_qa(llm: ChatOpenAI, content: str, chunk_index: int) -> List[Dict[str, str]]:
-    """Generate Q&A pairs for documentation chunks."""
-    prompt = f"""
+def build_documentation_qa_prompt(content: str) -> str:
+    """Build the Q&A prompt for a documentation chunk."""
+    return f"""
     Based on this documentation:
     {content}
-    
+
     Generate 3 different user questions and answers in JSON format.
     Each should be a realistic question a developer would ask.
     Include questions about:
@@ -174,48 +1808,46 @@ def generate_documentation_qa(llm: ChatOpenAI, content: str, chunk_index: int) -
     - What certain components do
     - Why certain design decisions were made
     - When to use different approaches
-    
+
     Format: [{{"question": "...", "answer": "..."}}]
-    
+
     Make sure the response is valid JSON and each question-answer pair is realistic and helpful.
     """
-    
-    try:
-        logger.info(f"Generating documentation Q&A for chunk {chunk_index + 1}")
-        response = llm.invoke(prompt)
-        
-        pairs = json.loads(response.content)
-        
-        if not isinstance(pairs, list):
-            logger.warning(f"Chunk {chunk_index + 1}: Response is not a list, skipping")
-            return []
-        
-        valid_pairs = []
-        for i, pair in enumerate(pairs):
-            if isinstance(pair, dict) and "question" in pair and "answer" in pair:
-                if pair["question"].strip() and pair["answer"].strip():
-                    valid_pairs.append(pair)
-                else:
-                    logger.warning(f"Chunk {chunk_index + 1}, pair {i + 1}: Empty question or answer")
-            else:
-                logger.warning(f"Chunk {chunk_index + 1}, pair {i + 1}: Invalid pair format")
-        
-        logger.info(f"Chunk {chunk_index + 1}: Generated {len(valid_pairs)} valid Q&A pairs")
-        return valid_pairs
-        
-    except json.JSONDecodeError as e:
-        logger.error(f"Chunk {chunk_index + 1}: Failed to parse JSON response: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Chunk {chunk_index + 1}: Error generating Q&A pairs: {e}")
-        return []
 
-def generate_code_qa(llm: ChatOpenAI, content: str, source_file: str, chunk_index: int) -> List[Dict[str, str]]:
-    """Generate Q&A pairs for TypeScript code examples."""
-    prompt = f"""
+def build_packed_documentation_qa_prompt(examples: List[TrainingExample]) -> str:
+    """Build one Q&A prompt covering several documentation chunks.
+
+    Each chunk is wrapped in a section tagged with its fingerprint, and the
+    model is asked for an object mapping every section id to its own pairs.
+    """
+    sections = "\n\n".join(
+        f'<section id="{example.fingerprint()}">\n{example.content}\n</section>' for example in examples
+    )
+    return f"""
+    Based on each of these documentation sections:
+    {sections}
+
+    For every section, generate 3 different user questions and answers in JSON format,
+    using only that section's content.
+    Each should be a realistic question a developer would ask.
+    Include questions about:
+    - How to use specific features
+    - What certain components do
+    - Why certain design decisions were made
+    - When to use different approaches
+
+    Format: {{"<section id>": [{{"question": "...", "answer": "..."}}], ...}}
+
+    Use every section id exactly once as a key.
+    Make sure the response is valid JSON and each question-answer pair is realistic and helpful.
+    """
+
+def build_code_qa_prompt(content: str) -> str:
+    """Build the Q&A prompt for a TypeScript code example."""
+    return f"""
     Based on this TypeScript/React code example:
     {content}
-    
+
     Generate 4 different user questions and answers in JSON format.
     Include questions about:
     - How to implement this pattern
@@ -223,347 +1855,2228 @@ def generate_code_qa(llm: ChatOpenAI, content: str, source_file: str, chunk_inde
     - How to customize or extend this example
     - Common issues and troubleshooting
     - Best practices demonstrated
-    
+
     Format: [{{"question": "...", "answer": "..."}}]
-    
+
     Make sure the response is valid JSON and each question-answer pair is realistic and helpful.
     Focus on practical implementation questions that developers would ask.
     """
-    
-    try:
-        logger.info(f"Generating code Q&A for {Path(source_file).name}")
-        response = llm.invoke(prompt)
-        
-        pairs = json.loads(response.content)
-        
-        if not isinstance(pairs, list):
-            logger.warning(f"Code example {chunk_index + 1}: Response is not a list, skipping")
-            return []
-        
-        valid_pairs = []
-        for i, pair in enumerate(pairs):
-            if isinstance(pair, dict) and "question" in pair and "answer" in pair:
-                if pair["question"].strip() and pair["answer"].strip():
-                    valid_pairs.append(pair)
-                else:
-                    logger.warning(f"Code example {chunk_index + 1}, pair {i + 1}: Empty question or answer")
-            else:
-                logger.warning(f"Code example {chunk_index + 1}, pair {i + 1}: Invalid pair format")
-        
-        logger.info(f"Code example {chunk_index + 1}: Generated {len(valid_pairs)} valid Q&A pairs")
-        return valid_pairs
-        
-    except json.JSONDecodeError as e:
-        logger.error(f"Code example {chunk_index + 1}: Failed to parse JSON response: {e}")
-        return []
-    except Exception as e:
-        logger.error(f"Code example {chunk_index + 1}: Error generating Q&A pairs: {e}")
-        return []
 
-def generate_code_generation_examples(llm: ChatOpenAI, all_examples: List[TrainingExample]) -> List[Dict[str, Any]]:
-    """Generate code generation instruction-following examples."""
-    logger.info("Generating code generation examples")
-    
-    # Get some documentation and code examples for context
-    doc_examples = [ex for ex in all_examples if ex.example_type == "documentation"][:3]
-    code_examples = [ex for ex in all_examples if ex.example_type == "code_example"][:2]
-    
-    combined_context = "\n\n".join([
-        f"Documentation: {ex.content[:800]}..." for ex in doc_examples
-    ] + [
-        f"Code Example: {ex.content[:800]}..." for ex in code_examples
-    ])
-    
-    prompt = f"""
+TERM_PATTERN = re.compile(r"[A-Z]+(?![a-z])|[A-Z]?[a-z]+|\d+")
+INDEX_CACHE_DIR = ".index_cache"
+INDEX_CACHE_MAX_BYTES = 256 * 1024 * 1024
+
+def index_terms(text: str) -> List[str]:
+    """Split text into lowercase search terms, breaking camelCase identifiers apart."""
+    return [term.lower() for term in TERM_PATTERN.findall(text)]
+
+class LexicalIndex:
+    """BM25 index over the text of training example chunks.
+
+    Postings are kept per term as parallel arrays of document ids and term
+    frequencies, and a query is scored with NumPy over just the documents its
+    terms occur in.
+    """
+
+    K1 = 1.5
+    B = 0.75
+
+    def __init__(self, postings: Dict[str, Tuple[List[int], List[int]]], doc_lengths: List[int]):
+        self.postings = {term: (np.asarray(docs, dtype=np.int64), np.asarray(tfs, dtype=np.float64))
+                         for term, (docs, tfs) in postings.items()}
+        self.doc_lengths = np.asarray(doc_lengths, dtype=np.float64)
+        self.avg_length = float(self.doc_lengths.mean()) if len(self.doc_lengths) else 0.0
+
+    @classmethod
+    def build(cls, texts: List[str]) -> "LexicalIndex":
+        """Tokenize and index texts; document ids are positions in texts."""
+        postings: Dict[str, Tuple[List[int], List[int]]] = {}
+        doc_lengths = []
+        for doc, text in enumerate(texts):
+            terms = index_terms(text)
+            doc_lengths.append(len(terms))
+            counts: Dict[str, int] = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                docs, tfs = postings.setdefault(term, ([], []))
+                docs.append(doc)
+                tfs.append(count)
+        return cls(postings, doc_lengths)
+
+    @classmethod
+    def load(cls, path: Path) -> "LexicalIndex":
+        with open(path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        return cls(data["postings"], data["doc_lengths"])
+
+    def save(self, path: Path):
+        """Atomically write the index as JSON."""
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                "postings": {term: [docs.tolist(), tfs.astype(int).tolist()] for term, (docs, tfs) in self.postings.items()},
+                "doc_lengths": self.doc_lengths.astype(int).tolist(),
+            }, f)
+        os.replace(tmp_path, path)
+
+    def search(self, query: str) -> List[int]:
+        """Return the ids of documents matching query, best BM25 score first."""
+        scores = np.zeros(len(self.doc_lengths))
+        total = len(self.doc_lengths)
+        for term in set(index_terms(query)):
+            if term not in self.postings:
+                continue
+            docs, tfs = self.postings[term]
+            idf = np.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[docs] / self.avg_length)
+            scores[docs] += idf * tfs * (self.K1 + 1) / (tfs + norm)
+        matches = np.flatnonzero(scores)
+        # Stable sort keeps corpus order among equal scores
+        return matches[np.argsort(-scores[matches], kind="stable")].tolist()
+
+_lexical_indexes: Dict[str, LexicalIndex] = {}
+
+def evict_lexical_indexes(cache_dir: str, max_bytes: int = INDEX_CACHE_MAX_BYTES):
+    """Delete the least recently used cached indexes once they exceed max_bytes.
+
+    The most recently used index is always kept. Loading an index touches its
+    mtime, so a corpus that is still in use outlives one-off runs such as the
+    benchmark's.
+    """
+    cached = []
+    for path in Path(cache_dir).glob("bm25-*.json"):
+        try:
+            stat = path.stat()
+        except OSError:
+            continue
+        cached.append((stat.st_mtime, stat.st_size, path))
+    total = 0
+    for position, (_, size, path) in enumerate(sorted(cached, key=lambda entry: entry[0], reverse=True)):
+        total += size
+        if position and total > max_bytes:
+            path.unlink(missing_ok=True)
+            logger.debug(f"Evicted cached lexical index {path}")
+
+def get_lexical_index(all_examples: List[TrainingExample], cache_dir: str = INDEX_CACHE_DIR) -> LexicalIndex:
+    """Return the BM25 index of all_examples, built once per corpus.
+
+    The index is memoized in-process and cached on disk under cache_dir,
+    keyed by a fingerprint of every chunk, so later runs, resumes and shards
+    load it instead of re-tokenizing the corpus. Indexes of other corpora
+    stay cached until evict_lexical_indexes trims the directory by size.
+    """
+    corpus_key = content_fingerprint("\0".join(example.fingerprint() for example in all_examples))
+    if corpus_key in _lexical_indexes:
+        return _lexical_indexes[corpus_key]
+
+    path = Path(cache_dir) / f"bm25-{corpus_key}.json"
+    index = None
+    if path.exists():
+        try:
+            index = LexicalIndex.load(path)
+            os.utime(path)
+            logger.info(f"Loaded lexical index from {path}")
+        except Exception as e:
+            logger.warning(f"Rebuilding unreadable lexical index {path}: {e}")
+    if index is None:
+        index = LexicalIndex.build([example.content for example in all_examples])
+        try:
+            index.save(path)
+            evict_lexical_indexes(cache_dir)
+            logger.info(f"Built lexical index over {len(all_examples)} chunks ({len(index.postings)} terms), cached at {path}")
+        except Exception as e:
+            logger.warning(f"Failed to cache lexical index at {path}: {e}")
+    _lexical_indexes[corpus_key] = index
+    return index
+
+# Each topic seeds one integration or code generation request with retrieved context
+INTEGRATION_TOPICS = [
+    "Integrating the kit into a Next.js app router project",
+    "Using the kit with Vite and a plain React app",
+    "Connecting to a Pipecat bot over a Daily, WebRTC or WebSocket transport",
+    "Handling connection errors, timeouts and debugging failed sessions",
+    "Microphone permissions and input device selection",
+    "Customizing themes, colors and dark mode",
+    "Styling components with Tailwind CSS classes and CSS variables",
+    "Building a custom layout from individual components and hooks",
+    "Showing transcripts and the conversation history",
+    "Audio visualizers and the bot speaking state",
+    "Performance optimization and bundle size",
+    "Server-side rendering and hydration issues",
+]
+
+CODE_GENERATION_TOPICS = [
+    "Create a basic voice chat component",
+    "Implement a custom theme",
+    "Add error handling to a component",
+    "Create a new template",
+    "Integrate with a specific framework such as Next.js or Vite",
+    "Add custom styling to existing components",
+    "Build a control bar with mute, device selection and disconnect",
+    "Display a live transcript of the conversation",
+    "Add an audio visualizer for the bot and the user",
+    "Create a complete example app",
+]
+
+TOPIC_PAIRS = 3  # pairs requested per topic prompt
+TOPIC_CONTEXT_TOKENS = 3000  # retrieved context budget per topic prompt
+
+def select_topic_context(kind: str, topic: str, all_examples: List[TrainingExample],
+                         index: Optional[LexicalIndex] = None, budget_tokens: int = TOPIC_CONTEXT_TOKENS,
+                         token_counter: Callable[[str], int] = estimate_tokens) -> List[TrainingExample]:
+    """Pick the chunks most relevant to a topic that fit the context budget.
+
+    Chunks are taken in BM25 order and skipped when they would overflow the
+    budget. Code generation prompts split the budget evenly between code
+    examples and documentation. If nothing matches the topic, the corpus is
+    used in order.
+    """
+    index = index or get_lexical_index(all_examples)
+    ranked = index.search(topic) or range(len(all_examples))
+    if kind == "code_generation":
+        remaining = {"code_example": budget_tokens // 2, "documentation": budget_tokens - budget_tokens // 2}
+    else:
+        remaining = {"any": budget_tokens}
+    selected, seen = [], set()
+    for doc in ranked:
+        example = all_examples[doc]
+        pool = example.example_type if kind == "code_generation" else "any"
+        if remaining.get(pool, 0) <= 0 or example.content in seen:
+            continue
+        tokens = token_counter(example.content)
+        if tokens > remaining[pool]:
+            continue
+        seen.add(example.content)
+        selected.append(example)
+        remaining[pool] -= tokens
+        if not any(remaining.values()):
+            break
+    return selected
+
+def _format_context(context_examples: List[TrainingExample]) -> str:
+    return "\n\n".join(
+        f"{'Documentation' if ex.example_type == 'documentation' else 'Code Example'}: {ex.content}"
+        for ex in context_examples
+    )
+
+def build_code_generation_prompt(topic: str, context_examples: List[TrainingExample]) -> str:
+    """Build a topic-seeded code generation prompt around retrieved context."""
+    return f"""
     Based on this Voice UI Kit documentation and code examples:
-    {combined_context}
-    
-    Generate 8 code generation instruction-following examples in JSON format.
-    Each should include an instruction and the expected code implementation.
-    
-    Include different types of requests:
-    - Create a basic voice chat component
-    - Implement a custom theme
-    - Add error handling to a component
-    - Create a new template
-    - Integrate with a specific framework
-    - Add custom styling
-    - Implement specific functionality
-    - Create a complete example app
-    
+    {_format_context(context_examples)}
+
+    Generate {TOPIC_PAIRS} code generation instruction-following examples in JSON format for this kind of request:
+    {topic}
+
+    Each should include an instruction and the expected code implementation, using the
+    components, props and patterns shown above.
+
     Format: [
         {{
             "instruction": "Create a voice chat component that...",
             "implementation": "```tsx\\nimport {{ ... }} from '@pipecat-ai/voice-ui-kit';\\n\\nexport function VoiceChat() {{...}}\\n```"
         }}
     ]
-    
+
     Make sure the response is valid JSON and each implementation includes proper imports and complete, working code.
     """
-    
-    try:
-        response = llm.invoke(prompt)
-        examples = json.loads(response.content)
-        
-        if not isinstance(examples, list):
-            logger.warning("Code generation examples: Response is not a list, skipping")
-            return []
-        
-        valid_examples = []
-        for i, example in enumerate(examples):
-            if isinstance(example, dict) and "instruction" in example and "implementation" in example:
-                if example["instruction"].strip() and example["implementation"].strip():
-                    valid_examples.append(example)
-                else:
-                    logger.warning(f"Code generation example {i + 1}: Empty instruction or implementation")
-            else:
-                logger.warning(f"Code generation example {i + 1}: Invalid format")
-        
-        logger.info(f"Generated {len(valid_examples)} code generation examples")
-        return valid_examples
-        
-    except Exception as e:
-        logger.error(f"Error generating code generation examples: {e}")
-        return []
 
-def generate_integration_examples(llm: ChatOpenAI, all_examples: List[TrainingExample]) -> List[Dict[str, str]]:
-    """Generate integration and troubleshooting examples."""
-    logger.info("Generating integration and troubleshooting examples")
-    
-    # Combine some documentation and code examples for integration questions
-    combined_content = "\n\n".join([
-        f"Documentation: {ex.content[:500]}..." if ex.example_type == "documentation" 
-        else f"Code Example: {ex.content[:500]}..."
-        for ex in all_examples[:5]  # Use first 5 examples
-    ])
-    
-    prompt = f"""
+def build_integration_prompt(topic: str, context_examples: List[TrainingExample]) -> str:
+    """Build a topic-seeded integration and troubleshooting prompt around retrieved context."""
+    return f"""
     Based on this Voice UI Kit documentation and code examples:
-    {combined_content}
-    
-    Generate 5 integration and troubleshooting questions and answers in JSON format.
-    Include questions about:
-    - How to integrate with different frameworks (Next.js, React, Vite)
-    - How to handle common errors and debugging
-    - How to customize themes and styling
-    - How to implement specific use cases
-    - Performance optimization tips
-    
+    {_format_context(context_examples)}
+
+    Generate {TOPIC_PAIRS} integration and troubleshooting questions and answers in JSON format about:
+    {topic}
+
     Format: [{{"question": "...", "answer": "..."}}]
-    
+
     Make sure the response is valid JSON and each question-answer pair is realistic and helpful.
     """
-    
+
+def _valid_items(items: List[Any], fields: Tuple[str, str], label: str) -> List[Dict[str, str]]:
+    """Keep items that are objects with non-empty string fields."""
+    valid_items = []
+    for i, item in enumerate(items):
+        if isinstance(item, dict) and all(isinstance(item.get(field), str) for field in fields):
+            if all(item[field].strip() for field in fields):
+                valid_items.append(item)
+            else:
+                logger.warning(f"{label}, pair {i + 1}: Empty {' or '.join(fields)}")
+        else:
+            logger.warning(f"{label}, pair {i + 1}: Invalid pair format")
+
+    return valid_items
+
+JSON_DECODER = json.JSONDecoder()
+FENCE_PATTERN = re.compile(r"```[a-zA-Z]*[ \t]*\n?(.*?)(?:```|$)", re.DOTALL)
+
+def _skip(text: str, pos: int, chars: str = " \t\r\n,") -> int:
+    while pos < len(text) and text[pos] in chars:
+        pos += 1
+    return pos
+
+def _salvage_container(text: str, pos: int) -> Tuple[Any, int]:
+    """Decode the array or object starting at pos, keeping the complete members of a broken one.
+
+    Returns (value, end position). Decoding stops at the first member that is
+    truncated or malformed; a nested container is salvaged the same way.
+    """
     try:
-        response = llm.invoke(prompt)
-        pairs = json.loads(response.content)
-        
-        if not isinstance(pairs, list):
-            logger.warning("Integration examples: Response is not a list, skipping")
-            return []
-        
-        valid_pairs = []
-        for i, pair in enumerate(pairs):
-            if isinstance(pair, dict) and "question" in pair and "answer" in pair:
-                if pair["question"].strip() and pair["answer"].strip():
-                    valid_pairs.append(pair)
-        
-        logger.info(f"Generated {len(valid_pairs)} integration examples")
-        return valid_pairs
-        
-    except Exception as e:
-        logger.error(f"Error generating integration examples: {e}")
+        return JSON_DECODER.raw_decode(text, pos)
+    except json.JSONDecodeError:
+        pass
+    closing = "]" if text[pos] == "[" else "}"
+    result: Any = [] if closing == "]" else {}
+    pos += 1
+    while True:
+        pos = _skip(text, pos)
+        if pos >= len(text) or text[pos] == closing:
+            return result, pos + 1
+        try:
+            if closing == "}":
+                key, pos = JSON_DECODER.raw_decode(text, pos)
+                pos = _skip(text, pos, " \t\r\n")
+                if not isinstance(key, str) or text[pos:pos + 1] != ":":
+                    return result, pos
+                pos = _skip(text, pos + 1, " \t\r\n")
+            if text[pos:pos + 1] in ("[", "{"):
+                value, pos = _salvage_container(text, pos)
+            else:
+                value, pos = JSON_DECODER.raw_decode(text, pos)
+        except json.JSONDecodeError:
+            return result, pos
+        if closing == "]":
+            result.append(value)
+        else:
+            result[key] = value
+
+def _unwrap_array(value: Any) -> Any:
+    """Return the single array inside an object, as in structured-output responses."""
+    if isinstance(value, dict):
+        arrays = [item for item in value.values() if isinstance(item, list)]
+        if len(arrays) == 1:
+            return arrays[0]
+    return value
+
+def extract_json(raw: str, opener: str = "[") -> Tuple[Any, bool]:
+    """Decode a response that should hold a JSON array (opener '[') or object ('{').
+
+    Returns (value, salvaged). Clean JSON is returned as is, with an object
+    wrapping a single array unwrapped when an array is expected. Otherwise
+    markdown fences and surrounding prose are skipped and the complete members
+    of a truncated or malformed container are recovered, and salvaged is True.
+
+    Raises json.JSONDecodeError if nothing can be recovered.
+    """
+    try:
+        value = json.loads(raw)
+        return (_unwrap_array(value) if opener == "[" else value), False
+    except json.JSONDecodeError as e:
+        error = e
+    fence = FENCE_PATTERN.search(raw)
+    text = fence.group(1) if fence else raw
+    start = text.find(opener)
+    if start < 0:
+        raise error
+    value, _ = _salvage_container(text, start)
+    if not value:
+        raise error
+    return value, True
+
+def _pairs_from_items(items: Any, fields: Tuple[str, str], label: str) -> List[Dict[str, str]]:
+    if not isinstance(items, list):
+        logger.warning(f"{label}: Response is not a list, skipping")
         return []
 
+    return _valid_items(items, fields, label)
+
+def _pairs_from_sections(sections: Any, fields: Tuple[str, str], section_ids: List[str],
+                         label: str) -> Dict[str, List[Dict[str, str]]]:
+    if not isinstance(sections, dict):
+        logger.warning(f"{label}: Response is not an object, skipping")
+        return {}
+
+    pairs_by_section = {}
+    for section_id in section_ids:
+        items = sections.get(section_id)
+        if not isinstance(items, list):
+            logger.warning(f"{label}: No pairs for section {section_id}")
+            continue
+        valid_items = _valid_items(items, fields, f"{label}, section {section_id}")
+        if valid_items:
+            pairs_by_section[section_id] = valid_items
+
+    return pairs_by_section
+
+def _pair_schema(fields: Tuple[str, str]) -> Dict[str, Any]:
+    return {
+        "type": "array",
+        "items": {
+            "type": "object",
+            "properties": {name: {"type": "string"} for name in fields},
+            "required": list(fields),
+            "additionalProperties": False,
+        },
+    }
+
+def response_format_for(fields: Tuple[str, str], section_ids: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Return an OpenAI json_schema response_format for a pairs prompt.
+
+    Strict schemas need an object at the root, so plain prompts get
+    {"pairs": [...]} (unwrapped again by extract_json) and packed prompts get
+    one required array per section id.
+    """
+    keys = section_ids if section_ids is not None else ["pairs"]
+    return {
+        "type": "json_schema",
+        "json_schema": {
+            "name": "training_pairs",
+            "strict": True,
+            "schema": {
+                "type": "object",
+                "properties": {key: _pair_schema(fields) for key in keys},
+                "required": list(keys),
+                "additionalProperties": False,
+            },
+        },
+    }
+
+def is_unsupported_response_format(error: BaseException) -> bool:
+    """Return True if the API rejected a request because of its response_format."""
+    return getattr(error, "status_code", None) == 400 and "response_format" in str(error)
+
+QA_FIELDS = ("question", "answer")
+CODE_GENERATION_FIELDS = ("instruction", "implementation")
+
+PACKAGE_NAME = "@pipecat-ai/voice-ui-kit"
+# Import specifiers of the package's entry points and their modules under src/ (see tsup.config.ts)
+PACKAGE_ENTRY_POINTS = {PACKAGE_NAME: "index.ts", f"{PACKAGE_NAME}/webgl": "visualizers/webgl/index.ts"}
+EXPORT_DECLARATION_PATTERN = re.compile(
+    r"^export\s+(?:declare\s+)?(?:abstract\s+)?(?:async\s+)?"
+    r"(?:const|let|var|function\*?|class|interface|type|enum)\s+([A-Za-z_$][\w$]*)", re.MULTILINE
+)
+EXPORT_LIST_PATTERN = re.compile(r"^export\s+(?:type\s+)?\{([^}]*)\}", re.MULTILINE)
+EXPORT_ALL_PATTERN = re.compile(r"^export\s+\*\s+(?:as\s+([A-Za-z_$][\w$]*)\s+)?from\s+[\"']([^\"']+)[\"']", re.MULTILINE)
+IMPORT_PATTERN = re.compile(r"^\s*import\s+(?:type\s+)?([\w$*{},\s]+?)\s+from\s+[\"']([^\"']+)[\"']", re.MULTILINE)
+CODE_FENCE_PATTERN = re.compile(r"```([\w+-]*)[^\n]*\n(.*?)```", re.DOTALL)
+SCRIPT_LANGUAGES = {"", "tsx", "ts", "typescript", "jsx", "js", "javascript"}
+
+def _resolve_module(specifier: str, importer: Path, src_dir: Path) -> Optional[Path]:
+    """Resolve an "@/..." or relative module specifier to a source file, or None for packages."""
+    if specifier.startswith("@/"):
+        base = src_dir / specifier[2:]
+    elif specifier.startswith("."):
+        base = importer.parent / specifier
+    else:
+        return None
+    for candidate in (Path(f"{base}{suffix}") for suffix in (".ts", ".tsx", ".d.ts")):
+        if candidate.is_file():
+            return candidate
+    for candidate in (base / "index.ts", base / "index.tsx"):
+        if candidate.is_file():
+            return candidate
+    return None
+
+def _exported_names(specifiers: str) -> Iterator[str]:
+    """Yield the exported (or imported) names of an `{ a, b as c, type d }` list."""
+    for specifier in specifiers.split(","):
+        specifier = re.sub(r"^\s*type\s+", "", specifier).strip()
+        if specifier:
+            yield specifier.split(" as ")[-1].strip()
+
+def collect_exports(entry: Path, src_dir: Path) -> Set[str]:
+    """Return the names a module exports, following `export * from` re-exports within src_dir."""
+    names: Set[str] = set()
+    seen: Set[Path] = set()
+    pending = [entry]
+    while pending:
+        module = pending.pop()
+        if module in seen:
+            continue
+        seen.add(module)
+        source = module.read_text(encoding="utf-8")
+        names.update(EXPORT_DECLARATION_PATTERN.findall(source))
+        for specifiers in EXPORT_LIST_PATTERN.findall(source):
+            names.update(name for name in _exported_names(specifiers) if name != "default")
+        for namespace, specifier in EXPORT_ALL_PATTERN.findall(source):
+            if namespace:
+                names.add(namespace)
+            elif (resolved := _resolve_module(specifier, module, src_dir)) is not None:
+                pending.append(resolved)
+    return names
+
+def load_package_exports(src_dir: str = "../../src") -> Dict[str, FrozenSet[str]]:
+    """Return the names exported by each entry point of the package, keyed by import specifier.
+
+    Raises FileNotFoundError if the package sources are not at src_dir.
+    """
+    src_path = Path(src_dir)
+    exports = {}
+    for specifier, entry in PACKAGE_ENTRY_POINTS.items():
+        if not (src_path / entry).is_file():
+            raise FileNotFoundError(f"Package entry point not found: {src_path / entry}")
+        exports[specifier] = frozenset(collect_exports(src_path / entry, src_path))
+    logger.info(f"Loaded {sum(len(names) for names in exports.values())} exported names from {src_dir}")
+    return exports
+
+def extract_code_blocks(implementation: str) -> List[Tuple[str, str]]:
+    """Return (language, code) for each TypeScript or JavaScript block of an implementation.
+
+    Fenced blocks in other languages (shell, CSS, JSON) are skipped; an
+    implementation without any fence is taken to be code as a whole.
+    """
+    blocks = CODE_FENCE_PATTERN.findall(implementation)
+    if not blocks:
+        return [("tsx", implementation)] if "```" not in implementation else []
+    return [(language.lower(), code) for language, code in blocks if language.lower() in SCRIPT_LANGUAGES]
+
+def _import_error(code: str, exports: Dict[str, FrozenSet[str]]) -> Optional[str]:
+    """Return a description of the first import from the package that it does not export."""
+    for clause, source in IMPORT_PATTERN.findall(code):
+        if source != PACKAGE_NAME and not source.startswith(f"{PACKAGE_NAME}/"):
+            continue
+        if source not in exports:
+            return f"{source} is not an entry point of {PACKAGE_NAME}"
+        named = re.search(r"\{([^}]*)\}", clause)
+        default = clause[:named.start()] if named else clause
+        if default.strip(" ,") and not default.strip().startswith("*"):
+            return f"{source} has no default export"
+        if named:
+            for specifier in named.group(1).split(","):
+                name = re.sub(r"^\s*type\s+", "", specifier).split(" as ")[0].strip()
+                if name and name not in exports[source]:
+                    return f"{name} is not exported by {source}"
+    return None
+
+# tree-sitter parsers of the current (worker) process, created on first use
+_parsers: Dict[str, Any] = {}
+
+def _syntax_error(code: str, language: str) -> Optional[str]:
+    """Return the position of the first syntax error tree-sitter finds in a block, or None."""
+    grammar = "typescript" if language in ("ts", "typescript") else "tsx"
+    if grammar not in _parsers:
+        from tree_sitter import Language, Parser
+        import tree_sitter_typescript
+        language_fn = tree_sitter_typescript.language_typescript if grammar == "typescript" else tree_sitter_typescript.language_tsx
+        _parsers[grammar] = Parser(Language(language_fn()))
+    root = _parsers[grammar].parse(code.encode("utf-8")).root_node
+    if not root.has_error:
+        return None
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        if node.is_error or node.is_missing:
+            return f"syntax error at line {node.start_point[0] + 1}"
+        pending.extend(reversed([child for child in node.children if child.has_error or child.is_missing]))
+    return "syntax error"
+
+def validate_implementation(implementation: str, exports: Dict[str, FrozenSet[str]],
+                            check_syntax: bool = True) -> Optional[str]:
+    """Return why a generated implementation is invalid, or None if it passes."""
+    blocks = extract_code_blocks(implementation)
+    if not blocks:
+        return "no TypeScript code block"
+    for language, code in blocks:
+        error = (_syntax_error(code, language) if check_syntax else None) or _import_error(code, exports)
+        if error:
+            return error
+    return None
+
+# Set in each validation worker process by _init_validation_worker
+_worker_exports: Dict[str, FrozenSet[str]] = {}
+_worker_check_syntax = True
+
+def _init_validation_worker(exports: Dict[str, FrozenSet[str]], check_syntax: bool):
+    global _worker_exports, _worker_check_syntax
+    _ignore_shutdown_signals()
+    _worker_exports, _worker_check_syntax = exports, check_syntax
+
+def _validate_batch(implementations: List[str]) -> List[Optional[str]]:
+    return [validate_implementation(implementation, _worker_exports, _worker_check_syntax)
+            for implementation in implementations]
+
+def tree_sitter_available() -> bool:
+    """Return True if the tree-sitter TypeScript grammar can be imported."""
+    try:
+        import tree_sitter  # noqa: F401
+        import tree_sitter_typescript  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+class CodeValidator:
+    """Validates generated TSX implementations on a process pool.
+
+    Every TypeScript block of an implementation is parsed with tree-sitter,
+    and its imports from the package must name exports of the entry point
+    they import from (see load_package_exports). Verdicts are kept in memory
+    and, with cache_file, appended to a JSONL file, keyed by a hash of the
+    implementation and of the export set, so unchanged code is validated once
+    across runs. Without tree-sitter only imports are checked.
+    """
+
+    def __init__(self, exports: Dict[str, FrozenSet[str]], cache_file: Optional[str] = None,
+                 max_workers: Optional[int] = None):
+        self.exports = exports
+        self.cache_file = cache_file
+        self.max_workers = max_workers
+        self.check_syntax = tree_sitter_available()
+        if not self.check_syntax:
+            logger.warning("tree-sitter is not installed, generated code is only checked for imports")
+        self._salt = content_fingerprint(json.dumps(
+            {"exports": {source: sorted(names) for source, names in exports.items()}, "syntax": self.check_syntax},
+            sort_keys=True
+        ))
+        self._verdicts: Dict[str, Optional[str]] = {}
+        self._lock = threading.Lock()
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._handle = None
+        self.validated = 0
+        self.cache_hits = 0
+        self.failures = 0
+        if cache_file and Path(cache_file).exists():
+            with open(cache_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self._verdicts[entry["key"]] = entry["error"]
+
+    def _key(self, implementation: str) -> str:
+        return hashlib.sha256(f"{self._salt}\0{implementation}".encode("utf-8")).hexdigest()
+
+    def _executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(self.max_workers, mp_context=get_context("spawn"),
+                                                 initializer=_init_validation_worker,
+                                                 initargs=(self.exports, self.check_syntax))
+            return self._pool
+
+    def _lookup(self, implementations: List[str]) -> Tuple[List[str], List[str]]:
+        """Return the cache keys of implementations and the ones that still need validating."""
+        keys = [self._key(implementation) for implementation in implementations]
+        with self._lock:
+            misses = [implementation for key, implementation in zip(keys, implementations) if key not in self._verdicts]
+            self.cache_hits += len(implementations) - len(misses)
+        return keys, misses
+
+    def _remember(self, implementations: List[str], errors: List[Optional[str]]):
+        with self._lock:
+            for implementation, error in zip(implementations, errors):
+                key = self._key(implementation)
+                self._verdicts[key] = error
+                self.validated += 1
+                if self.cache_file:
+                    if self._handle is None:
+                        self._handle = open(self.cache_file, 'a', encoding='utf-8')
+                    self._handle.write(json.dumps({"key": key, "error": error}) + '\n')
+            if self._handle:
+                self._handle.flush()
+
+    def _verdict(self, keys: List[str]) -> List[Optional[str]]:
+        with self._lock:
+            errors = [self._verdicts[key] for key in keys]
+            self.failures += sum(error is not None for error in errors)
+        return errors
+
+    def check(self, implementations: List[str]) -> List[Optional[str]]:
+        """Return an error message, or None, for each implementation."""
+        keys, misses = self._lookup(implementations)
+        if misses:
+            self._remember(misses, self._executor().submit(_validate_batch, misses).result())
+        return self._verdict(keys)
+
+    async def acheck(self, implementations: List[str]) -> List[Optional[str]]:
+        """Async variant of check that awaits the worker instead of blocking the event loop."""
+        keys, misses = self._lookup(implementations)
+        if misses:
+            self._remember(misses, await asyncio.wrap_future(self._executor().submit(_validate_batch, misses)))
+        return self._verdict(keys)
+
+    def log_stats(self):
+        """Log how many implementations were validated, served from cache and rejected."""
+        logger.info(f"Code validation: {self.validated} implementations validated, {self.cache_hits} cached verdicts, "
+                    f"{self.failures} rejected{'' if self.check_syntax else ' (imports only)'}")
+
+    def close(self):
+        """Shut down the worker pool and close the verdict cache."""
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self._handle:
+            self._handle.close()
+            self._handle = None
+
+def _lookup(llm: ChatOpenAI, prompt: str, cache: Optional[ResponseCache]) -> Tuple[Optional[str], Optional[str]]:
+    """Return (cached response, cache key) for a prompt."""
+    if cache is None:
+        return None, None
+    key = cache.make_key(model_name(llm), prompt)
+    return cache.get(key), key
+
+def _parse_response(raw: str, call: CallRecord, fields: Tuple[str, str], label: str, context: GenerationContext,
+                    section_ids: Optional[List[str]] = None) -> Tuple[Any, int, bool]:
+    """Parse a response into (valid pairs, pair count, salvaged), recording the call if it is unusable."""
+    try:
+        value, salvaged = extract_json(raw, "[" if section_ids is None else "{")
+    except json.JSONDecodeError as e:
+        call.outcome = "invalid_json"
+        context.record_call(call)
+        raise GenerationError(f"{label}: Failed to parse JSON response: {e}") from e
+    if section_ids is None:
+        valid_pairs = _pairs_from_items(value, fields, label)
+        count = len(valid_pairs)
+    else:
+        valid_pairs = _pairs_from_sections(value, fields, section_ids, label)
+        count = sum(len(pairs) for pairs in valid_pairs.values())
+    if salvaged:
+        if not count:
+            # Nothing usable: fail the unit so it is retried rather than checkpointed empty
+            call.outcome = "invalid_json"
+            context.record_call(call)
+            raise GenerationError(f"{label}: No valid pairs in malformed JSON response")
+        logger.warning(f"{label}: Recovered {count} valid pairs from malformed JSON")
+    return valid_pairs, count, salvaged
+
+def _reject_invalid_code(errors: List[Optional[str]], key: Optional[str], call: CallRecord, label: str,
+                         context: GenerationContext):
+    """Fail a code generation call if any of its implementations did not validate.
+
+    The response is dropped from the cache, so the retry asks the model again.
+    """
+    invalid = [error for error in errors if error]
+    if not invalid:
+        return
+    call.outcome = "invalid_code"
+    context.record_call(call)
+    if key and call.cached:
+        context.cache.discard(key)
+    raise GenerationError(f"{label}: {len(invalid)} of {len(errors)} implementations failed validation: "
+                          + "; ".join(invalid))
+
+def _store_response(raw: str, key: Optional[str], call: CallRecord, valid_pairs: Any, count: int, salvaged: bool,
+                    label: str, context: GenerationContext) -> Any:
+    """Record a usable call and cache its response if it is fresh and produced valid pairs."""
+    call.outcome = ("salvaged" if salvaged else "ok") if count else "empty"
+    call.valid_pairs = count
+    context.record_call(call)
+    if key and not call.cached and valid_pairs:
+        context.cache.put(key, raw)
+    logger.info(f"{label}: Generated {count} valid pairs{' (cached)' if call.cached else ''}")
+    return valid_pairs
+
+def _parse_and_store(raw: str, key: Optional[str], call: CallRecord, fields: Tuple[str, str], label: str,
+                     context: GenerationContext, section_ids: Optional[List[str]] = None) -> Any:
+    """Parse a response, validate generated code, cache it if it is fresh and produced valid pairs, and record the call."""
+    valid_pairs, count, salvaged = _parse_response(raw, call, fields, label, context, section_ids)
+    if context.validator is not None and call.kind == "code_generation" and count:
+        errors = context.validator.check([pair[fields[1]] for pair in valid_pairs])
+        _reject_invalid_code(errors, key, call, label, context)
+    return _store_response(raw, key, call, valid_pairs, count, salvaged, label, context)
+
+async def _aparse_and_store(raw: str, key: Optional[str], call: CallRecord, fields: Tuple[str, str], label: str,
+                            context: GenerationContext, section_ids: Optional[List[str]] = None) -> Any:
+    """Async variant of _parse_and_store; code is validated without blocking the event loop."""
+    valid_pairs, count, salvaged = _parse_response(raw, call, fields, label, context, section_ids)
+    if context.validator is not None and call.kind == "code_generation" and count:
+        errors = await context.validator.acheck([pair[fields[1]] for pair in valid_pairs])
+        _reject_invalid_code(errors, key, call, label, context)
+    return _store_response(raw, key, call, valid_pairs, count, salvaged, label, context)
+
+def _generate_pairs(llm: ChatOpenAI, prompt: str, fields: Tuple[str, str], label: str, kind: str,
+                    context: Optional[GenerationContext] = None, section_ids: Optional[List[str]] = None) -> Any:
+    """Invoke the model (or the cache) and return the valid pairs.
+
+    With section_ids the prompt is a packed one and the valid pairs are
+    returned per section id. Every attempt is recorded in context.metrics
+    under kind. With context.structured_output the request carries a strict
+    JSON schema; if the API rejects it, the rest of the run falls back to
+    plain prompts, whose responses are salvaged by extract_json.
+
+    Raises GenerationError once retries are exhausted or the failure is not
+    retryable, so the caller can requeue the unit instead of checkpointing it.
+    """
+    context = context or GenerationContext()
+    scheduler = context.scheduler
+    raw, key = _lookup(llm, prompt, context.cache)
+    call = CallRecord(kind, label, model_name(llm), cached=raw is not None)
+    attempt = 0
+    while raw is None:
+        queued = time.monotonic()
+        ticket = scheduler.wait(prompt)
+        started = time.monotonic()
+        call = CallRecord(kind, label, model_name(llm), attempt, queue_wait=started - queued)
+        request_options = ({"response_format": response_format_for(fields, section_ids)}
+                           if context.structured_output else {})
+        try:
+            response = llm.invoke(prompt, **request_options)
+            raw = response.content
+            call.latency = time.monotonic() - started
+            scheduler.observe(call.latency, ticket=ticket)
+            context.count_usage(call, response, prompt)
+        except Exception as e:
+            call.latency = time.monotonic() - started
+            scheduler.observe(call.latency, e, ticket)
+            call.outcome, call.error = "error", type(e).__name__
+            context.record_call(call)
+            if request_options and is_unsupported_response_format(e):
+                logger.warning(f"{label}: Structured output is not supported, falling back to plain JSON responses")
+                context.structured_output = False
+                delay = 0.0
+            elif not is_retryable_error(e) or attempt >= scheduler.max_retries:
+                raise GenerationError(f"{label}: Error generating pairs: {e}") from e
+            else:
+                delay = scheduler.backoff(attempt, e)
+                logger.warning(f"{label}: {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{scheduler.max_retries})")
+            time.sleep(delay)
+            attempt += 1
+    return _parse_and_store(raw, key, call, fields, label, context, section_ids)
+
+async def _agenerate_pairs(llm: ChatOpenAI, prompt: str, fields: Tuple[str, str], label: str, kind: str,
+                           context: Optional[GenerationContext] = None, section_ids: Optional[List[str]] = None) -> Any:
+    """Async variant of _generate_pairs built on ainvoke."""
+    context = context or GenerationContext()
+    scheduler = context.scheduler
+    raw, key = _lookup(llm, prompt, context.cache)
+    call = CallRecord(kind, label, model_name(llm), cached=raw is not None)
+    attempt = 0
+    while raw is None:
+        queued = time.monotonic()
+        ticket = await scheduler.acquire(prompt)
+        started = time.monotonic()
+        call = CallRecord(kind, label, model_name(llm), attempt, queue_wait=started - queued)
+        request_options = ({"response_format": response_format_for(fields, section_ids)}
+                           if context.structured_output else {})
+        try:
+            response = await llm.ainvoke(prompt, **request_options)
+            raw = response.content
+            call.latency = time.monotonic() - started
+            scheduler.observe(call.latency, ticket=ticket)
+            context.count_usage(call, response, prompt)
+        except Exception as e:
+            call.latency = time.monotonic() - started
+            scheduler.observe(call.latency, e, ticket)
+            call.outcome, call.error = "error", type(e).__name__
+            context.record_call(call)
+            if request_options and is_unsupported_response_format(e):
+                logger.warning(f"{label}: Structured output is not supported, falling back to plain JSON responses")
+                context.structured_output = False
+                delay = 0.0
+            elif not is_retryable_error(e) or attempt >= scheduler.max_retries:
+                raise GenerationError(f"{label}: Error generating pairs: {e}") from e
+            else:
+                delay = scheduler.backoff(attempt, e)
+                logger.warning(f"{label}: {type(e).__name__}, retrying in {delay:.1f}s ({attempt + 1}/{scheduler.max_retries})")
+        finally:
+            await scheduler.release()
+        if raw is None:
+            await asyncio.sleep(delay)
+            attempt += 1
+    return await _aparse_and_store(raw, key, call, fields, label, context, section_ids)
+
+def generate_documentation_qa(llm: ChatOpenAI, content: str, chunk_index: int,
+                              context: Optional[GenerationContext] = None) -> List[Dict[str, str]]:
+    """Generate Q&A pairs for documentation chunks."""
+    logger.info(f"Generating documentation Q&A for chunk {chunk_index + 1}")
+    return _generate_pairs(llm, build_documentation_qa_prompt(content), QA_FIELDS, f"Chunk {chunk_index + 1}",
+                           "documentation", context)
+
+def generate_packed_documentation_qa(llm: ChatOpenAI, examples: List[TrainingExample],
+                                     context: Optional[GenerationContext] = None) -> Dict[str, List[Dict[str, str]]]:
+    """Generate Q&A pairs for several documentation chunks in one request, keyed by fingerprint."""
+    logger.info(f"Generating packed documentation Q&A for {len(examples)} chunks")
+    return _generate_pairs(llm, build_packed_documentation_qa_prompt(examples), QA_FIELDS,
+                           f"Packed chunks {examples[0].chunk_index + 1}-{examples[-1].chunk_index + 1}",
+                           "documentation_pack", context, [example.fingerprint() for example in examples])
+
+def generate_code_qa(llm: ChatOpenAI, content: str, source_file: str, chunk_index: int,
+                     context: Optional[GenerationContext] = None) -> List[Dict[str, str]]:
+    """Generate Q&A pairs for TypeScript code examples."""
+    logger.info(f"Generating code Q&A for {Path(source_file).name}")
+    return _generate_pairs(llm, build_code_qa_prompt(content), QA_FIELDS, f"Code example {chunk_index + 1}",
+                           "code_example", context)
+
+def generate_code_generation_examples(llm: ChatOpenAI, topic: str, context_examples: List[TrainingExample],
+                                      context: Optional[GenerationContext] = None) -> List[Dict[str, Any]]:
+    """Generate code generation instruction-following examples for one topic."""
+    logger.info(f"Generating code generation examples: {topic}")
+    return _generate_pairs(llm, build_code_generation_prompt(topic, context_examples), CODE_GENERATION_FIELDS,
+                           f"Code generation: {topic}", "code_generation", context)
+
+def generate_integration_examples(llm: ChatOpenAI, topic: str, context_examples: List[TrainingExample],
+                                  context: Optional[GenerationContext] = None) -> List[Dict[str, str]]:
+    """Generate integration and troubleshooting examples for one topic."""
+    logger.info(f"Generating integration and troubleshooting examples: {topic}")
+    return _generate_pairs(llm, build_integration_prompt(topic, context_examples), QA_FIELDS, f"Integration: {topic}",
+                           "integration", context)
+
+async def agenerate_documentation_qa(llm: ChatOpenAI, content: str, chunk_index: int,
+                                     context: Optional[GenerationContext] = None) -> List[Dict[str, str]]:
+    """Async variant of generate_documentation_qa built on ainvoke."""
+    logger.info(f"Generating documentation Q&A for chunk {chunk_index + 1}")
+    return await _agenerate_pairs(llm, build_documentation_qa_prompt(content), QA_FIELDS, f"Chunk {chunk_index + 1}",
+                                  "documentation", context)
+
+async def agenerate_packed_documentation_qa(llm: ChatOpenAI, examples: List[TrainingExample],
+                                            context: Optional[GenerationContext] = None) -> Dict[str, List[Dict[str, str]]]:
+    """Async variant of generate_packed_documentation_qa built on ainvoke."""
+    logger.info(f"Generating packed documentation Q&A for {len(examples)} chunks")
+    return await _agenerate_pairs(llm, build_packed_documentation_qa_prompt(examples), QA_FIELDS,
+                                  f"Packed chunks {examples[0].chunk_index + 1}-{examples[-1].chunk_index + 1}",
+                                  "documentation_pack", context, [example.fingerprint() for example in examples])
+
+async def agenerate_code_qa(llm: ChatOpenAI, content: str, source_file: str, chunk_index: int,
+                            context: Optional[GenerationContext] = None) -> List[Dict[str, str]]:
+    """Async variant of generate_code_qa built on ainvoke."""
+    logger.info(f"Generating code Q&A for {Path(source_file).name}")
+    return await _agenerate_pairs(llm, build_code_qa_prompt(content), QA_FIELDS, f"Code example {chunk_index + 1}",
+                                  "code_example", context)
+
+async def agenerate_code_generation_examples(llm: ChatOpenAI, topic: str, context_examples: List[TrainingExample],
+                                             context: Optional[GenerationContext] = None) -> List[Dict[str, Any]]:
+    """Async variant of generate_code_generation_examples built on ainvoke."""
+    logger.info(f"Generating code generation examples: {topic}")
+    return await _agenerate_pairs(llm, build_code_generation_prompt(topic, context_examples), CODE_GENERATION_FIELDS,
+                                  f"Code generation: {topic}", "code_generation", context)
+
+async def agenerate_integration_examples(llm: ChatOpenAI, topic: str, context_examples: List[TrainingExample],
+                                         context: Optional[GenerationContext] = None) -> List[Dict[str, str]]:
+    """Async variant of generate_integration_examples built on ainvoke."""
+    logger.info(f"Generating integration and troubleshooting examples: {topic}")
+    return await _agenerate_pairs(llm, build_integration_prompt(topic, context_examples), QA_FIELDS,
+                                  f"Integration: {topic}", "integration", context)
+
+@dataclass
+class WorkUnit:
+    """A single LLM request in the generation plan."""
+    kind: str  # 'documentation', 'code_example', 'integration', 'code_generation', 'documentation_pack'
+    ordinal: int  # start order within the current pass
+    key: str  # content fingerprint identifying the unit across runs
+    example: Optional[TrainingExample] = None
+    members: List[TrainingExample] = field(default_factory=list)  # chunks of a documentation_pack, or topic context
+    topic: Optional[str] = None  # seed of an integration or code_generation unit
+    position: int = 0  # position in the full canonical plan, the same across resumes and shards
+    member_positions: List[int] = field(default_factory=list)  # plan positions of a documentation_pack's chunks
+
+def shard_of(key: str, shard_count: int) -> int:
+    """Return the shard a unit belongs to, from its content fingerprint.
+
+    Depends only on the unit's content, so every worker agrees on the
+    assignment without coordination and it survives re-splitting the corpus.
+    """
+    return int(key, 16) % shard_count
+
+def shard_path(path: str, shard: Tuple[int, int]) -> str:
+    """Return the per-shard variant of a file path, e.g. out.shard0-of-4.jsonl or out.shard0-of-4.jsonl.gz."""
+    index, count = shard
+    base = output_base(path)
+    compressed_suffix = Path(path).suffix if compression_of(path) else ""
+    return str(base.with_name(f"{base.stem}.shard{index}-of-{count}{base.suffix}{compressed_suffix}"))
+
+def topic_units(all_examples: List[TrainingExample]) -> Iterator[Tuple[str, str, str, List[TrainingExample]]]:
+    """Yield (kind, topic, key, members) for every integration and code generation topic.
+
+    members is the context select_topic_context retrieves for the topic and
+    key the fingerprint of the prompt built from it.
+    """
+    index = get_lexical_index(all_examples)
+    for kind, topics, build_prompt in (
+        ("integration", INTEGRATION_TOPICS, build_integration_prompt),
+        ("code_generation", CODE_GENERATION_TOPICS, build_code_generation_prompt),
+    ):
+        for topic in topics:
+            members = select_topic_context(kind, topic, all_examples, index)
+            yield kind, topic, content_fingerprint(build_prompt(topic, members)), members
+
+def grounding_sources(all_examples: List[TrainingExample]) -> Dict[Tuple[str, str], str]:
+    """Map each unit's (kind, key) to the text its pairs should be grounded in, for QualityFilter.
+
+    Documentation and code example units are grounded in their own chunk,
+    topic units in the context retrieved for them.
+    """
+    sources = {(example.example_type, example.fingerprint()): example.content for example in all_examples}
+    for kind, _, key, members in topic_units(all_examples):
+        sources[(kind, key)] = "\n\n".join(member.content for member in members)
+    return sources
+
+def iter_work_units(examples: Iterable[TrainingExample], checkpoint: Checkpoint,
+                    shard: Optional[Tuple[int, int]] = None,
+                    collected: Optional[List[TrainingExample]] = None) -> Iterator[WorkUnit]:
+    """Yield the units still to be generated, in canonical order.
+
+    The order is docs, code examples, integration, code generation; it is the
+    order results are merged in regardless of how they are executed, and each
+    unit carries its position in it. Positions count every unit of the full
+    plan, including those already processed or assigned to other shards, so
+    they stay the same across resumes and shards. Units are
+    keyed by content fingerprint, so inserting or editing a chunk never shifts
+    the identity of the others, and identical chunks are generated once.
+    Integration and code generation get one unit per topic, each with the
+    context select_topic_context retrieves for it. With
+    shard as (index, count), only the units assigned to that shard by shard_of
+    are listed.
+
+    examples is consumed lazily: documentation units are yielded as their
+    chunks arrive, so generation can start while a streaming loader is still
+    reading. Code example units are held until examples is exhausted, and the
+    topic units, whose retrieval needs the whole corpus, come last. Every
+    example read is appended to collected, and once the plan is complete
+    checkpoint.planned_units is set to the size of the full plan.
+    """
+    def wanted(key: str) -> bool:
+        return shard is None or shard_of(key, shard[1]) == shard[0]
+
+    collected = [] if collected is None else collected
+    ordinal = position = 0
+    planned: Dict[str, Set[str]] = {kind: set() for kind in UNIT_KINDS}
+    processed = {"documentation": set(checkpoint.processed_chunks),
+                 "code_example": set(checkpoint.processed_code_examples),
+                 "integration": set(checkpoint.processed_integration),
+                 "code_generation": set(checkpoint.processed_code_generation)}
+
+    def plan(kind: str, key: str) -> Optional[int]:
+        """Assign the next plan position to a new unit; return it if the unit is still to run here."""
+        nonlocal position
+        if key in planned[kind]:
+            return None
+        planned[kind].add(key)
+        position += 1
+        return position - 1 if key not in processed[kind] and wanted(key) else None
+
+    code_examples: List[TrainingExample] = []
+    for example in examples:
+        collected.append(example)
+        if example.example_type == "code_example":
+            code_examples.append(example)
+            continue
+        if example.example_type != "documentation":
+            continue
+        key = example.fingerprint()
+        if (unit_position := plan("documentation", key)) is not None:
+            yield WorkUnit("documentation", ordinal, key, example, position=unit_position)
+            ordinal += 1
+    for example in code_examples:
+        key = example.fingerprint()
+        if (unit_position := plan("code_example", key)) is not None:
+            yield WorkUnit("code_example", ordinal, key, example, position=unit_position)
+            ordinal += 1
+    for kind, topic, key, members in topic_units(collected):
+        if (unit_position := plan(kind, key)) is not None:
+            yield WorkUnit(kind, ordinal, key, members=members, topic=topic, position=unit_position)
+            ordinal += 1
+    checkpoint.planned_units = position
+    shard_note = f" for shard {shard[0]} of {shard[1]}" if shard is not None else ""
+    logger.info(f"Planned {ordinal} of {position} units{shard_note} from {len(collected)} examples")
+
+def plan_work_units(all_examples: Iterable[TrainingExample], checkpoint: Checkpoint,
+                    shard: Optional[Tuple[int, int]] = None) -> List[WorkUnit]:
+    """List the units still to be generated, in canonical order (see iter_work_units)."""
+    return list(iter_work_units(all_examples, checkpoint, shard))
+
+def pack_work_units(units: Iterable[WorkUnit], token_budget: int,
+                    token_counter: Callable[[str], int] = estimate_tokens) -> Iterator[WorkUnit]:
+    """Bundle consecutive small documentation units into packed requests.
+
+    Documentation units are grouped greedily in plan order while the group's
+    total content stays within token_budget; chunks larger than the budget and
+    groups of one stay plain units. Packs are only an execution detail: their
+    pairs are attributed back and checkpointed per member chunk. units is
+    consumed lazily and the packed units are renumbered as they are yielded.
+    """
+    packed: List[WorkUnit] = []
+    group: List[WorkUnit] = []
+    group_tokens = 0
+    read = written = 0
+
+    def flush():
+        if len(group) == 1:
+            packed.append(group[0])
+        elif group:
+            key = content_fingerprint("\0".join(unit.key for unit in group))
+            packed.append(WorkUnit("documentation_pack", 0, key, members=[unit.example for unit in group],
+                                   position=group[0].position, member_positions=[unit.position for unit in group]))
+        group.clear()
+
+    for unit in itertools.chain(units, [None]):
+        if unit is None:
+            flush()
+        else:
+            read += 1
+            tokens = token_counter(unit.example.content) if unit.kind == "documentation" else token_budget + 1
+            if tokens > token_budget:
+                flush()
+                group_tokens = 0
+                packed.append(unit)
+            else:
+                if group_tokens + tokens > token_budget:
+                    flush()
+                    group_tokens = 0
+                group.append(unit)
+                group_tokens += tokens
+        for ready in packed:
+            yield replace(ready, ordinal=written)
+            written += 1
+        packed.clear()
+
+    logger.info(f"Packed {read} units into {written} requests (budget {token_budget} tokens)")
+
+def unpack(unit: WorkUnit) -> List[WorkUnit]:
+    """Split a documentation_pack back into one unit per member chunk."""
+    if unit.kind != "documentation_pack":
+        return [unit]
+    return [WorkUnit("documentation", 0, example.fingerprint(), example, position=position)
+            for example, position in zip(unit.members, unit.member_positions)]
+
+def unit_commits(unit: WorkUnit, result: Any) -> Tuple[List[Tuple[str, str, int, List[Dict[str, Any]]]], List[WorkUnit]]:
+    """Turn a unit's generated pairs into (kind, key, position, records) checkpoint entries.
+
+    Returns the entries and the units left to retry: members of a pack the
+    model returned no valid pairs for.
+    """
+    if unit.kind != "documentation_pack":
+        return [(unit.kind, unit.key, unit.position, to_training_records(unit.kind, result))], []
+    commits, leftovers = [], []
+    for member in unpack(unit):
+        if member.key in result:
+            commits.append((member.kind, member.key, member.position, to_training_records(member.kind, result[member.key])))
+        else:
+            leftovers.append(member)
+    return commits, leftovers
+
+def seed_from_previous_output(
+    checkpoint_manager: CheckpointManager,
+    checkpoint: Checkpoint,
+    all_examples: List[TrainingExample],
+    output_file: str,
+    shard: Optional[Tuple[int, int]] = None
+):
+    """Carry over records of unchanged units from a previous run's output.
+
+    Walks the previous manifest alongside its JSONL output. Units whose
+    fingerprint is still part of the plan are recorded on the checkpoint with
+    their existing records; units from removed or changed chunks are dropped,
+    so only added or changed chunks are left to generate.
+    """
+    manifest_path = manifest_path_for(output_file)
+    if not manifest_path.exists() or not Path(output_file).exists():
+        logger.warning(f"No previous manifest at {manifest_path}, rebuilding everything")
+        return
+
+    with open(manifest_path, 'r', encoding='utf-8') as f:
+        previous_manifest = json.load(f)["units"]
+
+    wanted = {(unit.kind, unit.key): unit.position for unit in plan_work_units(all_examples, empty_checkpoint(), shard)}
+    already = {(entry["kind"], entry["key"]) for entry in checkpoint.manifest}
+    kept_units = kept_records = dropped_units = dropped_records = 0
+
+    with open_jsonl(output_file) as f:
+        for entry in previous_manifest:
+            lines = (f.readline() for _ in range(entry["count"]))
+            unit_id = (entry["kind"], entry["key"])
+            if unit_id in wanted and unit_id not in already:
+                checkpoint_manager.record_unit(checkpoint, entry["kind"], entry["key"], wanted[unit_id],
+                                               (json.loads(line) for line in lines))
+                already.add(unit_id)
+                kept_units += 1
+                kept_records += entry["count"]
+            else:
+                for _ in lines:
+                    pass
+                if unit_id not in wanted:
+                    dropped_units += 1
+                    dropped_records += entry["count"]
+
+    logger.info(f"Incremental rebuild: kept {kept_records} examples from {kept_units} unchanged units, "
+                f"dropped {dropped_records} examples from {dropped_units} removed or changed units")
+
+def to_training_records(kind: str, items: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Convert generated pairs into chat-format training records."""
+    prompt_field, completion_field = CODE_GENERATION_FIELDS if kind == "code_generation" else QA_FIELDS
+    return [
+        {
+            "messages": [
+                {"role": "user", "content": item[prompt_field]},
+                {"role": "assistant", "content": item[completion_field]}
+            ]
+        }
+        for item in items
+    ]
+
+def build_unit_prompt(unit: WorkUnit) -> str:
+    """Render the prompt a unit sends to the model."""
+    if unit.kind == "documentation":
+        return build_documentation_qa_prompt(unit.example.content)
+    if unit.kind == "code_example":
+        return build_code_qa_prompt(unit.example.content)
+    if unit.kind == "documentation_pack":
+        return build_packed_documentation_qa_prompt(unit.members)
+    if unit.kind == "integration":
+        return build_integration_prompt(unit.topic, unit.members)
+    return build_code_generation_prompt(unit.topic, unit.members)
+
+# Pairs each prompt asks for, per unit kind (per section for a documentation_pack)
+REQUESTED_PAIRS = {"documentation": 3, "documentation_pack": 3, "code_example": 4,
+                   "integration": TOPIC_PAIRS, "code_generation": TOPIC_PAIRS}
+DEFAULT_CHEAP_KINDS = ("documentation", "documentation_pack", "code_example")
+
+def count_pairs(result: Any) -> int:
+    """Return the number of valid pairs in a unit result (a list, or a dict of lists for packs)."""
+    return sum(len(pairs) for pairs in result.values()) if isinstance(result, dict) else len(result)
+
+def requested_pairs(unit: WorkUnit) -> int:
+    """Return the number of pairs a unit's prompt asks for."""
+    return REQUESTED_PAIRS[unit.kind] * (len(unit.members) if unit.kind == "documentation_pack" else 1)
+
+class ModelRouter:
+    """Sends units to a cheaper model where it is likely to do as well as the strong one.
+
+    A unit is routed to cheap_llm if its kind is in cheap_kinds, its prompt is
+    at most max_cheap_tokens long, and in earlier runs the cheap model
+    succeeded on that kind at least min_success_rate of the time. Success
+    means the response validated and carried every requested pair. Earlier
+    runs are read from their metrics file (observe_history), and a kind with
+    fewer than min_samples earlier outcomes is routed so the rate can be
+    learned. Decisions depend only on that history, never on the order units
+    finish in, so sync, async and sharded runs route the same units.
+
+    run_unit discards a cheap result that fails validation or comes back
+    short and runs the unit again on the strong model, so routing trades a
+    wasted cheap call for the strong model's cost but never loses pairs.
+    """
+
+    def __init__(self, strong_llm: ChatOpenAI, cheap_llm: ChatOpenAI, cheap_kinds: Iterable[str] = DEFAULT_CHEAP_KINDS,
+                 max_cheap_tokens: int = 2000, min_success_rate: float = 0.9, min_samples: int = 20):
+        self.strong_llm = strong_llm
+        self.cheap_llm = cheap_llm
+        self.cheap_kinds = set(cheap_kinds)
+        self.max_cheap_tokens = max_cheap_tokens
+        self.min_success_rate = min_success_rate
+        self.min_samples = min_samples
+        self._history: Dict[str, List[int]] = {}  # kind -> [successes, trials] in earlier runs
+        self.routed: Dict[str, int] = {}
+        self.fallbacks: Dict[str, int] = {}
+
+    def observe_history(self, metrics: CallMetrics):
+        """Learn the cheap model's success rate per kind from a previous run's metrics.
+
+        Cache hits and API errors say nothing about the model's answers and
+        are skipped. A packed call counts as a success if it carried at least
+        the pairs requested of one section.
+        """
+        observed = 0
+        for call in metrics.records():
+            if call.model == model_name(self.cheap_llm) and not call.cached and call.outcome != "error":
+                outcome = self._history.setdefault(call.kind, [0, 0])
+                outcome[0] += call.outcome in ("ok", "salvaged") and call.valid_pairs >= REQUESTED_PAIRS.get(call.kind, 1)
+                outcome[1] += 1
+                observed += 1
+        if observed:
+            logger.info(f"Model routing: learned from {observed} earlier {model_name(self.cheap_llm)} calls")
+
+    def success_rate(self, kind: str) -> Optional[float]:
+        """Return the cheap model's earlier success rate on a kind, or None below min_samples outcomes."""
+        successes, trials = self._history.get(kind, (0, 0))
+        return successes / trials if trials >= self.min_samples else None
+
+    def route(self, unit: WorkUnit, prompt_tokens: int) -> Optional[ChatOpenAI]:
+        """Return the cheap model if the unit should try it first, else None."""
+        if unit.kind not in self.cheap_kinds or prompt_tokens > self.max_cheap_tokens:
+            return None
+        rate = self.success_rate(unit.kind)
+        if rate is not None and rate < self.min_success_rate:
+            return None
+        self.routed[unit.kind] = self.routed.get(unit.kind, 0) + 1
+        return self.cheap_llm
+
+    def accept(self, unit: WorkUnit, result: Any) -> bool:
+        """Return True if a cheap result carries every requested pair."""
+        if count_pairs(result) >= requested_pairs(unit):
+            return True
+        self.fallbacks[unit.kind] = self.fallbacks.get(unit.kind, 0) + 1
+        logger.warning(f"{unit.kind} {unit.key}: {model_name(self.cheap_llm)} returned {count_pairs(result)} of "
+                       f"{requested_pairs(unit)} pairs, retrying with {model_name(self.strong_llm)}")
+        return False
+
+    def reject(self, unit: WorkUnit, error: GenerationError):
+        """Count a cheap call that failed validation or exhausted its retries."""
+        self.fallbacks[unit.kind] = self.fallbacks.get(unit.kind, 0) + 1
+        logger.warning(f"{error}; retrying with {model_name(self.strong_llm)}")
+
+    def log_stats(self):
+        """Log how many units of each kind went to the cheap model and how many fell back."""
+        if not self.routed:
+            logger.info(f"Model routing: no units were sent to {model_name(self.cheap_llm)}")
+            return
+        logger.info(f"Model routing ({model_name(self.cheap_llm)} first, {model_name(self.strong_llm)} as fallback):")
+        for kind, routed in sorted(self.routed.items()):
+            logger.info(f"  {kind}: {routed} units routed, {self.fallbacks.get(kind, 0)} fell back")
+        for kind in sorted(self.cheap_kinds - set(self.routed)):
+            rate = self.success_rate(kind)
+            if rate is not None and rate < self.min_success_rate:
+                logger.info(f"  {kind}: not routed, earlier success rate {rate:.0%}")
+
+def _invoke_unit(llm: ChatOpenAI, unit: WorkUnit, context: Optional[GenerationContext]) -> Any:
+    if unit.kind == "documentation":
+        return generate_documentation_qa(llm, unit.example.content, unit.example.chunk_index, context)
+    if unit.kind == "code_example":
+        return generate_code_qa(llm, unit.example.content, unit.example.source_file, unit.example.chunk_index, context)
+    if unit.kind == "documentation_pack":
+        return generate_packed_documentation_qa(llm, unit.members, context)
+    if unit.kind == "integration":
+        return generate_integration_examples(llm, unit.topic, unit.members, context)
+    return generate_code_generation_examples(llm, unit.topic, unit.members, context)
+
+async def _ainvoke_unit(llm: ChatOpenAI, unit: WorkUnit, context: Optional[GenerationContext]) -> Any:
+    if unit.kind == "documentation":
+        return await agenerate_documentation_qa(llm, unit.example.content, unit.example.chunk_index, context)
+    if unit.kind == "code_example":
+        return await agenerate_code_qa(llm, unit.example.content, unit.example.source_file, unit.example.chunk_index, context)
+    if unit.kind == "documentation_pack":
+        return await agenerate_packed_documentation_qa(llm, unit.members, context)
+    if unit.kind == "integration":
+        return await agenerate_integration_examples(llm, unit.topic, unit.members, context)
+    return await agenerate_code_generation_examples(llm, unit.topic, unit.members, context)
+
+def run_unit(llm: ChatOpenAI, unit: WorkUnit, context: Optional[GenerationContext] = None) -> List[Dict[str, Any]]:
+    """Generate the raw pairs for one unit.
+
+    With a ModelRouter on the context the unit may try the cheap model first;
+    llm is the strong model it falls back to.
+    """
+    router = context.router if context is not None else None
+    if router is not None:
+        cheap_llm = router.route(unit, context.token_counter(build_unit_prompt(unit)))
+        if cheap_llm is not None:
+            try:
+                result = _invoke_unit(cheap_llm, unit, context)
+                if router.accept(unit, result):
+                    return result
+            except GenerationError as e:
+                router.reject(unit, e)
+    return _invoke_unit(llm, unit, context)
+
+async def arun_unit(llm: ChatOpenAI, unit: WorkUnit, context: Optional[GenerationContext] = None) -> List[Dict[str, Any]]:
+    """Async variant of run_unit."""
+    router = context.router if context is not None else None
+    if router is not None:
+        cheap_llm = router.route(unit, context.token_counter(build_unit_prompt(unit)))
+        if cheap_llm is not None:
+            try:
+                result = await _ainvoke_unit(cheap_llm, unit, context)
+                if router.accept(unit, result):
+                    return result
+            except GenerationError as e:
+                router.reject(unit, e)
+    return await _ainvoke_unit(llm, unit, context)
+
+# Rough completion length of one generated pair, used to rank units by cost
+COMPLETION_TOKENS_PER_PAIR = 150
+
+def estimate_unit_tokens(unit: WorkUnit, token_counter: Callable[[str], int] = estimate_tokens) -> int:
+    """Estimate the prompt plus completion tokens a unit's request costs."""
+    return token_counter(build_unit_prompt(unit)) + requested_pairs(unit) * COMPLETION_TOKENS_PER_PAIR
+
+class WorkQueue:
+    """Hands out the units of a pass in the order they should be started.
+
+    Without a cost function units come lazily in plan order, so a streaming
+    plan starts running before it is complete. With one, the whole plan is
+    read into a heap and the costliest unit comes first (longest processing
+    time first), so the large one-off topic prompts no longer start last and
+    stretch the tail of the run. Equal costs keep plan order.
+    """
+
+    def __init__(self, units: Iterable[WorkUnit], cost: Optional[Callable[[WorkUnit], int]] = None):
+        self.prioritized = cost is not None
+        self._units = iter(units)
+        self._heap: List[Tuple[int, int, WorkUnit]] = []
+        if cost is not None:
+            self._heap = [(-cost(unit), unit.ordinal, unit) for unit in self._units]
+            heapq.heapify(self._heap)
+
+    def pop(self) -> Optional[WorkUnit]:
+        """Return the next unit to start, or None when the queue is empty."""
+        if not self.prioritized:
+            return next(self._units, None)
+        return heapq.heappop(self._heap)[2] if self._heap else None
+
+def _ignore_shutdown_signals():
+    """Process pool initializer: leave SIGINT and SIGTERM to the parent, which drains the pool."""
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, signal.SIG_IGN)
+
+class GracefulShutdown:
+    """Turns SIGINT and SIGTERM into a request to stop starting new units.
+
+    While installed, the first signal only sets signum: the orchestrators
+    stop taking units, let the requests in flight finish and journal them,
+    and return. A second signal raises KeyboardInterrupt to abort at once.
+    Handlers can only be installed from the main thread; elsewhere this is
+    a no-op.
+    """
+
+    def __init__(self):
+        self.signum: Optional[int] = None
+        self._previous: Dict[int, Any] = {}
+
+    @property
+    def requested(self) -> bool:
+        return self.signum is not None
+
+    def _handle(self, signum: int, frame: Any):
+        if self.requested:
+            raise KeyboardInterrupt
+        self.signum = signum
+        logger.warning(f"Received {signal.Signals(signum).name}, finishing requests in flight; "
+                       "send it again to abort immediately")
+
+    def __enter__(self) -> "GracefulShutdown":
+        if threading.current_thread() is threading.main_thread():
+            for signum in (signal.SIGINT, signal.SIGTERM):
+                self._previous[signum] = signal.signal(signum, self._handle)
+        return self
+
+    def __exit__(self, *exc_info):
+        for signum, handler in self._previous.items():
+            signal.signal(signum, handler)
+        self._previous.clear()
+
+def requeue(failed: List[WorkUnit]) -> List[WorkUnit]:
+    """Renumber failed units for another pass, retrying packed chunks one by one."""
+    return [replace(unit, ordinal=i) for i, unit in enumerate(member for unit in failed for member in unpack(unit))]
+
 def create_comprehensive_training_data_with_checkpoints(
-    all_examples: List[TrainingExample], 
+    all_examples: Iterable[TrainingExample],
     llm: ChatOpenAI,
-    checkpoint_manager: CheckpointManager
-) -> List[Dict[str, Any]]:
-    """Create comprehensive training data from all sources with checkpointing."""
-    
+    checkpoint_manager: CheckpointManager,
+    context: Optional[GenerationContext] = None,
+    incremental_from: Optional[str] = None,
+    retry_passes: int = 1,
+    pack_tokens: int = 0,
+    shard: Optional[Tuple[int, int]] = None
+) -> Checkpoint:
+    """Create comprehensive training data from all sources with checkpointing.
+
+    Records are streamed to the checkpoint manager's partial output as each
+    unit completes; call finalize_output on the returned checkpoint to publish
+    it. With incremental_from, unchanged units are carried over from that
+    previous output instead of being regenerated.
+
+    Units that raise GenerationError are not checkpointed. They are queued and
+    retried for up to retry_passes further passes; any still failing are left
+    in checkpoint.failed_units and will be planned again on the next run.
+
+    With pack_tokens, small documentation chunks are bundled into packed
+    requests of up to that many content tokens (see pack_work_units). With
+    shard as (index, count), only that shard's units are generated; combine
+    the shard outputs with merge_shard_outputs.
+
+    all_examples may be a lazy iterable such as load_corpus returns with
+    --stream-docs: units are planned as it is read (see iter_work_units), so
+    generation starts on the first chunks while the rest are still being
+    split. incremental_from needs the whole corpus up front and reads it first.
+
+    When the context's GracefulShutdown is triggered, the unit in flight is
+    finished and journaled and no further units are started; the remaining
+    ones are planned again by the next run.
+    """
+    context = context or GenerationContext()
+
     # Load existing checkpoint
     checkpoint = checkpoint_manager.load_checkpoint()
-    training_data = checkpoint.training_data
-    
-    logger.info(f"Starting to generate comprehensive training data from {len(all_examples)} examples")
-    logger.info(f"Resuming from checkpoint: {len(training_data)} examples already generated")
-    
-    # Process documentation examples
-    doc_examples = [ex for ex in all_examples if ex.example_type == "documentation"]
-    for i, example in enumerate(doc_examples):
-        # Skip if already processed
-        if example.chunk_index in checkpoint.processed_chunks:
-            logger.info(f"Skipping already processed documentation chunk {i + 1}/{len(doc_examples)}")
-            continue
-            
-        logger.info(f"Processing documentation chunk {i + 1}/{len(doc_examples)}")
-        pairs = generate_documentation_qa(llm, example.content, example.chunk_index)
-        
-        for pair in pairs:
-            training_data.append({
-                "messages": [
-                    {"role": "user", "content": pair["question"]},
-                    {"role": "assistant", "content": pair["answer"]}
-                ]
-            })
-        
-        # Update checkpoint
-        checkpoint.processed_chunks.append(example.chunk_index)
-        checkpoint.training_data = training_data
-        checkpoint.timestamp = datetime.now().isoformat()
-        checkpoint_manager.save_checkpoint(checkpoint)
-    
-    # Process code examples
-    code_examples = [ex for ex in all_examples if ex.example_type == "code_example"]
-    for i, example in enumerate(code_examples):
-        # Skip if already processed
-        if example.source_file in checkpoint.processed_code_examples:
-            logger.info(f"Skipping already processed code example {i + 1}/{len(code_examples)}: {Path(example.source_file).name}")
-            continue
-            
-        logger.info(f"Processing code example {i + 1}/{len(code_examples)}: {Path(example.source_file).name}")
-        pairs = generate_code_qa(llm, example.content, example.source_file, example.chunk_index)
-        
-        for pair in pairs:
-            training_data.append({
-                "messages": [
-                    {"role": "user", "content": pair["question"]},
-                    {"role": "assistant", "content": pair["answer"]}
-                ]
-            })
-        
-        # Update checkpoint
-        checkpoint.processed_code_examples.append(example.source_file)
-        checkpoint.training_data = training_data
-        checkpoint.timestamp = datetime.now().isoformat()
-        checkpoint_manager.save_checkpoint(checkpoint)
-    
-    # Generate integration examples (only once)
-    if not checkpoint.integration_generated:
-        logger.info("Generating integration examples...")
-        integration_pairs = generate_integration_examples(llm, all_examples)
-        for pair in integration_pairs:
-            training_data.append({
-                "messages": [
-                    {"role": "user", "content": pair["question"]},
-                    {"role": "assistant", "content": pair["answer"]}
-                ]
-            })
-        
-        checkpoint.integration_generated = True
-        checkpoint.training_data = training_data
-        checkpoint.timestamp = datetime.now().isoformat()
-        checkpoint_manager.save_checkpoint(checkpoint)
-    
-    # Generate code generation examples (only once)
-    if not checkpoint.code_generation_generated:
-        logger.info("Generating code generation examples...")
-        code_gen_examples = generate_code_generation_examples(llm, all_examples)
-        for example in code_gen_examples:
-            training_data.append({
-                "messages": [
-                    {"role": "user", "content": example["instruction"]},
-                    {"role": "assistant", "content": example["implementation"]}
-                ]
-            })
-        
-        checkpoint.code_generation_generated = True
-        checkpoint.training_data = training_data
-        checkpoint.timestamp = datetime.now().isoformat()
-        checkpoint_manager.save_checkpoint(checkpoint)
-    
-    return training_data
+    if incremental_from:
+        all_examples = list(all_examples)
+        seed_from_previous_output(checkpoint_manager, checkpoint, all_examples, incremental_from, shard)
+
+    logger.info("Starting to generate comprehensive training data")
+    logger.info(f"Resuming from checkpoint: {checkpoint.stats.total} examples already generated")
+
+    units: Iterable[WorkUnit] = iter_work_units(all_examples, checkpoint, shard)
+    if pack_tokens:
+        units = pack_work_units(units, pack_tokens, context.token_counter)
+    for attempt in range(retry_passes + 1):
+        if attempt:
+            logger.info(f"Retrying {len(units)} failed units (pass {attempt}/{retry_passes})")
+        failed = []
+        for i, unit in enumerate(units):
+            if context.stopping():
+                break
+            logger.info(f"Processing {unit.kind} unit {i + 1}")
+            try:
+                commits, leftovers = unit_commits(unit, run_unit(llm, unit, context))
+            except GenerationError as e:
+                logger.error(str(e))
+                failed.append(unit)
+                continue
+            for kind, key, position, records in commits:
+                checkpoint_manager.record_unit(checkpoint, kind, key, position, records)
+            failed.extend(leftovers)
+        units = requeue(failed)
+        if not units or context.stopping():
+            break
+
+    checkpoint.failed_units = [{"kind": unit.kind, "key": unit.key} for unit in units]
+    checkpoint_manager.close()
+    return checkpoint
+
+async def acreate_comprehensive_training_data_with_checkpoints(
+    all_examples: Iterable[TrainingExample],
+    llm: ChatOpenAI,
+    checkpoint_manager: CheckpointManager,
+    max_concurrency: int = 8,
+    context: Optional[GenerationContext] = None,
+    incremental_from: Optional[str] = None,
+    retry_passes: int = 1,
+    pack_tokens: int = 0,
+    shard: Optional[Tuple[int, int]] = None,
+    longest_first: bool = False
+) -> Checkpoint:
+    """Concurrent variant of create_comprehensive_training_data_with_checkpoints.
 
-def save_training_data(training_data: List[Dict[str, Any]], output_file: str = "comprehensive_training.jsonl"):
-    """Save training data to JSONL file with detailed statistics."""
-    logger.info(f"Saving {len(training_data)} training examples to {output_file}")
+    Doc chunks, code examples and the one-off integration and code generation
+    prompts all run at once; the context's RequestScheduler decides how many
+    are in flight, up to max_concurrency. At most 2 * max_concurrency units
+    are started at a time, and each is journaled as soon as it completes, so
+    nothing is buffered and an interruption loses at most the units in
+    flight. Units carry their plan position, and finalize_output writes them
+    back in plan order, so the published output matches a sequential run.
+    Failed units are retried in later passes.
+
+    With longest_first, each pass is read into a WorkQueue and units start in
+    order of estimate_unit_tokens, costliest first.
+
+    On a GracefulShutdown no further units are started and the requests in
+    flight finish and are journaled.
+    """
+    context = context or GenerationContext(scheduler=RequestScheduler(max_concurrency))
+    checkpoint = checkpoint_manager.load_checkpoint()
+    if incremental_from:
+        all_examples = list(all_examples)
+        seed_from_previous_output(checkpoint_manager, checkpoint, all_examples, incremental_from, shard)
+
+    logger.info("Starting to generate comprehensive training data")
+    logger.info(f"Resuming from checkpoint: {checkpoint.stats.total} examples already generated")
+
+    window = 2 * max_concurrency
+
+    async def run(unit: WorkUnit) -> Tuple[WorkUnit, Any]:
+        try:
+            return unit, unit_commits(unit, await arun_unit(llm, unit, context))
+        except GenerationError as e:
+            logger.error(str(e))
+            return unit, None
+
+    def cost(unit: WorkUnit) -> int:
+        return estimate_unit_tokens(unit, context.token_counter)
+
+    async def run_pass(units: Iterable[WorkUnit]) -> List[WorkUnit]:
+        # Without longest_first units are pulled lazily, so a streaming plan starts running before it is complete
+        queue = WorkQueue(units, cost if longest_first else None)
+        failed: List[WorkUnit] = []
+        exhausted = False
+        pending = set()
+        try:
+            while True:
+                while not exhausted and not context.stopping() and len(pending) < window:
+                    unit = queue.pop()
+                    if unit is None:
+                        exhausted = True
+                        break
+                    pending.add(asyncio.create_task(run(unit)))
+                if not pending:
+                    break
+
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for finished in done:
+                    unit, outcome = finished.result()
+                    if outcome is None:
+                        failed.append(unit)
+                        continue
+                    commits, leftovers = outcome
+                    for kind, key, position, records in commits:
+                        checkpoint_manager.record_unit(checkpoint, kind, key, position, records)
+                    failed.extend(leftovers)
+        finally:
+            for task in pending:
+                task.cancel()
+        return sorted(failed, key=lambda unit: unit.position)
+
+    units: Iterable[WorkUnit] = iter_work_units(all_examples, checkpoint, shard)
+    if pack_tokens:
+        units = pack_work_units(units, pack_tokens, context.token_counter)
+    logger.info(f"Running units with concurrency up to {max_concurrency}")
+    try:
+        for attempt in range(retry_passes + 1):
+            if attempt:
+                logger.info(f"Retrying {len(units)} failed units (pass {attempt}/{retry_passes})")
+            units = requeue(await run_pass(units))
+            if not units or context.stopping():
+                break
+    finally:
+        checkpoint_manager.close()
+
+    checkpoint.failed_units = [{"kind": unit.kind, "key": unit.key} for unit in units]
+    return checkpoint
+
+def save_training_data(training_data: Iterable[Dict[str, Any]], output_file: str = "comprehensive_training.jsonl",
+                       manifest: Optional[List[Dict[str, Any]]] = None,
+                       planned_units: Optional[int] = None) -> TrainingDataStats:
+    """Stream training data to a JSONL file and log detailed statistics.
+
+    The file is compressed according to its suffix and gets an offset index
+    next to it (see JsonlWriter). Statistics are accumulated while writing,
+    so training_data may be any iterable and is consumed in a single pass. When a manifest is given it is
+    written next to the output so a later incremental run can attribute each
+    record to its source unit, along with planned_units if given (see
+    write_manifest).
+    """
+    logger.info(f"Saving training examples to {output_file}")
+    stats = TrainingDataStats()
     
     try:
-        with open(output_file, "w", encoding="utf-8") as f:
+        with JsonlWriter(output_file) as writer:
             for item in training_data:
-                f.write(json.dumps(item, ensure_ascii=False) + '\n')
-        
-        logger.info(f"Successfully saved training data to {output_file}")
-        
-        # Print comprehensive summary statistics
-        logger.info("=== COMPREHENSIVE TRAINING DATA SUMMARY ===")
-        logger.info(f"Total training examples: {len(training_data)}")
+                writer.write(item)
+                stats.add(item)
         
-        # Analyze question types
-        question_types = {}
-        code_generation_count = 0
+        if manifest is not None:
+            write_manifest(output_file, manifest, planned_units)
         
-        for item in training_data:
-            user_content = item["messages"][0]["content"].lower()
-            
-            # Check for code generation instructions
-            if any(word in user_content for word in ["create", "implement", "build", "write", "generate", "make"]):
-                if any(word in user_content for word in ["component", "function", "class", "code", "app", "template"]):
-                    code_generation_count += 1
-                    continue
-            
-            # Categorize other questions
-            if "how" in user_content:
-                question_types["how"] = question_types.get("how", 0) + 1
-            elif "what" in user_content:
-                question_types["what"] = question_types.get("what", 0) + 1
-            elif "why" in user_content:
-                question_types["why"] = question_types.get("why", 0) + 1
-            elif "when" in user_content:
-                question_types["when"] = question_types.get("when", 0) + 1
-            elif "error" in user_content or "debug" in user_content or "troubleshoot" in user_content:
-                question_types["troubleshooting"] = question_types.get("troubleshooting", 0) + 1
-            elif "integrate" in user_content or "setup" in user_content or "install" in user_content:
-                question_types["integration"] = question_types.get("integration", 0) + 1
-            else:
-                question_types["other"] = question_types.get("other", 0) + 1
-        
-        logger.info(f"Code generation examples: {code_generation_count}")
-        for q_type, count in question_types.items():
-            logger.info(f"Questions with '{q_type}': {count}")
-        
-        # Check for code-related questions
-        code_questions = sum(1 for item in training_data 
-                           if any(word in item["messages"][0]["content"].lower() 
-                                 for word in ["code", "component", "import", "export", "function", "class"]))
-        logger.info(f"Code-related questions: {code_questions}")
+        logger.info(f"Successfully saved {stats.total} training examples to {output_file}")
+        stats.log_summary()
+        return stats
         
     except Exception as e:
         logger.error(f"Error saving training data: {e}")
         raise
 
-def main():
-    """Main function to orchestrate the comprehensive fine-tuning data generation."""
+def batch_custom_id(unit: WorkUnit) -> str:
+    """Return the stable batch request id of a unit."""
+    return f"{unit.kind}-{unit.key}"
+
+def export_batch_requests(all_examples: List[TrainingExample], requests_file: str, model: str = DEFAULT_MODEL,
+                          structured_output: bool = False) -> int:
+    """Write every unit's prompt as a chat completions batch request JSONL.
+
+    Each line carries a custom_id derived from the unit's content fingerprint,
+    so results can be matched back even if the corpus is re-split in between.
+    With structured_output each request carries a strict JSON schema.
+    Returns the number of requests written.
+    """
+    units = plan_work_units(all_examples, empty_checkpoint())
+    with open(requests_file, "w", encoding="utf-8") as f:
+        for unit in units:
+            request = {
+                "custom_id": batch_custom_id(unit),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": {
+                    "model": model,
+                    "messages": [{"role": "user", "content": build_unit_prompt(unit)}]
+                }
+            }
+            if structured_output:
+                fields = CODE_GENERATION_FIELDS if unit.kind == "code_generation" else QA_FIELDS
+                request["body"]["response_format"] = response_format_for(fields)
+            f.write(json.dumps(request, ensure_ascii=False) + '\n')
+    logger.info(f"Wrote {len(units)} batch requests to {requests_file}")
+    return len(units)
+
+def _batch_response_content(result: Dict[str, Any]) -> str:
+    """Extract the completion text from one batch result line."""
+    if result.get("error"):
+        raise GenerationError(f"{result['custom_id']}: Batch request failed: {result['error']}")
+    response = result.get("response") or {}
+    if response.get("status_code") != 200:
+        raise GenerationError(f"{result['custom_id']}: Batch request returned status {response.get('status_code')}")
+    return response["body"]["choices"][0]["message"]["content"]
+
+def ingest_batch_results(
+    all_examples: List[TrainingExample],
+    results_file: str,
+    output_file: str = "comprehensive_training.jsonl",
+    model: str = DEFAULT_MODEL,
+    cache: Optional[ResponseCache] = None,
+    dedup: Optional[NearDuplicateFilter] = None,
+    validator: Optional[CodeValidator] = None,
+    quality: Optional[QualityFilter] = None,
+    shard: Optional[Tuple[int, int]] = None
+) -> TrainingDataStats:
+    """Validate batch results and save them as training data.
+
+    Results are indexed by custom_id with their file offsets and then read back
+    in canonical plan order, so the output matches an interactive run without
+    holding every response in memory. Valid responses are also stored in the
+    response cache, keyed as if they had been requested interactively. With
+    quality and dedup, low-quality and near-duplicate records are dropped
+    before they are saved; with a validator, code generation units whose
+    implementations fail validation are reported as failed like any other
+    unusable result. With shard as (index, count), only that shard's units
+    are ingested, into a shard output that merge_shard_outputs can combine.
+    """
+    offsets: Dict[str, int] = {}
+    with open(results_file, "rb") as f:
+        while True:
+            offset = f.tell()
+            line = f.readline()
+            if not line:
+                break
+            if line.strip():
+                offsets[json.loads(line)["custom_id"]] = offset
+    logger.info(f"Indexed {len(offsets)} batch results from {results_file}")
+
+    plan = empty_checkpoint()
+    units = plan_work_units(all_examples, plan, shard)
+    manifest: List[Dict[str, Any]] = []
+    failed: List[str] = []
+
+    def items():
+        with open(results_file, "rb") as f:
+            for unit in units:
+                custom_id = batch_custom_id(unit)
+                if custom_id not in offsets:
+                    failed.append(f"{custom_id} (missing)")
+                    continue
+                f.seek(offsets[custom_id])
+                try:
+                    raw = _batch_response_content(json.loads(f.readline()))
+                    prompt = build_unit_prompt(unit)
+                    fields = CODE_GENERATION_FIELDS if unit.kind == "code_generation" else QA_FIELDS
+                    key = cache.make_key(model, prompt) if cache is not None else None
+                    context = GenerationContext(cache=cache, validator=validator)
+                    call = CallRecord(unit.kind, custom_id, model)
+                    unit_records = to_training_records(unit.kind, _parse_and_store(raw, key, call, fields, custom_id, context))
+                except (GenerationError, KeyError, IndexError, TypeError) as e:
+                    logger.error(f"{custom_id}: {e}")
+                    failed.append(custom_id)
+                    continue
+                entry = {"kind": unit.kind, "key": unit.key, "count": 0, "position": unit.position}
+                manifest.append(entry)
+                for record in unit_records:
+                    yield entry, unit.kind, unit.key, record
+
+    def records():
+        # Counts are filled in as records are kept; the manifest is complete once
+        # save_training_data has consumed this generator
+        for entry, record in filter_batches(items(), quality, dedup):
+            entry["count"] += 1
+            yield record
+
+    stats = save_training_data(records(), output_file, manifest, plan.planned_units)
+    if quality is not None:
+        quality.log_summary()
+        quality.write_review(low_quality_path_for(output_file))
+    if dedup is not None:
+        dedup.log_summary()
+    if failed:
+        logger.warning(f"{len(failed)} of {len(units)} batch units had no usable result: {', '.join(failed)}")
+    return stats
+
+def merge_shard_outputs(
+    shard_outputs: List[str],
+    output_file: str = "comprehensive_training.jsonl",
+    dedup: Optional[NearDuplicateFilter] = None,
+    allow_missing: bool = False
+) -> TrainingDataStats:
+    """Combine shard outputs into one output in canonical plan order.
+
+    Each shard's manifest gives every unit's plan position and the position
+    of its first record in the shard output, which is opened through its
+    offset index; records are then read back unit by unit sorted by plan
+    position, so the merged file matches a single-process run no matter how
+    units were spread over shards, and the corpus is never loaded. Shards
+    apply the quality thresholds themselves; their low-quality review files
+    are combined in plan order. With dedup, near duplicates are dropped
+    across all shards.
+
+    Raises ValueError if a shard manifest has no plan positions, if the
+    shards were planned from different corpora, or if planned units are
+    missing from every shard, unless allow_missing is set.
+    """
+    index: Dict[Tuple[str, str], Tuple[int, int, int, int]] = {}
+    planned: Set[int] = set()
+    readers: List[IndexedJsonl] = []
+    try:
+        for shard_number, shard_output in enumerate(shard_outputs):
+            with open(manifest_path_for(shard_output), 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            shard_manifest = data["units"]
+            if "planned_units" not in data or any("position" not in entry for entry in shard_manifest):
+                raise ValueError(f"{shard_output} has no plan positions; generate the shard again")
+            planned.add(data["planned_units"])
+            readers.append(IndexedJsonl(shard_output))
+            if sum(entry["count"] for entry in shard_manifest) != len(readers[shard_number]):
+                raise ValueError(f"{shard_output} does not match its manifest")
+            first = 0
+            for entry in shard_manifest:
+                unit_id = (entry["kind"], entry["key"])
+                if unit_id in index:
+                    logger.warning(f"{shard_output}: {entry['kind']} {entry['key']} is also in an earlier shard, skipping")
+                else:
+                    index[unit_id] = (entry["position"], shard_number, first, entry["count"])
+                first += entry["count"]
+            logger.info(f"Indexed {len(shard_manifest)} units from {shard_output}")
+        if len(planned) > 1:
+            raise ValueError(f"Shard outputs were planned from different corpora ({', '.join(map(str, sorted(planned)))} units)")
+
+        planned_units = planned.pop() if planned else 0
+        missing = sorted(set(range(planned_units)) - {position for position, _, _, _ in index.values()})
+        if missing:
+            message = f"{len(missing)} of {planned_units} units are missing from the shard outputs"
+            if not allow_missing:
+                raise ValueError(f"{message}: plan positions {', '.join(map(str, missing[:10]))}"
+                                 f"{' ...' if len(missing) > 10 else ''}")
+            logger.warning(message)
+
+        units = sorted(index.items(), key=lambda item: item[1][0])
+        manifest: List[Dict[str, Any]] = []
+
+        def items():
+            for (kind, key), (position, shard_number, first, count) in units:
+                entry = {"kind": kind, "key": key, "count": 0, "position": position}
+                manifest.append(entry)
+                for i in range(first, first + count):
+                    yield entry, kind, key, readers[shard_number][i]
+
+        def records():
+            # Counts are filled in as records are kept; the manifest is complete once
+            # save_training_data has consumed this generator
+            for entry, record in filter_batches(items(), dedup=dedup):
+                entry["count"] += 1
+                yield record
+
+        stats = save_training_data(records(), output_file, manifest)
+    finally:
+        for reader in readers:
+            reader.close()
+    merge_reviews(shard_outputs, output_file, {unit_id: position for unit_id, (position, _, _, _) in index.items()})
+    if dedup is not None:
+        dedup.log_summary()
+    return stats
+
+def merge_reviews(shard_outputs: List[str], output_file: str, positions: Dict[Tuple[str, str], int]):
+    """Combine the shards' low-quality review files into output_file's, ordered by plan position."""
+    flagged: List[Tuple[int, str]] = []
+    for shard_output in shard_outputs:
+        review_file = low_quality_path_for(shard_output)
+        if not review_file.exists():
+            continue
+        with open(review_file, 'r', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                flagged.append((positions.get((entry["kind"], entry["key"]), -1), line))
+    review_file = low_quality_path_for(output_file)
+    if not flagged:
+        review_file.unlink(missing_ok=True)
+        return
+    flagged.sort(key=lambda item: item[0])
+    with open(review_file, 'w', encoding='utf-8') as f:
+        f.writelines(line for _, line in flagged)
+    logger.info(f"Listed {len(flagged)} low-quality examples from {len(shard_outputs)} shards in {review_file}")
+
+SPLIT_NAMES = ("train", "val", "test")
+DEFAULT_SPLIT_RATIOS = (0.9, 0.05, 0.05)
+# Unit kinds as recorded in manifests, in canonical plan order
+UNIT_KINDS = ("documentation", "code_example", "integration", "code_generation")
+
+def split_path_for(output_file: str, split: str) -> str:
+    """Return the path of one split of an output file, e.g. out.train.jsonl or out.train.jsonl.gz."""
+    base = output_base(output_file)
+    compressed_suffix = Path(output_file).suffix if compression_of(output_file) else ""
+    return str(base.with_name(f"{base.stem}.{split}{base.suffix}{compressed_suffix}"))
+
+def split_output(
+    output_file: str,
+    ratios: Tuple[float, float, float] = DEFAULT_SPLIT_RATIOS,
+    caps: Optional[Dict[str, int]] = None
+) -> Dict[str, Dict[str, int]]:
+    """Write train, validation and test splits of an output in one streaming pass.
+
+    Each record is assigned by a hash of its source unit key and its
+    serialized content, so a record keeps its split across incremental
+    rebuilds that carry it over unchanged. caps limits the number of records
+    per unit kind: the per-kind totals come from the manifest, and each
+    record is kept if a second, independent part of its hash falls under
+    cap / total, so capped kinds are sampled evenly across the whole output
+    and every split rather than truncated to the first units.
+
+    Splits with a zero ratio are not written, and removed if an earlier run
+    left them behind. Returns the record count per split and kind.
+    """
+    with open(manifest_path_for(output_file), 'r', encoding='utf-8') as f:
+        manifest = json.load(f)["units"]
+    totals: Dict[str, int] = {}
+    for entry in manifest:
+        totals[entry["kind"]] = totals.get(entry["kind"], 0) + entry["count"]
+    keep_fraction = {kind: min(1.0, cap / totals[kind]) if totals.get(kind) else 1.0
+                     for kind, cap in (caps or {}).items()}
+    bounds = np.cumsum(ratios) / sum(ratios)
+    bounds[-1] = 1.0
+    counts: Dict[str, Dict[str, int]] = {split: {} for split, ratio in zip(SPLIT_NAMES, ratios) if ratio > 0}
+    for split in SPLIT_NAMES:
+        if split not in counts:
+            Path(split_path_for(output_file, split)).unlink(missing_ok=True)
+            index_path_for(split_path_for(output_file, split)).unlink(missing_ok=True)
+
+    with ExitStack() as stack:
+        writers = {split: stack.enter_context(JsonlWriter(split_path_for(output_file, split))) for split in counts}
+        f = stack.enter_context(open_jsonl(output_file))
+        for entry in manifest:
+            kind, prefix = entry["kind"], f"{entry['key']}\0".encode('utf-8')
+            for _ in range(entry["count"]):
+                line = f.readline()
+                digest = hashlib.sha256(prefix + line).digest()
+                if kind in keep_fraction:
+                    if int.from_bytes(digest[8:16], "big") / 2**64 >= keep_fraction[kind]:
+                        continue
+                    if sum(split_counts.get(kind, 0) for split_counts in counts.values()) >= caps[kind]:
+                        continue
+                split = SPLIT_NAMES[int(np.searchsorted(bounds, int.from_bytes(digest[:8], "big") / 2**64, side="right"))]
+                writers[split].write_line(line)
+                counts[split][kind] = counts[split].get(kind, 0) + 1
+
+    for split, split_counts in counts.items():
+        logger.info(f"Split {split}: {sum(split_counts.values())} examples to {split_path_for(output_file, split)} ("
+                    + ", ".join(f"{count} {kind}" for kind, count in sorted(split_counts.items())) + ")")
+    return counts
+
+CHECKPOINT_FILE = "fine_tune_checkpoint.jsonl"
+
+def parse_split_ratios(value: str) -> Tuple[float, float, float]:
+    """Parse "train,val,test" split ratios such as 0.9,0.05,0.05."""
+    try:
+        ratios = tuple(float(part) for part in value.split(","))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid split ratios: {value!r}")
+    if len(ratios) != len(SPLIT_NAMES) or min(ratios) < 0 or not sum(ratios) > 0:
+        raise argparse.ArgumentTypeError(f"expected three non-negative ratios like 0.9,0.05,0.05, got {value!r}")
+    return ratios
+
+def parse_split_cap(value: str) -> Tuple[str, int]:
+    """Parse a KIND=N cap on the records of one unit kind."""
+    kind, _, cap = value.partition("=")
+    if kind not in UNIT_KINDS or not cap.isdigit():
+        raise argparse.ArgumentTypeError(f"expected KIND=N with KIND one of {', '.join(UNIT_KINDS)}, got {value!r}")
+    return kind, int(cap)
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    """Parse the subcommand and its options.
+
+    Invocations without a subcommand (only options) run generate, so existing
+    command lines keep working.
+    """
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if not argv or (argv[0].startswith("-") and argv[0] not in ("-h", "--help")):
+        argv.insert(0, "generate")
+
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument("--output", default="comprehensive_training.jsonl",
+                        help="Output JSONL file; a .gz or .zst suffix compresses it (default: comprehensive_training.jsonl)")
+
+    sharding = argparse.ArgumentParser(add_help=False)
+    sharding.add_argument("--shard-index", type=int, default=0,
+                          help="Which shard of the corpus this process generates (default: 0)")
+    sharding.add_argument("--shard-count", type=int, default=1,
+                          help="Number of shards the corpus is split into (default: 1)")
+
+    corpus = argparse.ArgumentParser(add_help=False)
+    corpus.add_argument("--docs", nargs="+", default=["data/llm-full.txt"], metavar="FILE",
+                        help="Markdown documentation files to split (default: data/llm-full.txt)")
+    corpus.add_argument("--stream-docs", action="store_true",
+                        help="Stream documentation header section by header section so generation starts on the "
+                             "first chunks; changes chunk boundaries")
+    corpus.add_argument("--loader-workers", type=int, default=None,
+                        help="Processes splitting --docs files in parallel with --stream-docs (default: CPU count)")
+    corpus.add_argument("--tokenizer", default="approx",
+                        help="Token counter: approx, tiktoken or tiktoken:<encoding> (default: approx)")
+    corpus.add_argument("--chunk-tokens", type=int, default=0,
+                        help="Split documentation into chunks of this many tokens instead of 2000 characters")
+    corpus.add_argument("--chunk-overlap-tokens", type=int, default=50,
+                        help="Token overlap between chunks with --chunk-tokens (default: 50)")
+    corpus.add_argument("--min-grounding", type=float, default=0.0,
+                        help="Drop pairs whose answer has a smaller share of content words found in its source (default: 0)")
+    corpus.add_argument("--min-identifier-coverage", type=float, default=0.0,
+                        help="Drop pairs whose answer has a smaller share of code identifiers found in its source (default: 0)")
+    corpus.add_argument("--min-answer-words", type=int, default=0,
+                        help="Drop pairs whose answer is shorter than this many words (default: 0)")
+    corpus.add_argument("--flag-low-quality", action="store_true",
+                        help="Keep pairs below the quality thresholds; they are still listed in <output>.low_quality.jsonl")
+    corpus.add_argument("--quality-report", action="store_true",
+                        help="Score pairs and log the quality score distribution even when no threshold is set")
+
+    deduplication = argparse.ArgumentParser(add_help=False)
+    deduplication.add_argument("--dedup-threshold", type=float, default=0.8,
+                               help="Drop pairs whose estimated Jaccard similarity to a kept pair reaches this; 0 disables (default: 0.8)")
+
+    splitting = argparse.ArgumentParser(add_help=False)
+    splitting.add_argument("--split", type=parse_split_ratios, metavar="TRAIN,VAL,TEST",
+                           help="Also write train/val/test splits of the output with these ratios, e.g. 0.9,0.05,0.05")
+    splitting.add_argument("--split-cap", type=parse_split_cap, action="append", default=[], metavar="KIND=N",
+                           help="Keep at most N records of a unit kind across the splits; repeatable")
+
+    generation = argparse.ArgumentParser(add_help=False)
+    generation.add_argument("--async", dest="use_async", action="store_true",
+                            help="Run LLM requests concurrently with ainvoke")
+    generation.add_argument("--max-concurrency", type=int, default=8,
+                            help="Maximum in-flight requests in async mode (default: 8)")
+    generation.add_argument("--requests-per-minute", type=int, default=500,
+                            help="Request rate budget (default: 500)")
+    generation.add_argument("--tokens-per-minute", type=int, default=150_000,
+                            help="Estimated token rate budget (default: 150000)")
+    generation.add_argument("--max-retries", type=int, default=5,
+                            help="Retries per request for rate limits, timeouts and server errors (default: 5)")
+    generation.add_argument("--retry-passes", type=int, default=1,
+                            help="Extra passes over units that failed (default: 1)")
+    generation.add_argument("--allow-failed-units", action="store_true",
+                            help="Publish the output even if some units still failed")
+    generation.add_argument("--cache-dir", default=".llm_cache",
+                            help="Directory for the LLM response cache (default: .llm_cache)")
+    generation.add_argument("--cache-max-mb", type=int, default=512,
+                            help="Evict least recently used cache entries above this size (default: 512)")
+    generation.add_argument("--no-cache", action="store_true",
+                            help="Always call the model, ignoring the response cache")
+    generation.add_argument("--pack-tokens", type=int, default=0,
+                            help="Bundle small documentation chunks into one request up to this many tokens")
+    generation.add_argument("--longest-first", action="store_true",
+                            help="With --async, start the units with the largest estimated token cost first")
+    generation.add_argument("--model", default=DEFAULT_MODEL,
+                            help=f"Model used for every unit, or as the fallback with --cheap-model (default: {DEFAULT_MODEL})")
+    generation.add_argument("--cheap-model",
+                            help="Try this model first on short units, falling back to --model when its result falls short")
+    generation.add_argument("--cheap-kinds", nargs="+", default=list(DEFAULT_CHEAP_KINDS), choices=list(REQUESTED_PAIRS),
+                            help="Unit kinds that may go to --cheap-model (default: documentation and code examples)")
+    generation.add_argument("--cheap-max-tokens", type=int, default=2000,
+                            help="Longest prompt, in tokens, sent to --cheap-model (default: 2000)")
+    generation.add_argument("--routing-min-success", type=float, default=0.9,
+                            help="Stop routing a kind to --cheap-model below this success rate (default: 0.9)")
+    generation.add_argument("--package-src", default="../../src",
+                            help="Package sources whose exports generated code may import (default: ../../src)")
+    generation.add_argument("--no-code-validation", action="store_true",
+                            help="Do not parse generated implementations or check their imports")
+    generation.add_argument("--validation-workers", type=int,
+                            help="Processes validating generated code (default: one per CPU)")
+    generation.add_argument("--structured-output", action="store_true",
+                            help="Request JSON-schema structured output (falls back to plain JSON if unsupported)")
+    generation.add_argument("--metrics-file",
+                            help="Per-call metrics JSONL (default: <output>.metrics.jsonl)")
+    generation.add_argument("--no-metrics", action="store_true",
+                            help="Do not record per-call metrics")
+    generation.add_argument("--incremental", action="store_true",
+                            help="Reuse records of unchanged chunks from the previous output and its manifest")
+    batch = generation.add_mutually_exclusive_group()
+    batch.add_argument("--batch-export", metavar="REQUESTS_JSONL",
+                       help="Write all prompts as a batch request file and exit")
+    batch.add_argument("--batch-ingest", metavar="RESULTS_JSONL",
+                       help="Build the output from a batch results file instead of calling the model")
+
+    parser = argparse.ArgumentParser(description="Generate Voice UI Kit fine-tuning data")
+    commands = parser.add_subparsers(dest="command", metavar="COMMAND")
+    command = commands.add_parser("generate", parents=[output, sharding, corpus, deduplication, splitting, generation],
+                                  help="Generate training data, resuming from a checkpoint if one exists")
+    command.set_defaults(handler=run_generate)
+    command = commands.add_parser("resume", parents=[output, sharding, corpus, deduplication, splitting, generation],
+                                  help="Continue an interrupted run; fails if there is no checkpoint")
+    command.set_defaults(handler=run_resume)
+    command = commands.add_parser("stats", parents=[output, sharding],
+                                  help="Summarize the checkpoint, output and call metrics without loading the corpus")
+    command.add_argument("--metrics-file",
+                         help="Per-call metrics JSONL (default: <output>.metrics.jsonl)")
+    command.set_defaults(handler=run_stats)
+    command = commands.add_parser("merge", parents=[output, deduplication, splitting],
+                                  help="Merge shard outputs into --output in canonical order without loading the corpus")
+    command.add_argument("shards", nargs="+", metavar="SHARD_JSONL",
+                         help="Shard output files written by generate --shard-index/--shard-count")
+    command.add_argument("--allow-missing", action="store_true",
+                         help="Merge even if some units are missing from the shard outputs")
+    command.set_defaults(handler=run_merge)
+    command = commands.add_parser("split", parents=[output, splitting],
+                                  help="Write train/val/test splits of an existing output (default ratios 0.9,0.05,0.05)")
+    command.set_defaults(handler=run_split)
+    command = commands.add_parser("clear-checkpoint", parents=[output, sharding],
+                                  help="Delete the checkpoint journal and partial output")
+    command.set_defaults(handler=run_clear_checkpoint)
+
+    args = parser.parse_args(argv)
+    if getattr(args, "split_cap", None) and args.split is None and args.command != "split":
+        parser.error("--split-cap needs --split")
+    if hasattr(args, "shard_count") and (args.shard_count < 1 or not 0 <= args.shard_index < args.shard_count):
+        parser.error("--shard-index must be between 0 and --shard-count - 1")
+    return args
+
+def resolve_files(args: argparse.Namespace) -> Tuple[Optional[Tuple[int, int]], str, str]:
+    """Return the shard and the checkpoint and output files it uses; each shard keeps its own."""
+    shard = (args.shard_index, args.shard_count) if args.shard_count > 1 else None
+    if shard is None:
+        return None, CHECKPOINT_FILE, args.output
+    return shard, shard_path(CHECKPOINT_FILE, shard), shard_path(args.output, shard)
+
+def load_corpus(args: argparse.Namespace, token_counter: Callable[[str], int],
+                collected: Optional[List[TrainingExample]] = None) -> Iterable[TrainingExample]:
+    """Load documentation chunks and TypeScript examples as configured by the corpus options.
+
+    With --stream-docs this returns a generator: documentation chunks are
+    streamed from iter_documents and the code examples are loaded once they
+    are exhausted. Otherwise it returns a list. Every example loaded is also
+    appended to collected, so a streamed corpus can be used again afterwards.
+    """
+    collected = [] if collected is None else collected
+    chunk_size, chunk_overlap = (args.chunk_tokens, args.chunk_overlap_tokens) if args.chunk_tokens else (2000, 200)
+    if args.stream_docs:
+        def stream() -> Iterator[TrainingExample]:
+            doc_count = 0
+            for example in iter_documents(args.docs, chunk_size, chunk_overlap,
+                                          tokenizer=args.tokenizer if args.chunk_tokens else None,
+                                          max_workers=args.loader_workers):
+                doc_count += 1
+                collected.append(example)
+                yield example
+            code_examples = load_typescript_examples()
+            logger.info(f"Total examples loaded: {doc_count + len(code_examples)} "
+                        f"({doc_count} docs, {len(code_examples)} code)")
+            collected.extend(code_examples)
+            yield from code_examples
+        return stream()
+
+    doc_examples = []
+    for file_path in args.docs:
+        doc_examples.extend(load_and_split_documents(file_path, chunk_size, chunk_overlap,
+                                                     length_function=token_counter if args.chunk_tokens else None))
+    code_examples = load_typescript_examples()
+    logger.info(f"Total examples loaded: {len(doc_examples) + len(code_examples)} "
+                f"({len(doc_examples)} docs, {len(code_examples)} code)")
+    collected.extend(doc_examples + code_examples)
+    return doc_examples + code_examples
+
+def build_quality_filter(args: argparse.Namespace, all_examples: List[TrainingExample]) -> Optional[QualityFilter]:
+    """Create the QualityFilter configured by the corpus options.
+
+    Returns None when no threshold is set and --quality-report is not given,
+    so runs that filter nothing skip collecting grounding sources.
+    """
+    if not (args.min_grounding > 0 or args.min_identifier_coverage > 0 or args.min_answer_words > 0
+            or args.quality_report):
+        return None
+    return QualityFilter(grounding_sources(all_examples), args.min_grounding, args.min_identifier_coverage,
+                         args.min_answer_words, flag_only=args.flag_low_quality)
+
+def run_generate(args: argparse.Namespace):
+    """Generate training data with checkpointing, or run an offline batch export/ingest."""
     logger.info("Starting comprehensive fine-tuning data generation process")
+    shard, checkpoint_file, output_file = resolve_files(args)
+    
+    # Initialize checkpoint manager and response cache
+    checkpoint_manager = CheckpointManager(checkpoint_file, output_file)
+    context = GenerationContext(
+        cache=None if args.no_cache else ResponseCache(args.cache_dir, max_bytes=args.cache_max_mb * 1024 * 1024),
+        scheduler=RequestScheduler(
+            max_concurrency=args.max_concurrency if args.use_async else 1,
+            requests_per_minute=args.requests_per_minute,
+            tokens_per_minute=args.tokens_per_minute,
+            max_retries=args.max_retries
+        ),
+        token_counter=get_token_counter(args.tokenizer),
+        metrics=None if args.no_metrics else CallMetrics(args.metrics_file or str(metrics_path_for(output_file))),
+        structured_output=args.structured_output
+    )
     
-    # Initialize checkpoint manager
-    checkpoint_manager = CheckpointManager()
+    if not args.no_code_validation:
+        try:
+            exports = load_package_exports(args.package_src)
+        except FileNotFoundError as e:
+            logger.warning(f"{e}; generated code will not be validated")
+        else:
+            cache_file = None if args.no_cache else str(Path(args.cache_dir) / "code_validation.jsonl")
+            context.validator = CodeValidator(exports, cache_file, args.validation_workers)
     
     try:
-        # Load documentation
-        doc_examples = load_and_split_documents("data/llm-full.txt")
-        
-        # Load TypeScript examples
-        code_examples = load_typescript_examples()
+        corpus: List[TrainingExample] = []
+        all_examples = load_corpus(args, context.token_counter, collected=corpus)
         
-        # Combine all examples
-        all_examples = doc_examples + code_examples
-        logger.info(f"Total examples loaded: {len(all_examples)} ({len(doc_examples)} docs, {len(code_examples)} code)")
+        # Offline batch modes never call the model directly; they need the whole corpus
+        if args.batch_export or args.batch_ingest:
+            all_examples = list(all_examples)
+        if args.batch_export:
+            export_batch_requests(all_examples, args.batch_export, args.model, structured_output=args.structured_output)
+            return
+        dedup = NearDuplicateFilter(args.dedup_threshold) if args.dedup_threshold > 0 else None
+        if args.batch_ingest:
+            # Like generate, a shard writes its own output and leaves deduplication and splits to merge
+            ingest_batch_results(all_examples, args.batch_ingest, output_file, args.model, cache=context.cache,
+                                 dedup=None if shard else dedup, validator=context.validator,
+                                 quality=build_quality_filter(args, all_examples), shard=shard)
+            if context.cache is not None:
+                context.cache.log_stats()
+            if args.split and shard is None:
+                split_output(output_file, args.split, dict(args.split_cap))
+            # The published output supersedes any interrupted generate run for the same file
+            if Path(checkpoint_file).exists():
+                checkpoint_manager.clear_checkpoint()
+            return
         
         # Initialize LLM
-        logger.info("Initializing ChatOpenAI model")
-        llm = ChatOpenAI(model="gpt-4")
+        from langchain_openai import ChatOpenAI
+        logger.info(f"Initializing ChatOpenAI model {args.model}")
+        llm = ChatOpenAI(model=args.model)
+        if args.cheap_model:
+            context.router = ModelRouter(llm, ChatOpenAI(model=args.cheap_model), args.cheap_kinds,
+                                         args.cheap_max_tokens, args.routing_min_success)
+            metrics_file = args.metrics_file or str(metrics_path_for(output_file))
+            if Path(metrics_file).exists():
+                context.router.observe_history(CallMetrics.load(metrics_file))
         
         # Generate comprehensive training data with checkpointing
-        training_data = create_comprehensive_training_data_with_checkpoints(all_examples, llm, checkpoint_manager)
+        incremental_from = output_file if args.incremental else None
+        with GracefulShutdown() as context.shutdown:
+            if args.use_async:
+                checkpoint = asyncio.run(acreate_comprehensive_training_data_with_checkpoints(
+                    all_examples, llm, checkpoint_manager, max_concurrency=args.max_concurrency, context=context,
+                    incremental_from=incremental_from, retry_passes=args.retry_passes, pack_tokens=args.pack_tokens,
+                    shard=shard, longest_first=args.longest_first
+                ))
+            else:
+                checkpoint = create_comprehensive_training_data_with_checkpoints(
+                    all_examples, llm, checkpoint_manager, context, incremental_from=incremental_from,
+                    retry_passes=args.retry_passes, pack_tokens=args.pack_tokens, shard=shard
+                )
+        
+        if context.cache is not None:
+            context.cache.log_stats()
+        context.scheduler.log_stats()
+        if context.router is not None:
+            context.router.log_stats()
+        if context.validator is not None:
+            context.validator.log_stats()
+        if context.metrics is not None:
+            context.metrics.log_summary()
+            context.metrics.close()
+        
+        if context.stopping():
+            hint = ("Progress has been saved. Run the resume command to continue." if Path(checkpoint_file).exists()
+                    else "No unit was journaled yet; run the generate command again.")
+            logger.warning(f"Interrupted by {signal.Signals(context.shutdown.signum).name}. {hint}")
+            sys.exit(128 + context.shutdown.signum)
         
-        if not training_data:
+        if checkpoint.failed_units:
+            logger.error(f"{len(checkpoint.failed_units)} units failed: "
+                         + ", ".join(f"{unit['kind']} {unit['key']}" for unit in checkpoint.failed_units))
+            if not args.allow_failed_units:
+                logger.info("Progress has been saved. Run the resume command to retry the failed units.")
+                sys.exit(1)
+        
+        if not checkpoint.stats.total:
             logger.error("No training data generated. Exiting.")
             return
         
-        # Save training data
-        save_training_data(training_data)
+        # Publish the streamed training data; shards are deduplicated and split globally by merge
+        checkpoint_manager.finalize_output(checkpoint, None if shard else dedup, build_quality_filter(args, corpus))
+        if args.split and shard is None:
+            split_output(output_file, args.split, dict(args.split_cap))
         
         # Clear checkpoint after successful completion
         checkpoint_manager.clear_checkpoint()
@@ -572,8 +4085,94 @@ def main():
         
     except Exception as e:
         logger.error(f"Error in main process: {e}")
-        logger.info("Progress has been saved. You can resume by running the script again.")
+        logger.info("Progress has been saved. You can resume with the resume command.")
         raise
+    finally:
+        if context.validator is not None:
+            context.validator.close()
+
+def run_resume(args: argparse.Namespace):
+    """Continue an interrupted generate run from its checkpoint."""
+    _, checkpoint_file, _ = resolve_files(args)
+    if not Path(checkpoint_file).exists():
+        logger.error(f"No checkpoint found at {checkpoint_file}; use the generate command to start a new run")
+        sys.exit(1)
+    run_generate(args)
+
+def run_stats(args: argparse.Namespace):
+    """Log progress of an interrupted run, the published output and call metrics.
+
+    Only reads files: the checkpoint journal is replayed without compacting it
+    and the partial output is not truncated, so this is safe to run next to a
+    generate process.
+    """
+    _, checkpoint_file, output_file = resolve_files(args)
+    manager = CheckpointManager(checkpoint_file, output_file)
+    found = False
+
+    if Path(checkpoint_file).exists():
+        found = True
+        entries, dead = manager._read_entries()
+        units: Dict[str, int] = {}
+        examples: Dict[str, int] = {}
+        for entry in entries:
+            units[entry["kind"]] = units.get(entry["kind"], 0) + 1
+            examples[entry["kind"]] = examples.get(entry["kind"], 0) + entry["count"]
+        offset = entries[-1]["offset"] if entries else 0
+        partial_size = Path(manager.partial_file).stat().st_size if Path(manager.partial_file).exists() else 0
+        logger.info(f"Checkpoint {checkpoint_file}: {len(entries)} units journaled ({dead} stale lines), "
+                    f"partial output {partial_size} bytes ({partial_size - offset} not yet journaled)")
+        for kind in sorted(units):
+            logger.info(f"  {kind}: {units[kind]} units, {examples[kind]} examples")
+        if entries:
+            TrainingDataStats(**entries[-1]["stats"]).log_summary()
+
+    if Path(output_file).exists():
+        found = True
+        stats = TrainingDataStats()
+        with open_jsonl(output_file) as f:
+            for line in f:
+                stats.add(json.loads(line))
+        logger.info(f"Output {output_file}: {stats.total} examples")
+        manifest_file = manifest_path_for(output_file)
+        if manifest_file.exists():
+            with open(manifest_file, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)["units"]
+            kinds: Dict[str, int] = {}
+            for entry in manifest:
+                kinds[entry["kind"]] = kinds.get(entry["kind"], 0) + 1
+            logger.info(f"  Manifest: {len(manifest)} units ("
+                        + ", ".join(f"{count} {kind}" for kind, count in sorted(kinds.items())) + ")")
+        stats.log_summary()
+
+    metrics_file = args.metrics_file or str(metrics_path_for(output_file))
+    if Path(metrics_file).exists():
+        found = True
+        CallMetrics.load(metrics_file).log_summary()
+
+    if not found:
+        logger.info(f"Nothing to report: no checkpoint, output or metrics for {output_file}")
+
+def run_merge(args: argparse.Namespace):
+    """Merge shard outputs into one output in canonical order, without loading the corpus."""
+    dedup = NearDuplicateFilter(args.dedup_threshold) if args.dedup_threshold > 0 else None
+    merge_shard_outputs(args.shards, args.output, dedup, allow_missing=args.allow_missing)
+    if args.split:
+        split_output(args.output, args.split, dict(args.split_cap))
+
+def run_split(args: argparse.Namespace):
+    """Write train/val/test splits of an existing output."""
+    split_output(args.output, args.split or DEFAULT_SPLIT_RATIOS, dict(args.split_cap))
+
+def run_clear_checkpoint(args: argparse.Namespace):
+    """Delete the checkpoint journal and partial output so the next run starts over."""
+    _, checkpoint_file, output_file = resolve_files(args)
+    CheckpointManager(checkpoint_file, output_file).clear_checkpoint()
+
+def main(argv: Optional[List[str]] = None):
+    """Run the requested subcommand."""
+    args = parse_args(argv)
+    args.handler(args)
 
 if __name__ == "__main__":
     main()